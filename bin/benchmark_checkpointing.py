@@ -0,0 +1,82 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Peak memory against step time of a ViLBERT forward/backward for different
+# gradient checkpointing settings of `BertEncoder`.
+import time
+import yaml
+import argparse
+import torch
+
+from src.model.vilbert.vilbert import BertConfig, BertModel
+
+# (name, t_checkpoint_id, v_checkpoint_id, c_checkpoint_id)
+SETTINGS = [
+    ('none',         [],    [],    []),
+    ('co-attention', [],    [],    'all'),
+    ('text',         'all', [],    []),
+    ('image',        [],    'all', []),
+    ('all',          'all', 'all', 'all'),
+]
+
+
+def find_vilbert_config(config):
+    if isinstance(config, dict):
+        if 'vilbert_config' in config:
+            return config['vilbert_config']
+        for v in config.values():
+            found = find_vilbert_config(v)
+            if found is not None:
+                return found
+    return None
+
+
+def run(args):
+    device = torch.device('cuda' if args.gpu and torch.cuda.is_available() else 'cpu')
+    vilbert_config = dict(find_vilbert_config(yaml.safe_load(open(args.config, 'r'))))
+    torch.manual_seed(args.seed)
+    txt = torch.randint(1000, 2000, (args.batch_size, args.num_words), device=device)
+    imgs = torch.rand(args.batch_size, args.num_bboxs, vilbert_config['v_feature_size'], device=device)
+    locs = torch.rand(args.batch_size, args.num_bboxs, 5, device=device)
+
+    print("[INFO] batch_size: {} | num_words: {} | num_bboxs: {} | device: {}".format(
+        args.batch_size, args.num_words, args.num_bboxs, device))
+    for name, t_ids, v_ids, c_ids in SETTINGS:
+        vilbert_config.update(t_checkpoint_id=t_ids, v_checkpoint_id=v_ids, c_checkpoint_id=c_ids)
+        model = BertModel(BertConfig.from_dict(vilbert_config)).to(device)
+        model.train()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        for it in range(args.n_iters + 1):
+            if it == 1:
+                # First iteration is warm-up
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.time()
+            _, _, pooled_t, pooled_v, _ = model(txt, imgs, locs)
+            (pooled_t.sum() + pooled_v.sum()).backward()
+            model.zero_grad()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_time = (time.time() - start) / args.n_iters
+        msg = "[{}] step time - {:.1f} ms".format(name, 1e3 * step_time)
+        if device.type == 'cuda':
+            msg += " | peak mem - {:.1f} MB".format(torch.cuda.max_memory_allocated(device) / 2 ** 20)
+        print(msg)
+        del model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark gradient checkpointing settings of the ViLBERT encoder.')
+    parser.add_argument('--config', default='config_files/guesser_vilbert.yaml', type=str,
+                        help='Yaml config with a `vilbert_config` entry.')
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--num-words', default=20, type=int)
+    parser.add_argument('--num-bboxs', default=101, type=int)
+    parser.add_argument('--n-iters', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--gpu', action='store_true',
+                        help='Run on GPU if available.')
+    args = parser.parse_args()
+    run(args)
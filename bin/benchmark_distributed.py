@@ -0,0 +1,110 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Data-parallel scaling of Oracle ViLBERT training on CPU: N gloo processes
+# each train on their `DistributedSampler` shard of random Oracle inputs with a
+# fixed global batch size, and rank 0 reports the epoch time and throughput.
+import os
+import time
+import yaml
+import argparse
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+
+from src.model.oracle_vilbert import OracleModel
+
+
+def random_oracle_data(args, v_feature_size):
+    torch.manual_seed(args.seed)
+    n = args.num_samples
+    return TensorDataset(
+        torch.randint(1000, 2000, (n, args.num_words)),
+        torch.randint(1, 91, (n,)),
+        torch.rand(n, 5),
+        torch.rand(n, v_feature_size),
+        torch.rand(n, args.num_bboxs, 5),
+        torch.rand(n, args.num_bboxs, v_feature_size),
+        torch.randint(0, 3, (n,)))
+
+
+def worker(rank, n_procs, args, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    torch.set_num_threads(args.threads_per_proc or max(1, (os.cpu_count() or 1) // n_procs))
+    dist.init_process_group(backend='gloo', init_method='env://', rank=rank, world_size=n_procs)
+
+    config = yaml.safe_load(open(args.config, 'r'))['model']
+    if args.num_layers is not None:
+        # Smaller text stream, the co-attention layers keep their place at the end
+        vilbert_config = config['vilbert_config']
+        n_drop = vilbert_config['num_hidden_layers'] - args.num_layers
+        vilbert_config['num_hidden_layers'] = args.num_layers
+        vilbert_config['t_biattention_id'] = [i - n_drop for i in vilbert_config['t_biattention_id']]
+    torch.manual_seed(args.seed)
+    model = DistributedDataParallel(OracleModel(num_wrds=30522, wrd_pad_id=0, **config))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    loss_fn = nn.CrossEntropyLoss()
+
+    dataset = random_oracle_data(args, config['vilbert_config']['v_feature_size'])
+    sampler = DistributedSampler(dataset, shuffle=True)
+    loader = DataLoader(dataset, batch_size=max(1, args.batch_size // n_procs), sampler=sampler)
+    for epoch in range(args.n_epochs + 1):
+        if epoch == 1:
+            # First epoch is warm-up
+            dist.barrier()
+            start = time.time()
+        sampler.set_epoch(epoch)
+        for wrds, cat, bbox, img_feat, bg_bboxs, bg_img_feats, answer in loader:
+            pred = model(wrds, cat, bbox, img_feat, bg_bboxs, bg_img_feats,
+                         attention_mask=torch.ones_like(wrds))
+            loss = loss_fn(pred, answer)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    dist.barrier()
+    if rank == 0:
+        results[n_procs] = (time.time() - start) / args.n_epochs
+    dist.destroy_process_group()
+
+
+def run(args):
+    if args.num_layers is not None:
+        vilbert_config = yaml.safe_load(open(args.config, 'r'))['model']['vilbert_config']
+        assert args.num_layers >= len(vilbert_config['t_biattention_id']), \
+            "--num-layers should keep the %d co-attention layers." % len(vilbert_config['t_biattention_id'])
+    results = mp.Manager().dict()
+    for n_procs in args.n_procs:
+        mp.spawn(worker, args=(n_procs, args, results), nprocs=n_procs, join=True)
+
+    print("[INFO] samples: {} | global batch_size: {} | num_words: {} | num_bboxs: {}".format(
+        args.num_samples, args.batch_size, args.num_words, args.num_bboxs))
+    base = results[args.n_procs[0]] * args.n_procs[0]
+    for n_procs in args.n_procs:
+        epoch_time = results[n_procs]
+        print("[{} proc(s)] epoch - {:.2f}s | {:.1f} samples/s | scaling efficiency {:.2f}".format(
+            n_procs, epoch_time, args.num_samples / epoch_time, base / (n_procs * epoch_time)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark CPU data-parallel scaling of Oracle training with gloo.')
+    parser.add_argument('--config', default='config_files/oracle_vilbert.yaml', type=str)
+    parser.add_argument('--n-procs', default=[1, 2, 4], type=int, nargs='+')
+    parser.add_argument('--threads-per-proc', default=None, type=int,
+                        help='Default: cores / n-procs.')
+    parser.add_argument('--num-layers', default=None, type=int,
+                        help='Text layers of the ViLBERT trunk, default: as in the config.')
+    parser.add_argument('--num-samples', default=256, type=int)
+    parser.add_argument('--batch-size', default=32, type=int,
+                        help='Global batch size, split over the processes.')
+    parser.add_argument('--num-words', default=16, type=int)
+    parser.add_argument('--num-bboxs', default=36, type=int)
+    parser.add_argument('--n-epochs', default=2, type=int)
+    parser.add_argument('--port', default=29512, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,74 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Time K candidate questions per dialog with `QGenModel.generate_candidates`
+# (beam search and K-way sampling) against calling `generate_sentence` K times.
+import time
+import yaml
+import argparse
+import torch
+
+from src.model.qgen_vilbert import QGenModel
+
+
+def timed(fn, device, n_iters):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(n_iters):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, (time.time() - start) / n_iters
+
+
+def run(args):
+    device = torch.device('cuda' if args.gpu and torch.cuda.is_available() else 'cpu')
+    config = yaml.safe_load(open(args.config, 'r'))['model']
+    torch.manual_seed(args.seed)
+    model = QGenModel(num_wrds=args.num_wrds, wrd_pad_id=0, **config).to(device).eval()
+    num_bboxs = config['num_bboxs']
+    img_feats = torch.rand(args.batch_size, num_bboxs, config['obj_feat_size'] - 5, device=device)
+    bboxs = torch.rand(args.batch_size, num_bboxs, 5, device=device)
+    pi = torch.softmax(torch.randn(args.batch_size, num_bboxs, device=device), dim=-1)
+    last_wrd = torch.randint(1000, 2000, (args.batch_size,), device=device)
+    end_of_dialog = torch.zeros(args.batch_size, dtype=torch.bool, device=device)
+    # BERT ids of `?` (<eoq>) and `[unused1]` (<eod>)
+    eoq_token, eod_token = 1029, 2
+    inputs = (last_wrd, img_feats, bboxs, eoq_token, eod_token, end_of_dialog, args.max_q_len)
+
+    def loop_sample():
+        return [model.generate_sentence(*inputs, pi=pi, greedy=False) for _ in range(args.k)]
+
+    with torch.no_grad():
+        _, loop_lat = timed(loop_sample, device, args.n_iters)
+        _, sample_lat = timed(lambda: model.generate_candidates(
+            *inputs, args.k, pi=pi, beam=False), device, args.n_iters)
+        (_, lengths, scores, _, _), beam_lat = timed(lambda: model.generate_candidates(
+            *inputs, args.k, pi=pi, beam=True, length_penalty=args.length_penalty), device, args.n_iters)
+
+    print("[INFO] batch_size: {} | K: {} | max_q_len: {} | device: {}".format(
+        args.batch_size, args.k, args.max_q_len, device))
+    print("[INFO] {} x generate_sentence (sample) - {:.2f} ms".format(args.k, 1e3 * loop_lat))
+    print("[INFO] generate_candidates (sample)   - {:.2f} ms ({:.2f}x)".format(
+        1e3 * sample_lat, loop_lat / sample_lat))
+    print("[INFO] generate_candidates (beam)     - {:.2f} ms | mean length {:.1f} | best score {:.3f}".format(
+        1e3 * beam_lat, lengths.float().mean().item(), scores[:, 0].mean().item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark batched K-candidate QGen decoding.')
+    parser.add_argument('--config', default='config_files/qgen_vilbert.yaml', type=str)
+    parser.add_argument('--num-wrds', default=30522, type=int)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--k', default=8, type=int,
+                        help='Candidates per dialog.')
+    parser.add_argument('--max-q-len', default=20, type=int)
+    parser.add_argument('--length-penalty', default=1.0, type=float)
+    parser.add_argument('--n-iters', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--gpu', action='store_true',
+                        help='Run on GPU if available.')
+    args = parser.parse_args()
+    run(args)
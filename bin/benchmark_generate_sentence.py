@@ -0,0 +1,102 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Compare the fixed-shape `QGenModel.generate_sentence` of qgen_vilbert against
+# the original loop, which indexes finished questions with `.nonzero()`.
+import time
+import yaml
+import argparse
+import torch
+
+from src.model.qgen_vilbert import QGenModel
+
+
+def reference_generate_sentence(
+    model, last_wrd, img_feats, bboxs, eoq_token, eod_token, end_of_dialog, max_q_len, pi, last_state):
+    last_wrd = last_wrd.clone()
+    last_state = last_state.clone()
+    batch_size = last_wrd.size(0)
+    finished = end_of_dialog.clone()
+    actual_length = torch.zeros_like(last_wrd).long()
+    obj_repr = model.img_mlp(torch.cat([img_feats, bboxs], dim=-1)) * pi.unsqueeze(-1)
+    vis_repr, _ = model.self_diff_attention(obj_repr, pi)
+    _q_tokens = []
+    for t in range(max_q_len):
+        logit, state = model.generate_word(last_wrd, vis_repr, last_state)
+        q_t = logit.argmax(dim=-1)
+        if model.shortlist is not None:
+            q_t = model.shortlist[q_t]
+        updated_indices = torch.logical_not(finished).nonzero().view(-1)
+        actual_length[updated_indices] = actual_length[updated_indices] + 1
+        last_state[:, :, updated_indices] = state[:, :, updated_indices].type_as(last_state)
+        last_wrd[updated_indices] = q_t[updated_indices]
+        _q_tokens.append(q_t)
+        new_end_of_dialog = (q_t == eod_token)
+        finished[((q_t == eoq_token) | new_end_of_dialog).nonzero().view(-1)] = 1
+        end_of_dialog = end_of_dialog | new_end_of_dialog
+        if finished.sum() == batch_size:
+            break
+    _q_tokens = torch.stack(_q_tokens).transpose(0, 1)
+    q_tokens = [_q_tok[:act_len] for _q_tok, act_len in zip(_q_tokens, actual_length)]
+    return q_tokens, actual_length, last_state, end_of_dialog
+
+
+def timed(fn, device, n_iters):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(n_iters):
+        out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, (time.time() - start) / n_iters
+
+
+def run(args):
+    device = torch.device('cuda' if args.gpu and torch.cuda.is_available() else 'cpu')
+    config = yaml.safe_load(open(args.config, 'r'))['model']
+    torch.manual_seed(args.seed)
+    model = QGenModel(num_wrds=args.num_wrds, wrd_pad_id=0, **config).to(device).eval()
+    num_bboxs = config['num_bboxs']
+    img_feats = torch.rand(args.batch_size, num_bboxs, config['obj_feat_size'] - 5, device=device)
+    bboxs = torch.rand(args.batch_size, num_bboxs, 5, device=device)
+    pi = torch.softmax(torch.randn(args.batch_size, num_bboxs, device=device), dim=-1)
+    last_wrd = torch.randint(1000, 2000, (args.batch_size,), device=device)
+    last_state = torch.randn(2, 1, args.batch_size, config['lstm_hidden_size'], device=device)
+    # Some dialogs have already ended
+    end_of_dialog = torch.rand(args.batch_size, device=device) < 0.2
+    # BERT ids of `?` (<eoq>) and `[unused1]` (<eod>)
+    eoq_token, eod_token = 1029, 2
+
+    with torch.no_grad():
+        (ref_q, ref_len, ref_state, ref_eod), ref_lat = timed(lambda: reference_generate_sentence(
+            model, last_wrd, img_feats, bboxs, eoq_token, eod_token, end_of_dialog,
+            args.max_q_len, pi, last_state), device, args.n_iters)
+        (q, q_len, state, eod), lat = timed(lambda: model.generate_sentence(
+            last_wrd, img_feats, bboxs, eoq_token, eod_token, end_of_dialog, args.max_q_len,
+            pi=pi, last_state=last_state.clone(), sync_every=args.sync_every), device, args.n_iters)
+
+    same_tokens = all(torch.equal(r, x[:l]) for r, x, l in zip(ref_q, q, q_len))
+    print("[INFO] batch_size: {} | max_q_len: {} | device: {}".format(
+        args.batch_size, args.max_q_len, device))
+    print("[INFO] Identical - tokens {} | lengths {} | end_of_dialog {} | max state diff {:.3e}".format(
+        same_tokens, torch.equal(ref_len, q_len), torch.equal(ref_eod, eod),
+        (ref_state - state).abs().max().item()))
+    print("[INFO] Latency - {:.2f} ms -> {:.2f} ms ({:.2f}x)".format(
+        1e3 * ref_lat, 1e3 * lat, ref_lat / lat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check and time the fixed-shape QGen sentence generation.')
+    parser.add_argument('--config', default='config_files/qgen_vilbert.yaml', type=str)
+    parser.add_argument('--num-wrds', default=30522, type=int)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--max-q-len', default=20, type=int)
+    parser.add_argument('--sync-every', default=4, type=int)
+    parser.add_argument('--n-iters', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--gpu', action='store_true',
+                        help='Run on GPU if available.')
+    args = parser.parse_args()
+    run(args)
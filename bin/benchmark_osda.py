@@ -0,0 +1,92 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Compare the closed-form OsDA glimpse logits against the original
+# implementation that materialises the N x N x D difference tensor.
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+from src.model.utils import osda_glimpse_logits, osda_hard_diff
+
+
+def reference_diff(obj_repr):
+    num_bboxs = obj_repr.size(1)
+    obj_feat_dim = obj_repr.size(-1)
+    diff = obj_repr.view(-1, num_bboxs, 1, obj_feat_dim) -\
+            obj_repr.view(-1, 1, num_bboxs, obj_feat_dim)
+    diff = obj_repr.unsqueeze(2) * diff
+    return diff.view(-1, num_bboxs, num_bboxs * obj_feat_dim)
+
+
+def reference_glimpse_logits(obj_repr, linear):
+    return linear(reference_diff(obj_repr))
+
+
+def reference_hard_diff(obj_repr, pi_hard):
+    num_bboxs = obj_repr.size(1)
+    obj_feat_dim = obj_repr.size(-1)
+    diff = reference_diff(obj_repr)
+    diff_hard = (diff * pi_hard.unsqueeze(-1)).sum(dim=1).reshape(-1, num_bboxs, obj_feat_dim)
+    return diff_hard.sum(dim=1)
+
+
+def measure(fn, args, device, n_iters):
+    with torch.no_grad():
+        fn(*args)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base_mem = torch.cuda.memory_allocated(device)
+        start = time.time()
+        for _ in range(n_iters):
+            out = fn(*args)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        latency = (time.time() - start) / n_iters
+        peak_mem = None
+        if device.type == 'cuda':
+            peak_mem = torch.cuda.max_memory_allocated(device) - base_mem
+    return out, latency, peak_mem
+
+
+def run(args):
+    device = torch.device('cuda' if args.gpu and torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(args.seed)
+    obj_repr = torch.rand(args.batch_size, args.num_bboxs, args.obj_feat_dim, device=device)
+    linear = nn.Linear(args.num_bboxs * args.obj_feat_dim, args.num_glimpses).to(device)
+    pi = torch.softmax(torch.randn(args.batch_size, args.num_bboxs, device=device), dim=-1)
+    pi_hard = nn.functional.one_hot(pi.argmax(dim=-1), args.num_bboxs).float()
+
+    print("[INFO] batch_size: {} | num_bboxs: {} | obj_feat_dim: {} | device: {}".format(
+        args.batch_size, args.num_bboxs, args.obj_feat_dim, device))
+    print("[INFO] Difference tensor: {:.1f} MB".format(
+        4 * args.batch_size * args.num_bboxs ** 2 * args.obj_feat_dim / 2 ** 20))
+    for name, ref_fn, fast_fn, inputs in [
+        ('glimpse', reference_glimpse_logits, osda_glimpse_logits, (obj_repr, linear)),
+        ('hard',    reference_hard_diff,      osda_hard_diff,      (obj_repr, pi_hard)),
+    ]:
+        ref_out, ref_lat, ref_mem = measure(ref_fn, inputs, device, args.n_iters)
+        fast_out, fast_lat, fast_mem = measure(fast_fn, inputs, device, args.n_iters)
+        max_err = (ref_out - fast_out).abs().max().item()
+        rel_err = max_err / ref_out.abs().max().clamp(min=1e-12).item()
+        msg = "[{}] max abs err - {:.3e} | max rel err - {:.3e} | latency {:.2f} ms -> {:.2f} ms ({:.1f}x)".format(
+            name, max_err, rel_err, 1e3 * ref_lat, 1e3 * fast_lat, ref_lat / fast_lat)
+        if ref_mem is not None:
+            msg += " | peak mem {:.1f} MB -> {:.1f} MB".format(ref_mem / 2 ** 20, fast_mem / 2 ** 20)
+        print(msg)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the closed-form OsDA against the materialised difference tensor.')
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--num-bboxs', default=101, type=int)
+    parser.add_argument('--obj-feat-dim', default=512, type=int)
+    parser.add_argument('--num-glimpses', default=2, type=int)
+    parser.add_argument('--n-iters', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--gpu', action='store_true',
+                        help='Run on GPU if available.')
+    args = parser.parse_args()
+    run(args)
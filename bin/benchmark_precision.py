@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Accuracy and throughput of the Oracle, Guesser and self-play test commands
+# for each `--precision` of main.py.
+import time
+import argparse
+
+from main import run as run_solver
+
+# (name, test command of main.py, config option of this script)
+TASKS = [
+    ('oracle', 'test-oracle-vilbert', 'oracle_config'),
+    ('guesser', 'test-guesser-vilbert', 'guesser_config'),
+    ('self-play', 'test-self-play-all-vilbert', 'self_play_config'),
+]
+
+
+def run_once(args, command, config, precision):
+    solver_args = argparse.Namespace(
+        command=command, config=config, name='%s-%s-%s' % (args.name, command, precision),
+        logdir='log/', result='ckpt/', load=None, seed=args.seed, n_jobs=args.n_jobs,
+        cpu=args.cpu, gpu=not args.cpu, pin_memory=False, no_msg=False, verbose=True,
+        precision=precision, compile=args.compile, local_rank=0, distributed=False)
+    start = time.time()
+    solver = run_solver(solver_args)
+    elapsed = time.time() - start
+    # The test set is evaluated first
+    return solver.eval_log[0], elapsed
+
+
+def run(args):
+    results = []
+    for name, command, config_option in TASKS:
+        config = getattr(args, config_option)
+        if config is None:
+            continue
+        for precision in args.precision:
+            if precision == 'fp16' and args.cpu:
+                print("[INFO] Skip fp16 {}, it needs a GPU".format(name))
+                continue
+            stats, elapsed = run_once(args, command, config, precision)
+            results.append((name, precision, stats, elapsed))
+
+    print("[INFO] {:<10} {:<6} {:>8} {:>9} {:>12} {:>10}".format(
+        'task', 'prec.', 'acc.', 'samples', 'samples/s', 'total (s)'))
+    for name, precision, stats, elapsed in results:
+        print("[INFO] {:<10} {:<6} {:>8.4f} {:>9d} {:>12.1f} {:>10.1f}".format(
+            name, precision, stats['acc'], stats['samples'], stats['samples_per_sec'], elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Accuracy and samples/s of the ViLBERT test commands for each precision.')
+    parser.add_argument('--oracle-config', default=None, type=str,
+                        help='Config of test-oracle-vilbert, skipped if not given.')
+    parser.add_argument('--guesser-config', default=None, type=str,
+                        help='Config of test-guesser-vilbert, skipped if not given.')
+    parser.add_argument('--self-play-config', default=None, type=str,
+                        help='Config of test-self-play-all-vilbert, skipped if not given.')
+    parser.add_argument('--precision', default=['fp32', 'bf16', 'fp16'], nargs='+',
+                        choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument('--name', default='precision-check', type=str,
+                        help='Prefix of the result files.')
+    parser.add_argument('--cpu', action='store_true', help='Disable GPU training.')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the ViLBERT trunks with torch.compile.')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--n-jobs', default=5, type=int)
+    args = parser.parse_args()
+    assert args.oracle_config or args.guesser_config or args.self_play_config, \
+        "Pass at least one of --oracle-config, --guesser-config and --self-play-config."
+    run(args)
@@ -0,0 +1,111 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Regression check for dynamic int8 self-play players: run the same self-play
+# evaluation on CPU with fp32 and int8 players and compare the results.
+import os
+import time
+import yaml
+import argparse
+import tempfile
+from collections import defaultdict
+
+from main import run as run_solver
+
+
+def load_results(path):
+    '''
+    Parse the `game_id|pred_obj|answer_obj|turn_id|question|answer|answer_confidence`
+    file written by the self-play solvers.
+    '''
+    games = dict()
+    answers = defaultdict(dict)
+    with open(path, 'r') as f:
+        next(f)
+        for line in f:
+            fields = line.rstrip('\n').split('|')
+            game_id, pred_obj, answer_obj, turn_id, question = fields[:5]
+            games[game_id] = (pred_obj, answer_obj)
+            if len(fields) > 5 and fields[5]:
+                answers[game_id][int(turn_id)] = (question, fields[5])
+    return games, answers
+
+
+def model_size(model):
+    ''' Bytes held by the weights of `model`, including packed int8 weights. '''
+    def _nbytes(v):
+        if isinstance(v, (tuple, list)):
+            return sum(_nbytes(x) for x in v)
+        if hasattr(v, 'element_size'):
+            return v.numel() * v.element_size()
+        return 0
+    return sum(_nbytes(v) for v in model.state_dict().values())
+
+
+def run_once(args, config, quantize):
+    tag = 'int8' if quantize else 'fp32'
+    config = yaml.safe_load(yaml.safe_dump(config))
+    for plyr in args.players:
+        if plyr in config['model']:
+            config['model'][plyr]['quantize'] = quantize
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as f:
+        yaml.safe_dump(config, f)
+        config_path = f.name
+    solver_args = argparse.Namespace(
+        command=args.command, config=config_path, name='%s-%s' % (args.name, tag),
+        logdir='log/', result='ckpt/', load=None, seed=args.seed, n_jobs=args.n_jobs,
+        cpu=True, gpu=False, pin_memory=False, no_msg=False, verbose=True,
+        precision='fp32', compile=False, local_rank=0, distributed=False)
+    start = time.time()
+    solver = run_solver(solver_args)
+    elapsed = time.time() - start
+    os.remove(config_path)
+    out_name = solver.exp_name + ('_gt' if solver.use_gt_question else '') + '.txt'
+    return out_name, elapsed, model_size(solver.model)
+
+
+def run(args):
+    config = yaml.safe_load(open(args.config, 'r'))
+    out_fp32, time_fp32, size_fp32 = run_once(args, config, quantize=False)
+    out_int8, time_int8, size_int8 = run_once(args, config, quantize=True)
+    games_fp32, answers_fp32 = load_results(out_fp32)
+    games_int8, answers_int8 = load_results(out_int8)
+
+    common = [g for g in games_fp32 if g in games_int8]
+    acc_fp32 = sum(games_fp32[g][0] == games_fp32[g][1] for g in common) / float(len(common))
+    acc_int8 = sum(games_int8[g][0] == games_int8[g][1] for g in common) / float(len(common))
+    same_guess = sum(games_fp32[g][0] == games_int8[g][0] for g in common) / float(len(common))
+    # Oracle answers can only be compared where both runs asked the same question
+    same_q, same_a = 0, 0
+    for g in common:
+        for t, (q, a) in answers_fp32[g].items():
+            if t in answers_int8[g] and answers_int8[g][t][0] == q:
+                same_q += 1
+                same_a += answers_int8[g][t][1] == a
+
+    print("[INFO] Games compared: {}".format(len(common)))
+    print("[INFO] Success rate - fp32 {:.4f} | int8 {:.4f} | delta {:+.4f}".format(
+        acc_fp32, acc_int8, acc_int8 - acc_fp32))
+    print("[INFO] Guess agreement - {:.4f}".format(same_guess))
+    print("[INFO] Oracle answer agreement - {:.4f} ({} shared questions)".format(
+        same_a / float(max(same_q, 1)), same_q))
+    print("[INFO] Wall time - fp32 {:.1f}s | int8 {:.1f}s | speedup {:.2f}x".format(
+        time_fp32, time_int8, time_fp32 / time_int8))
+    print("[INFO] Weights - fp32 {:.1f} MB | int8 {:.1f} MB".format(
+        size_fp32 / 2 ** 20, size_int8 / 2 ** 20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare fp32 and dynamic int8 self-play players on CPU.')
+    parser.add_argument('--command', default='test-self-play-all-vilbert', type=str,
+                        help='A self-play test command of main.py.')
+    parser.add_argument('--config', required=True, type=str,
+                        help='Path to yaml config file.')
+    parser.add_argument('--name', default='quantize-check', type=str,
+                        help='Prefix of the result files.')
+    parser.add_argument('--players', default=['qgen', 'oracle', 'guesser'], nargs='+',
+                        help='Players to quantize.')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--n-jobs', default=5, type=int)
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,32 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Export the model weights of training checkpoints for evaluation: no optimizer
+# state, no `module.` prefixes, optionally in 16 bits. Self-play memory-maps them.
+import os
+import time
+import argparse
+
+from src.tools.checkpoint import DTYPES, export_weights
+
+
+def run(args):
+    assert len(args.ckpt) == len(args.out), "Give one --out per --ckpt."
+    for ckpt_path, out_path in zip(args.ckpt, args.out):
+        start = time.time()
+        n_tensors = export_weights(ckpt_path, out_path, dtype=args.dtype)
+        print("[INFO] {} ({:.1f} MB) -> {} ({:.1f} MB, {} tensors, {}) in {:.1f}s".format(
+            ckpt_path, os.path.getsize(ckpt_path) / 2 ** 20, out_path, os.path.getsize(out_path) / 2 ** 20,
+            n_tensors, args.dtype, time.time() - start))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export inference-only player weights from training checkpoints.')
+    parser.add_argument('--ckpt', required=True, type=str, nargs='+',
+                        help='Training checkpoints, e.g. ckpt/guesser_vilbert-sd0/best.pth.')
+    parser.add_argument('--out', required=True, type=str, nargs='+',
+                        help='Output weight files, one per checkpoint.')
+    parser.add_argument('--dtype', default='fp32', type=str, choices=list(DTYPES),
+                        help='Type of floating point weights in the files.')
+    args = parser.parse_args()
+    run(args)
@@ -0,0 +1,63 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+# Run a self-play evaluation command of main.py in N local CPU processes, each
+# playing its share of the test games. Rank 0 merges the result files and
+# reports the accuracy over all games.
+import os
+import time
+import argparse
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from main import run as run_solver
+
+
+def worker(rank, args):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(args.port)
+    # Split the cores between the processes instead of oversubscribing them
+    torch.set_num_threads(args.threads_per_proc)
+    if args.n_procs > 1:
+        dist.init_process_group(backend='gloo', init_method='env://', rank=rank, world_size=args.n_procs)
+    solver_args = argparse.Namespace(
+        command=args.command, config=args.config, name=args.name, logdir='log/', result='ckpt/',
+        load=args.load, seed=args.seed, n_jobs=args.n_jobs, cpu=True, gpu=False, pin_memory=False,
+        no_msg=rank != 0, verbose=rank == 0, precision=args.precision, compile=False,
+        local_rank=rank, distributed=args.n_procs > 1)
+    start = time.time()
+    run_solver(solver_args)
+    if rank == 0:
+        print("[INFO] {} processes x {} threads - {:.1f}s".format(
+            args.n_procs, args.threads_per_proc, time.time() - start))
+    if args.n_procs > 1:
+        dist.destroy_process_group()
+
+
+def run(args):
+    if args.threads_per_proc is None:
+        args.threads_per_proc = max(1, (os.cpu_count() or 1) // args.n_procs)
+    mp.spawn(worker, args=(args,), nprocs=args.n_procs, join=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Shard a self-play evaluation over local CPU processes.')
+    parser.add_argument('--command', default='test-self-play-all-vilbert', type=str,
+                        help='test-self-play-all-vilbert or rescore-self-play-all-vilbert.')
+    parser.add_argument('--config', required=True, type=str,
+                        help='Path to yaml config file.')
+    parser.add_argument('--name', default=None, type=str,
+                        help='Name of the result files.')
+    parser.add_argument('--load', default=None, type=str)
+    parser.add_argument('--n-procs', default=4, type=int)
+    parser.add_argument('--threads-per-proc', default=None, type=int,
+                        help='Default: cores / n-procs.')
+    parser.add_argument('--n-jobs', default=1, type=int,
+                        help='Dataloader workers per process.')
+    parser.add_argument('--precision', default='fp32', type=str,
+                        choices=['fp32', 'bf16'])
+    parser.add_argument('--port', default=29511, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    run(args)
@@ -30,7 +30,8 @@ VALID_COMMAND = [
     'test-self-play-qgen-vdst-oracle-vilbert',
     'test-self-play-qgen-vdst-guesser-vilbert',
     'test-self-play-qgen-vdst-oracle-vilbert-guesser-vilbert',
-    'test-self-play-all-vilbert'
+    'test-self-play-all-vilbert',
+    'rescore-self-play-all-vilbert'
 ]
 
 
@@ -128,6 +129,10 @@ def run(args):
         kwargs = dict()
         mode = 'test'
         from solver.self_play_all_vilbert import SelfPlaySolver as Solver
+    elif command == 'rescore-self-play-all-vilbert':
+        kwargs = dict()
+        mode = 'test'
+        from solver.self_play_all_vilbert import RescoreSolver as Solver
     else:
         raise NotImplementedError
 
@@ -135,7 +140,11 @@ def run(args):
     solver.load_data()
     solver.set_model()
     solver.exec()
-    
+    if mode == 'train':
+        # Raises if the last background checkpoint write failed
+        solver.ckpt_writer.wait()
+    return solver
+
 
 
 if __name__ == '__main__':
@@ -163,6 +172,13 @@ if __name__ == '__main__':
                         help='Disable pin-memory for torch `Dataloader`.')
     parser.add_argument('--no-msg', action='store_true',
                         help='Hide all messages.')
+    parser.add_argument('--precision', default='fp32', type=str,
+                        choices=['fp32', 'bf16', 'fp16'],
+                        help='Numerical precision for forwards (autocast) and backwards.')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the ViLBERT trunks with torch.compile on bucketed input shapes.')
+    parser.add_argument('--dist-backend', default=None, type=str, choices=['gloo', 'nccl'],
+                        help='Distributed backend, default: nccl on GPU, gloo on CPU.')
     parser.add_argument("--local_rank", type=int, default=0, 
                         help="local_rank for distributed training on GPUs")
 
@@ -174,13 +190,20 @@ if __name__ == '__main__':
     args.distributed = False
     if 'WORLD_SIZE' in os.environ:
         args.distributed = int(os.environ['WORLD_SIZE']) > 1
+    if 'LOCAL_RANK' in os.environ:
+        # torchrun passes the local rank through the environment only
+        args.local_rank = int(os.environ['LOCAL_RANK'])
     if args.distributed:
+        use_cuda = args.gpu and torch.cuda.is_available()
         # FOR DISTRIBUTED:  Set the device according to local_rank.
-        torch.cuda.set_device(args.local_rank)
+        if use_cuda:
+            torch.cuda.set_device(args.local_rank)
 
         # FOR DISTRIBUTED:  Initialize the backend.  torch.distributed.launch will provide
         # environment variables, and requires that you use init_method=`env://`.
-        torch.distributed.init_process_group(backend='nccl',
+        # gloo for CPU processes (e.g. CPU-only training nodes, sharded self-play evaluation)
+        backend = args.dist_backend or ('nccl' if use_cuda else 'gloo')
+        torch.distributed.init_process_group(backend=backend,
                                              init_method='env://'
                                              )
     
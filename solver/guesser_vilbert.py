@@ -1,15 +1,20 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: CC-BY-NC-4.0
 import os
+import time
 import torch
 import torch.nn as nn
 from functools import partial
 from solver.solver import BaseSolver
 from solver.utils import human_format
-from torch.utils.data import DataLoader
+from solver.metrics import hits, Metrics
+from torch.utils.data import DataLoader, Subset
 from src.model.guesser_vilbert import GuesserModel
 from src.tools.optimizer import Optimizer
+from src.tools.compile import TXT_BUCKETS, BBOX_BUCKETS, pad_to_bucket
 from src.tools.tokenizer import GW_Tokenizer, BERT_Tokenizer
+from src.tools.distributed import get_world_size, shard_indices, all_reduce_sum, gather_shards, ResumableSampler
+from src.tools.checkpoint import strip_module_prefix
 from src.data.image_features_reader import numpyReader as image_features_reader
 from src.data.guesser_vilbert import GuesserDataset, collate_fn
 
@@ -24,19 +29,32 @@ class GuesserSolver(BaseSolver):
         # Prepare self.train_set, self.valid_set, self.test_set
         dataroot = self.config['data']['dataroot']
         batch_size = self.config['data']['batch_size']
+        num_workers = self.args.n_jobs
+        if self.distributed:
+            # `batch_size` and `n_jobs` are split over the ranks
+            batch_size = max(1, batch_size // get_world_size())
+            num_workers = num_workers // get_world_size()
         for split in splits:
             dataset = GuesserDataset(
                 dataroot, split, image_features_reader[split], tokenizer, padding_index=tokenizer.pad_id)
+            sampler = None
+            if split == 'train':
+                # Sharded over the ranks when distributed, and resumable mid-epoch
+                sampler = ResumableSampler(dataset, seed=self.args.seed)
+                setattr(self, split+'_sampler', sampler)
+            elif self.distributed:
+                # Each rank evaluates its own shard, metrics are summed in validate
+                dataset = Subset(dataset, shard_indices(len(dataset)))
             setattr(
                 self,
                 split+'_set',
                 DataLoader(
                     dataset,
                     batch_size=batch_size if split == 'train' else 4*batch_size,
-                    shuffle=(split=='train'),
+                    sampler=sampler,
                     drop_last=False,
                     collate_fn=partial(collate_fn, wrd_pad_id=tokenizer.pad_id),
-                    num_workers=self.args.n_jobs,
+                    num_workers=num_workers,
                     pin_memory=self.args.pin_memory)
             )
 
@@ -63,6 +81,18 @@ class GuesserSolver(BaseSolver):
 
     def fetch_data(self, data):
         game, qs, qs_len, answers, end_turn, cats, img_feats, bboxs, bboxs_mask, bboxs_mask_vb, txt_attn_mask, label = data
+        # Regions of the batch, the initial Guesser state is uniform over these only
+        num_bboxs = img_feats.size(1)
+        if self.args.compile:
+            # Bucketed question lengths and region counts keep the number of compiled graphs
+            # small, padded regions are masked out of the guess logits and start with a zero state
+            qs = pad_to_bucket(qs, -1, TXT_BUCKETS, self.tokenizer.pad_id)
+            txt_attn_mask = pad_to_bucket(txt_attn_mask, -1, TXT_BUCKETS, 0)
+            cats = pad_to_bucket(cats, 1, BBOX_BUCKETS, 0)
+            img_feats = pad_to_bucket(img_feats, 1, BBOX_BUCKETS, 0)
+            bboxs = pad_to_bucket(bboxs, 1, BBOX_BUCKETS, 0)
+            bboxs_mask = pad_to_bucket(bboxs_mask, 1, BBOX_BUCKETS, False)
+            bboxs_mask_vb = pad_to_bucket(bboxs_mask_vb, 1, BBOX_BUCKETS, 0)
         return (
             game,
             qs.to(self.device), 
@@ -75,7 +105,8 @@ class GuesserSolver(BaseSolver):
             bboxs_mask.to(self.device), 
             bboxs_mask_vb.to(self.device), 
             txt_attn_mask.to(self.device), 
-            label.to(self.device)
+            label.to(self.device),
+            num_bboxs,
         )
 
 
@@ -99,12 +130,29 @@ class GuesserSolver(BaseSolver):
 
         if self.args.load:
             ckpt = torch.load(self.args.load, map_location=self.device)
-            self.model.load_state_dict(ckpt['model'])
+            # Saved with or without the DistributedDataParallel wrapper
+            getattr(self.model, 'module', self.model).load_state_dict(strip_module_prefix(ckpt['model']))
             self.optimizer.load_opt_state_dict(ckpt['optimizer'])
             self.step = ckpt['global_step']
+            if self.mode == 'train':
+                self.load_train_state(ckpt)
             self.verbose('Load ckpt from {}, restarting at step {}'.format(
                 self.args.load, self.step))
 
+        # Gradients are averaged over the ranks through the wrapper, while
+        # self.model (and so best.pth) keeps the keys self-play loads
+        self.train_model = self.model
+        if self.distributed:
+            self.train_model = self.data_parallel(self.model)
+
+        if self.args.compile:
+            # Other region buckets are compiled when first seen
+            num_bboxs = self.fetch_data(next(iter(self.valid_set)))[6].size(1)
+            warmup_shapes = [(self.model, False, self.valid_set.batch_size, num_bboxs, True)]
+            if self.mode == 'train':
+                warmup_shapes.append((self.model, True, self.train_set.batch_size, num_bboxs, True))
+            self.compile_model(warmup_shapes)
+
     def exec(self):
         # [TODO]: finish testing code
         if self.mode == 'train':
@@ -122,88 +170,102 @@ class GuesserSolver(BaseSolver):
             human_format(self.steps_per_epoch))])
         while self.step < self.max_step:
             # Validate every epoch
-            self.validate(self.valid_set)
-            self.timer.set()
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set)
+            self.begin_epoch()
+            self.telemetry.start()
             for data in self.train_set:
-                _, qs, qs_len, answers, end_turn, cats, img_feats, bboxs, bboxs_mask, bboxs_mask_vb, txt_attn_mask, label = self.fetch_data(data)
+                self.telemetry.lap('data')
+                _, qs, qs_len, answers, end_turn, cats, img_feats, bboxs, bboxs_mask, bboxs_mask_vb, txt_attn_mask, label, num_bboxs = self.fetch_data(data)
 
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
-                pred = self.model.forward_session(
-                    qs, answers, end_turn, cats, img_feats, bboxs, 
-                    bboxs_mask=bboxs_mask, 
-                    attention_mask=txt_attn_mask,
-                    image_attention_mask=bboxs_mask_vb,
-                    # update_vilbert=False,
-                    )
-                loss = self.loss(pred, label)
-                acc = (pred.argmax(dim=-1) == label).sum().item() / float(len(label))
-                self.timer.cnt('fw')
+                with self.autocast():
+                    pred = self.train_model(
+                        qs, answers, end_turn, cats, img_feats, bboxs, 
+                        bboxs_mask=bboxs_mask, 
+                        attention_mask=txt_attn_mask,
+                        image_attention_mask=bboxs_mask_vb,
+                        num_valid_bboxs=num_bboxs,
+                        # update_vilbert=False,
+                        )
+                    loss = self.loss(pred, label)
+                    self.train_metrics.update(loss=loss, hit=hits(pred, label), cnt=len(label))
+                self.telemetry.lap('forward')
                 # Backward
-                grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                grad_norm = self.backward(loss, self.train_model)
+                self.telemetry.step(len(label), txt_attn_mask.sum())
 
                 self.step += 1
+                self.save_last()
                 # Log
                 if (self.step == 1) or (self.step % self._progress_step == 0):
+                    stats, n_steps = self.train_metrics.read()
                     self.progress("Tr stat. | Loss - {:.4f} | Acc. - {:.3f} | Grad. norm - {:.2f} | {}".format(
-                        loss.item(), acc, grad_norm, self.timer.show()))
+                        stats['loss'] / n_steps, stats['hit'] / stats['cnt'], grad_norm, self.telemetry.report(self.step)))
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     break
 
 
     def validate(self, specified_set, write_log=False):
+        start_time = time.time()
         self.model.eval()
-        total_loss = 0
-        total_hit = 0
-        cnt = 0
-        if write_log:
-            out_file = open('{}_stat_his.txt'.format(self.exp_name), 'w')
+        metrics = Metrics(self.device)
+        log_lines = []
         for val_step, data in enumerate(specified_set):
-            game, qs, qs_len, answers, end_turn, cats, img_feats, bboxs, bboxs_mask, bboxs_mask_vb, txt_attn_mask, label = self.fetch_data(data)
-            with torch.no_grad():
+            game, qs, qs_len, answers, end_turn, cats, img_feats, bboxs, bboxs_mask, bboxs_mask_vb, txt_attn_mask, label, num_bboxs = self.fetch_data(data)
+            with torch.no_grad(), self.autocast():
                 pred = self.model.forward_session(
                     qs, answers, end_turn, cats, img_feats, bboxs, 
                     bboxs_mask=bboxs_mask, 
                     attention_mask=txt_attn_mask,
                     image_attention_mask=bboxs_mask_vb,
-                    return_state_history=self.mode=='test'
+                    return_state_history=self.mode=='test',
+                    num_valid_bboxs=num_bboxs,
                     )
                 if self.mode == 'test':
                     pred, stat_his = pred
 
-                loss = self.loss(pred, label).item()
-                hit = (pred.argmax(dim=-1) == label).sum().item()
-                total_hit += hit
-                total_loss += loss
-                cnt += len(label)
+                metrics.update(loss=self.loss(pred, label), hit=hits(pred, label), cnt=len(label))
                 if (val_step == 0) or ((val_step+1) % self._progress_step == 0):
+                    stats, _ = metrics.read(reset=False)
+                    total_loss, total_hit, cnt = stats['loss'], stats['hit'], stats['cnt']
                     self.progress("Dev stat. ({}/{}) | Loss - {:.4f} | Acc. - {:.4f}".format(
                         val_step, len(specified_set), total_loss/float(cnt), total_hit/float(cnt)))
 
                 if self.mode == 'test':
                     if write_log:
                         for g, l, p, stat_h in zip(game, label, pred.argmax(dim=-1), stat_his):
-                            out_file.write("{}|{}|{}|{}\n".format(g.id, l, p,stat_h.tolist()))
+                            log_lines.append("{}|{}|{}|{}\n".format(g.id, l, p,stat_h.tolist()))
 
 
+        # Sum over the validation shards of all ranks
+        stats, n_steps = metrics.read()
+        total_hit, cnt, total_loss, n_batches = all_reduce_sum(
+            [stats['hit'], stats['cnt'], stats['loss'], n_steps], self.device)
         score = total_hit / float(cnt)
-        loss = total_loss / float(len(specified_set))
+        loss = total_loss / float(n_batches)
+        self.record_eval(score, cnt, start_time)
         if score > self.best_score and self.mode == 'train':
-            self.save_checkpoint('best.pth', score)
+            if self.main_proc:
+                self.save_checkpoint('best.pth', score)
             self.best_score = score
 
         self.verbose(["Val stat. @ step {} | Loss - {:.4f} | Acc. - {:.4f}"
                       .format(self.step, loss, score)])
+        self.log_compile_stats()
 
         self.model.train()
         if write_log:
-            out_file.close()
+            log_lines = gather_shards(log_lines)
+            if self.main_proc:
+                with open('{}_stat_his.txt'.format(self.exp_name), 'w') as out_file:
+                    out_file.writelines(log_lines)
 
     def write_log(self):
         pass
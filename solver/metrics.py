@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import torch
+
+
+def hits(pred, label, pad_id=None):
+    '''
+    Number of argmax predictions equal to `label`, as a device tensor
+        <int> pad_id - positions where `label` is `pad_id` are not counted
+    '''
+    correct = pred.argmax(dim=-1) == label
+    if pad_id is not None:
+        correct = correct & (label != pad_id)
+    return correct.sum()
+
+
+def num_tokens(label, pad_id):
+    ''' Number of non-pad positions of `label`, as a device tensor '''
+    return (label != pad_id).sum()
+
+
+class Metrics(object):
+    '''
+    Sums of per-step values (losses, hits, counts, ...) kept as device tensors, so
+    steps do not wait for the device; `read` syncs once for all of them, e.g. at
+    the logging interval.
+        <torch.device> device - device of the summed tensors
+    '''
+    def __init__(self, device):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.sums = dict()
+        # Python numbers (e.g. batch sizes) are summed on the host, copying them
+        # to the device could wait for it too
+        self.host_sums = dict()
+        self.steps = 0
+
+    def update(self, **values):
+        ''' Add the values (tensors or numbers) of one step to the sums of their names '''
+        for name, v in values.items():
+            if torch.is_tensor(v):
+                v = v.detach().to(self.device, torch.float64).sum()
+                self.sums[name] = self.sums[name] + v if name in self.sums else v
+            else:
+                self.host_sums[name] = self.host_sums.get(name, 0) + v
+        self.steps += 1
+
+    def read(self, reset=True):
+        '''
+        return: dict of summed values as floats, number of steps
+        '''
+        names = list(self.sums)
+        values = torch.stack([self.sums[n] for n in names]).tolist() if names else []
+        sums, steps = dict(zip(names, values)), self.steps
+        sums.update((n, float(v)) for n, v in self.host_sums.items())
+        if reset:
+            self.reset()
+        return sums, steps
@@ -6,6 +6,7 @@ import torch.nn as nn
 from functools import partial
 from solver.solver import BaseSolver
 from solver.utils import human_format
+from solver.metrics import hits
 from torch.utils.data import DataLoader
 from src.model.oracle_rcnn import OracleModel
 from src.tools.optimizer import Optimizer
@@ -117,30 +118,34 @@ class OracleSolver(BaseSolver):
             human_format(self.steps_per_epoch))])
         while self.step < self.max_step:
             # Validate every epoch
-            self.validate(self.valid_set)
-            self.timer.set()
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set)
+            self.telemetry.start()
             for data in self.train_set:
+                self.telemetry.lap('data')
                 game, tgt_cat, tgt_bbox, tgt_img_feat, q_tokens, q_len, answer = self.fetch_data(data)
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
-                pred = self.model(q_tokens, tgt_cat, tgt_bbox, tgt_img_feat, q_len)
-                #loss = self.loss(pred, answer) / float(len(answer))
-                loss = self.loss(pred, answer)
-                acc = (pred.argmax(dim=-1) == answer).sum().item() / float(len(answer))
-                self.timer.cnt('fw')
+                with self.autocast():
+                    pred = self.model(q_tokens, tgt_cat, tgt_bbox, tgt_img_feat, q_len)
+                    #loss = self.loss(pred, answer) / float(len(answer))
+                    loss = self.loss(pred, answer)
+                    self.train_metrics.update(loss=loss, hit=hits(pred, answer), cnt=len(answer))
+                self.telemetry.lap('forward')
                 # Backward
                 grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                self.telemetry.step(len(answer), q_len.sum())
 
                 self.step += 1
                 # Log
                 if (self.step == 1) or (self.step % self._progress_step == 0):
+                    stats, n_steps = self.train_metrics.read()
                     self.progress("Tr stat. | Loss - {:.4f} | Acc. - {:.3f} | Grad. norm - {:.2f} | {}".format(
-                        loss.item(), acc, grad_norm, self.timer.show()))
+                        stats['loss'] / n_steps, stats['hit'] / stats['cnt'], grad_norm, self.telemetry.report(self.step)))
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     break
@@ -156,7 +161,7 @@ class OracleSolver(BaseSolver):
             log = "game_id|question|answer|pred_answer|pred_confidence\n"
         for val_step, data in enumerate(specified_set):
             game, tgt_cat, tgt_bbox, tgt_img_feat, q_tokens, q_len, answer = self.fetch_data(data)
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 pred = self.model(q_tokens, tgt_cat, tgt_bbox, tgt_img_feat, q_len)
                 loss = self.loss(pred, answer).item()
                 hit = (pred.argmax(dim=-1) == answer).sum().item()
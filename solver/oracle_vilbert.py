@@ -1,23 +1,26 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: CC-BY-NC-4.0
 import os
+import time
 import torch
 import torch.nn as nn
 from functools import partial
 from solver.solver import BaseSolver
 from solver.utils import human_format
-from torch.utils.data import DataLoader
+from solver.metrics import hits, Metrics
+from torch.utils.data import DataLoader, Subset
 from src.model.oracle_vilbert import OracleModel
 from src.data.oracle_vilbert import OracleDataset, collate_fn
 from src.tools.optimizer import Optimizer
+from src.tools.compile import TXT_BUCKETS, pad_to_bucket
 from src.tools.tokenizer import GW_Tokenizer, BERT_Tokenizer
+from src.tools.distributed import get_world_size, shard_indices, all_reduce_sum, gather_shards, ResumableSampler
+from src.tools.checkpoint import strip_module_prefix
 from src.data.image_features_reader import (
     numpyReader as image_features_reader_gt,
     h5FeatureReaderVilbert as image_features_reader,
 )
 
-from apex.parallel import DistributedDataParallel
-
 
 
 class OracleSolver(BaseSolver):
@@ -30,6 +33,11 @@ class OracleSolver(BaseSolver):
         # Prepare self.train_set, self.valid_set, self.test_set
         dataroot = self.config['data']['dataroot']
         batch_size = self.config['data']['batch_size']
+        num_workers = self.args.n_jobs
+        if self.distributed:
+            # `batch_size` and `n_jobs` are split over the ranks
+            batch_size = max(1, batch_size // get_world_size())
+            num_workers = num_workers // get_world_size()
         # splits = ['train', 'valid'] if self.mode == 'train' else ['test', 'valid']
         for split in splits:
             dataset = OracleDataset(
@@ -39,16 +47,24 @@ class OracleSolver(BaseSolver):
                 tokenizer, 
                 img_feat_readers_gt[split],
                 padding_index=tokenizer.pad_id)
+            sampler = None
+            if split == 'train':
+                # Sharded over the ranks when distributed, and resumable mid-epoch
+                sampler = ResumableSampler(dataset, seed=self.args.seed)
+                setattr(self, split+'_sampler', sampler)
+            elif self.distributed:
+                # Each rank evaluates its own shard, metrics are summed in validate
+                dataset = Subset(dataset, shard_indices(len(dataset)))
             setattr(
                 self,
                 split+'_set',
                 DataLoader(
                     dataset,
                     batch_size=batch_size if split == 'train' else 4*batch_size,
-                    shuffle=(split=='train'),
+                    sampler=sampler,
                     drop_last=False,
                     collate_fn=partial(collate_fn, wrd_pad_id=tokenizer.pad_id),
-                    num_workers=self.args.n_jobs,
+                    num_workers=num_workers,
                     pin_memory=self.args.pin_memory)
             )
 
@@ -84,6 +100,10 @@ class OracleSolver(BaseSolver):
 
     def fetch_data(self, data):
         game, tgt_cat, tgt_bbox, tgt_img_feat, bg_bboxs, bg_img_feats, q_tokens, q_len, txt_attn_mask, answer = data
+        if self.args.compile:
+            # Bucketed question lengths keep the number of compiled graphs small
+            q_tokens = pad_to_bucket(q_tokens, -1, TXT_BUCKETS, self.tokenizer.pad_id)
+            txt_attn_mask = pad_to_bucket(txt_attn_mask, -1, TXT_BUCKETS, 0)
         return (
             game, 
             tgt_cat.to(self.device), 
@@ -111,9 +131,7 @@ class OracleSolver(BaseSolver):
 
         self.model = self.model.to(self.device)
         if self.args.distributed:
-            # FOR DISTRIBUTED:  After amp.initialize, wrap the model with
-            # apex.parallel.DistributedDataParallel.
-            self.model = DistributedDataParallel(self.model)
+            self.model = self.data_parallel(self.model)
         self.optimizer = Optimizer(
             self.model.parameters(), **self.config['hparas'])
         # self.loss = nn.CrossEntropyLoss(reduction='sum')
@@ -121,32 +139,36 @@ class OracleSolver(BaseSolver):
 
         if self.args.load:
             ckpt = torch.load(self.args.load, map_location=self.device)
-            from collections import OrderedDict
-            new_state_dict = OrderedDict()
-            for k, v in ckpt['model'].items():
-                name = k[7:]  # remove `module.`
-                new_state_dict[name] = v
-            self.model.load_state_dict(new_state_dict)
-
-            #self.model.load_state_dict(ckpt['model'])
+            # Saved with or without the DistributedDataParallel wrapper
+            getattr(self.model, 'module', self.model).load_state_dict(strip_module_prefix(ckpt['model']))
             self.optimizer.load_opt_state_dict(ckpt['optimizer'])
             self.step = ckpt['global_step']
+            if self.mode == 'train':
+                self.load_train_state(ckpt)
             self.verbose('Load ckpt from {}, restarting at step {}'.format(
                 self.args.load, self.step))
 
+        if self.args.compile:
+            # Background regions + target region
+            num_bboxs = self.fetch_data(next(iter(self.valid_set)))[4].size(1) + 1
+            warmup_shapes = [(self.model, False, self.valid_set.batch_size, num_bboxs, False)]
+            if self.mode == 'train':
+                warmup_shapes.append((self.model, True, self.train_set.batch_size, num_bboxs, False))
+            self.compile_model(warmup_shapes)
+
     def exec(self):
         # [TODO]: finish testing code
         if self.mode == 'train':
             self.train()
         else:
             self.verbose(["Evaluate on test set..."])
-            write_log = True if self.args.local_rank == 0 else False
-            log_test = self.validate(self.test_set, write_log=write_log)
+            log_test = self.validate(self.test_set, write_log=True)
             self.verbose(["Evaluate on valid set..."])
             self.validate(self.valid_set)
 
-            with open('%s.txt' % self.exp_name, 'w') as f:
-                f.write(log_test)
+            if self.main_proc:
+                with open('%s.txt' % self.exp_name, 'w') as f:
+                    f.write(log_test)
 
     def train(self):
         self.verbose(['Total training epoch/steps: {}/{}'.format(
@@ -155,54 +177,57 @@ class OracleSolver(BaseSolver):
             human_format(self.steps_per_epoch))])
         while self.step < self.max_step:
             # Validate every epoch
-            self.validate(self.valid_set, epoch=int(self.step/self.steps_per_epoch))
-            self.timer.set()
+            epoch = self.begin_epoch()
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set, epoch=epoch)
+            self.telemetry.start()
             for data in self.train_set:
+                self.telemetry.lap('data')
                 game, tgt_cat, tgt_bbox, tgt_img_feat, bg_bboxs, bg_img_feats, q_tokens, q_len, txt_attn_mask, answer = self.fetch_data(data)
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
-                pred = self.model(
-                    q_tokens, 
-                    tgt_cat, 
-                    tgt_bbox, 
-                    tgt_img_feat, 
-                    bg_bboxs, 
-                    bg_img_feats, 
-                    update_vilbert=True, 
-                    attention_mask=txt_attn_mask,
-                )
-                loss = self.loss(pred, answer)
-                acc = (pred.argmax(dim=-1) == answer).sum().item() / float(len(answer))
-                self.timer.cnt('fw')
+                with self.autocast():
+                    pred = self.model(
+                        q_tokens, 
+                        tgt_cat, 
+                        tgt_bbox, 
+                        tgt_img_feat, 
+                        bg_bboxs, 
+                        bg_img_feats, 
+                        update_vilbert=True, 
+                        attention_mask=txt_attn_mask,
+                    )
+                    loss = self.loss(pred, answer)
+                    self.train_metrics.update(loss=loss, hit=hits(pred, answer), cnt=len(answer))
+                self.telemetry.lap('forward')
                 # Backward
                 grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                self.telemetry.step(len(answer), txt_attn_mask.sum())
 
                 self.step += 1
+                self.save_last()
                 # Log
                 if (self.step == 1) or (self.step % self._progress_step == 0):
+                    stats, n_steps = self.train_metrics.read()
                     self.progress("Tr stat. | Loss - {:.4f} | Acc. - {:.3f} | Grad. norm - {:.2f} | {}".format(
-                        loss.item(), acc, grad_norm, self.timer.show()))
+                        stats['loss'] / n_steps, stats['hit'] / stats['cnt'], grad_norm, self.telemetry.report(self.step)))
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     break
 
 
     def validate(self, specified_set, write_log=False, epoch=0):
+        start_time = time.time()
         self.model.eval()
-        total_loss = 0
-        total_hit = 0
-        cnt = 0
-        log = None
-        if write_log:
-            log = "game_id|question|answer|pred_answer|pred_confidence\n"
+        metrics = Metrics(self.device)
+        log_lines = []
         for val_step, data in enumerate(specified_set):
             game, tgt_cat, tgt_bbox, tgt_img_feat, bg_bboxs, bg_img_feats, q_tokens, q_len, txt_attn_mask, answer = self.fetch_data(data)
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 pred = self.model(
                     q_tokens, 
                     tgt_cat, 
@@ -213,12 +238,10 @@ class OracleSolver(BaseSolver):
                     update_vilbert=True, 
                     attention_mask=txt_attn_mask,
                 )
-                loss = self.loss(pred, answer).item()
-                hit = (pred.argmax(dim=-1) == answer).sum().item()
-                total_hit += hit
-                total_loss += loss
-                cnt += len(answer)
+                metrics.update(loss=self.loss(pred, answer), hit=hits(pred, answer), cnt=len(answer))
                 if (val_step == 0) or ((val_step+1) % self._progress_step == 0):
+                    stats, _ = metrics.read(reset=False)
+                    total_loss, total_hit, cnt = stats['loss'], stats['hit'], stats['cnt']
                     self.progress("({}/{}) Dev stat. | Loss - {:.4f} | Acc. - {:.4f}".format(
                         val_step, len(specified_set), total_loss/float(cnt), total_hit/float(cnt)))
 
@@ -229,29 +252,40 @@ class OracleSolver(BaseSolver):
                         pred_ans = ans_idx2str(pred_idx)
                         pred_conf = nn.functional.softmax(pred[b], dim=-1)[pred_idx].item()
                         ans = ans_idx2str(answer[b].item())
-                        log += "{}|{}|{}|{}|{:.3f}\n".format(
+                        log_lines.append("{}|{}|{}|{}|{:.3f}\n".format(
                                 game[b].id,
                                 self.tokenizer.decode(q_tokens[b].tolist(), ignore_pad=True),
                                 ans,
                                 pred_ans,
                                 pred_conf
-                            )
+                            ))
 
+        # Sum over the validation shards of all ranks
+        stats, n_steps = metrics.read()
+        total_hit, cnt, total_loss, n_batches = all_reduce_sum(
+            [stats['hit'], stats['cnt'], stats['loss'], n_steps], self.device)
         score = total_hit / float(cnt)
-        loss = total_loss / float(len(specified_set))
-        if self.distributed:
-            if self.main_proc:
-                self.save_checkpoint('epoch-%d.pth' % (epoch), score)
-        else:
-            if score > self.best_score and self.mode == 'train':
-                self.save_checkpoint('best.pth', score)
+        loss = total_loss / float(n_batches)
+        self.record_eval(score, cnt, start_time)
+        if self.mode == 'train':
+            filenames = []
+            if self.distributed:
+                filenames.append('epoch-%d.pth' % (epoch))
+            if score > self.best_score:
+                filenames.append('best.pth')
                 self.best_score = score
+            # One snapshot for both files
+            if filenames and self.main_proc:
+                self.save_checkpoint(filenames, score)
 
         self.verbose(["Val stat. @ step {} | Loss - {:.4f} | Acc. - {:.4f}"
                       .format(self.step, loss, score)])
+        self.log_compile_stats()
 
         self.model.train()
-        return log
+        if write_log:
+            log_lines = gather_shards(log_lines)
+            return "game_id|question|answer|pred_answer|pred_confidence\n" + ''.join(log_lines)
 
 def ans_idx2str(idx):
     if idx==0:
@@ -6,7 +6,8 @@ import torch.nn as nn
 from functools import partial
 from matplotlib.image import imread
 from solver.solver import BaseSolver
-from solver.utils import human_format, cal_hit
+from solver.utils import human_format
+from solver.metrics import hits, num_tokens, Metrics
 from torch.utils.data import DataLoader
 from src.model.qgen import QGenModel
 from src.tools.optimizer import Optimizer
@@ -123,35 +124,39 @@ class QGenSolver(BaseSolver):
             human_format(self.steps_per_epoch))])
         while self.step < self.max_step:
             # Validate every epoch
-            self.validate(self.valid_set)
-            self.timer.set()
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set)
+            self.telemetry.start()
             for data in self.train_set:
+                self.telemetry.lap('data')
                 game, qgen_in, qgen_in_len, qgen_tgt, qgen_tgt_len, img_feat, out_mask = self.fetch_data(data)
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
-                pred = self.model(qgen_in, qgen_in_len, img_feat, mask=None)
-                loss = self.loss(pred.view(-1, pred.size(-1)), qgen_tgt.view(-1))
-                hit = cal_hit(pred, qgen_tgt)
-                acc = hit / float(qgen_tgt.size(0) * qgen_tgt.size(1))
-                hit_nopad = cal_hit(pred, qgen_tgt, pad_id=self.tokenizer.pad_id)
-                acc_nopad = hit_nopad / float(qgen_tgt.size(0) * qgen_tgt.size(1))
-                self.timer.cnt('fw')
+                with self.autocast():
+                    pred = self.model(qgen_in, qgen_in_len, img_feat, mask=None)
+                    loss = self.loss(pred.view(-1, pred.size(-1)), qgen_tgt.view(-1))
+                    self.train_metrics.update(
+                        loss=loss, hit=hits(pred, qgen_tgt), hit_nopad=hits(pred, qgen_tgt, self.tokenizer.pad_id),
+                        cnt=qgen_tgt.size(0) * qgen_tgt.size(1))
+                self.telemetry.lap('forward')
                 # Backward
                 grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                self.telemetry.step(len(game), num_tokens(qgen_tgt, self.tokenizer.pad_id))
 
                 self.step += 1
                 # Log
                 if (self.step == 1) or (self.step % self._progress_step == 0):
+                    stats, n_steps = self.train_metrics.read()
+                    acc, acc_nopad = stats['hit'] / stats['cnt'], stats['hit_nopad'] / stats['cnt']
                     self.progress("Tr stat. | Loss - {:.4f} | Acc.(pad/nopad) - {:.3f}/{:.3f} | Grad. norm - {:.2f} | {}".format(
-                        loss.item(), acc, acc_nopad, grad_norm, self.timer.show()))            
+                        stats['loss'] / n_steps, acc, acc_nopad, grad_norm, self.telemetry.report(self.step)))
                     self.write_log('scalars', 'accuracy', {'train': acc})
                     self.write_log('scalars', 'accuracy', {'train-nopad': acc_nopad})
-                    self.write_log('scalars', 'loss', {'train': loss})
+                    self.write_log('scalars', 'loss', {'train': stats['loss'] / n_steps})
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     self.logger.close()
@@ -161,27 +166,21 @@ class QGenSolver(BaseSolver):
     def validate(self, specified_set):
 
         self.model.eval()
-        total_loss = 0
-        total_hit = 0
-        total_hit_nopad = 0
+        metrics = Metrics(self.device)
         for val_step, data in enumerate(specified_set):
             game, qgen_in, qgen_in_len, qgen_tgt, qgen_tgt_len, img_feat, out_mask = self.fetch_data(data)
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 pred = self.model(qgen_in, qgen_in_len, img_feat, mask=None)
-                loss = self.loss(pred.view(-1, pred.size(-1)), qgen_tgt.view(-1)).item()
-                hit = cal_hit(pred, qgen_tgt)
-                hit /= qgen_tgt.size(0) * qgen_tgt.size(1)
-                hit_nopad = cal_hit(pred, qgen_tgt, pad_id=self.tokenizer.pad_id)
-                hit_nopad /= qgen_tgt.size(0) * qgen_tgt.size(1)
-
-                total_hit += hit
-                total_hit_nopad += hit_nopad
-                total_loss += loss
+                loss = self.loss(pred.view(-1, pred.size(-1)), qgen_tgt.view(-1))
+                n = qgen_tgt.size(0) * qgen_tgt.size(1)
+                # Accuracies of the batch, averaged over the batches
+                metrics.update(
+                    loss=loss, hit=hits(pred, qgen_tgt) / n,
+                    hit_nopad=hits(pred, qgen_tgt, self.tokenizer.pad_id) / n)
                 if (val_step == 0) or ((val_step+1) % self._progress_step == 0):
+                    stats, n_steps = metrics.read(reset=False)
                     self.progress("Dev stat. | Loss - {:.4f} | Acc.(pad/nopad) - {:.3f}/{:.3f}".format(
-                        total_loss/float(val_step+1), 
-                        total_hit/float(val_step+1), 
-                        total_hit_nopad/float(val_step+1)))
+                        stats['loss'] / n_steps, stats['hit'] / n_steps, stats['hit_nopad'] / n_steps))
                 # Log
                 if self.mode == 'train':
                     if val_step < NUM_LOG_TEXT_SAMPLES:
@@ -202,9 +201,10 @@ class QGenSolver(BaseSolver):
                         self.write_log('text', '(free-run)-pred-%d' % val_step, pred_sc)
                         
         # Total hit is not actaul hit here
-        avg_acc = total_hit / float(len(specified_set))
-        avg_acc_nopad = total_hit_nopad / float(len(specified_set))
-        avg_loss = total_loss / float(len(specified_set))
+        stats, n_steps = metrics.read()
+        avg_acc = stats['hit'] / float(n_steps)
+        avg_acc_nopad = stats['hit_nopad'] / float(n_steps)
+        avg_loss = stats['loss'] / float(n_steps)
         self.write_log('scalars', 'accuracy', {'dev': avg_acc})
         self.write_log('scalars', 'accuracy', {'dev-nopad': avg_acc_nopad})
         self.write_log('scalars', 'loss', {'dev': avg_loss})
@@ -229,7 +229,7 @@ class QGenSolver(BaseSolver):
             self.progress("[{}/{}] Generating questions for sanity check...".format(val_step+1, len(specified_set)))
             game, qgen_in, qgen_in_len, qgen_tgt, qgen_tgt_len, img_feat, out_mask = self.fetch_data(data)
             qgen_in_sc, qgen_in_len_sc, last_ans = self.make_sanity_check_input(qgen_in)
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 pred = self.model.generate_from_dialog(
                     qgen_in_sc, qgen_in_len_sc, last_ans, img_feat,
                     self.tokenizer.eoq_id, self.tokenizer.eod_id, max_q_len=20)
@@ -6,7 +6,8 @@ import torch.nn as nn
 from functools import partial
 from matplotlib.image import imread
 from solver.solver import BaseSolver
-from solver.utils import human_format, cal_hit
+from solver.utils import human_format
+from solver.metrics import num_tokens
 from torch.utils.data import DataLoader
 from src.model.qgen_vdst import QGenModel
 from src.tools.optimizer import Optimizer
@@ -130,30 +131,35 @@ class QGenSolver(BaseSolver):
         while self.step < self.max_step:
         # while self.step < 1e100:
             # Validate every epoch
-            self.validate(self.valid_set)
-            self.timer.set()
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set)
+            self.telemetry.start()
             for data in self.train_set:
+                self.telemetry.lap('data')
                 game, qs, tf_input, answers, q_len, obj_feats = self.fetch_data(data)
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
-                # (batch_size, max_num_turns, max_q_len, num_classes)             
-                pred, _, entropy = self.model.forward_dialog(tf_input, q_len, answers, obj_feats)
-                loss = self.loss(pred.reshape(-1, pred.size(-1)), qs.reshape(-1)) + self.entropy_loss_weight * entropy
-                self.timer.cnt('fw')
+                with self.autocast():
+                    # (batch_size, max_num_turns, max_q_len, num_classes)             
+                    pred, _, entropy = self.model.forward_dialog(tf_input, q_len, answers, obj_feats)
+                    loss = self.loss(pred.reshape(-1, pred.size(-1)), qs.reshape(-1)) + self.entropy_loss_weight * entropy
+                    self.train_metrics.update(loss=loss)
+                self.telemetry.lap('forward')
                 # Backward
                 grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                self.telemetry.step(len(game), num_tokens(qs, self.tokenizer.pad_id))
 
                 self.step += 1
                 # Log
                 if (self.step == 1) or (self.step % self._progress_step == 0):
+                    stats, n_steps = self.train_metrics.read()
                     self.progress("Tr stat. | Loss - {:.4f} | Grad. norm - {:.2f} | {}".format(
-                        loss.item(), grad_norm, self.timer.show()))            
-                    self.write_log('scalars', 'loss', {'train': loss})
+                        stats['loss'] / n_steps, grad_norm, self.telemetry.report(self.step)))
+                    self.write_log('scalars', 'loss', {'train': stats['loss'] / n_steps})
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     self.logger.close()
@@ -163,7 +169,7 @@ class QGenSolver(BaseSolver):
         self.model.eval()
         total_loss = 0
         for val_step, data in enumerate(specified_set):
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 game, qs, tf_input, answers, q_len, obj_feats = self.fetch_data(data)
                 pred, _, _ = self.model.forward_dialog(tf_input, q_len, answers, obj_feats)
                 loss = self.loss(pred.reshape(-1, pred.size(-1)), qs.reshape(-1))
@@ -6,17 +6,19 @@ import torch.nn as nn
 from functools import partial
 from matplotlib.image import imread
 from solver.solver import BaseSolver
-from solver.utils import human_format, cal_hit
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from solver.utils import human_format
+from solver.metrics import Metrics
+from torch.utils.data import DataLoader, SequentialSampler, Subset
 from src.model.qgen_vilbert import QGenModel
 from src.tools.optimizer import Optimizer
+from src.tools.compile import TXT_BUCKETS, pad_to_bucket
 from src.tools.tokenizer import GW_Tokenizer, BERT_Tokenizer
+from src.tools.distributed import shard_indices, all_reduce_sum, ResumableSampler
+from src.tools.checkpoint import strip_module_prefix
 from src.data.image_features_reader import h5FeatureReaderVilbert as image_features_reader
 from src.data.qgen_vilbert import QGenDataset, collate_fn
 
-from apex.parallel import DistributedDataParallel
 import torch.distributed as dist
-from torch.utils.data.distributed import DistributedSampler
 
 
 NUM_LOG_TEXT_SAMPLES = 5 # must < len(valid_set)
@@ -47,13 +49,15 @@ class QGenSolver(BaseSolver):
                 img_feat_readers[split], 
                 tokenizer, 
                 padding_index=tokenizer.pad_id)
-            if self.distributed:
-                sampler = DistributedSampler(
-                    dataset, shuffle=True if split == 'train' else False)
+            if split == 'train':
+                # Sharded over the ranks when distributed, and resumable mid-epoch
+                sampler = ResumableSampler(dataset, seed=self.args.seed)
                 setattr(self, split+'_sampler', sampler)
-            elif split == 'train':
-                # Not distributed and train
-                sampler = RandomSampler(dataset)
+            elif self.distributed:
+                # Disjoint shards, unlike DistributedSampler which pads them with
+                # repeated items, so the metrics summed in validate are exact
+                dataset = Subset(dataset, shard_indices(len(dataset)))
+                sampler = SequentialSampler(dataset)
             else:
                 # Not distributed and validation & test
                 sampler = SequentialSampler(dataset)
@@ -100,6 +104,12 @@ class QGenSolver(BaseSolver):
         q_len[q_len == -1] = 0
         if self.config['model']['answer_as_sos']:
             qs_tf_in[:, 1:, 0] = answers
+        if self.args.compile:
+            # Bucketed question lengths keep the number of compiled graphs small
+            pad_id = self.tokenizer.pad_id
+            qs = pad_to_bucket(qs, -1, TXT_BUCKETS, pad_id)
+            qs_tf_in = pad_to_bucket(qs_tf_in, -1, [qs.size(-1) - 1], pad_id)
+            txt_attn_mask = pad_to_bucket(txt_attn_mask, -1, TXT_BUCKETS, 0)
         return (
             game,
             qs.to(self.device),
@@ -134,7 +144,7 @@ class QGenSolver(BaseSolver):
 
         self.model = self.model.to(self.device)
         if self.distributed:
-            self.model = DistributedDataParallel(self.model, delay_allreduce=True)
+            self.model = self.data_parallel(self.model)
 
         state_handler_params = []
         other_params = []
@@ -151,29 +161,33 @@ class QGenSolver(BaseSolver):
             optimizer_grouped_parameters, 
             self.config['hparas']['optimizer'],
             lr=[self.config['hparas']['lr']['state_handler'], self.config['hparas']['lr']['other']],
-            lr_scheduler=self.config['hparas']['lr_scheduler']
+            lr_scheduler=self.config['hparas']['lr_scheduler'],
+            grad_accum_steps=self.grad_accum_steps
         )
 
         self.loss = nn.CrossEntropyLoss(ignore_index=self.tokenizer.pad_id)
+        # Project onto the vocabulary and compute the loss in chunks of non-pad words
+        self.loss_chunk_size = self.config['hparas'].get('loss_chunk_size', 0)
         self.loss_guess = nn.CrossEntropyLoss()
 
         if self.args.load:
             ckpt = torch.load(self.args.load, map_location=self.device)
-            if self.distributed:
-                from collections import OrderedDict
-                new_state_dict = OrderedDict()
-                for k, v in ckpt['model'].items():
-                    name = k[7:]  # remove `module.`
-                    new_state_dict[name] = v
-                self.model.load_state_dict(new_state_dict)
-
-
-            # self.model.load_state_dict(ckpt['model'])
+            # Saved with or without the DistributedDataParallel wrapper
+            getattr(self.model, 'module', self.model).load_state_dict(strip_module_prefix(ckpt['model']))
             self.optimizer.load_opt_state_dict(ckpt['optimizer'])
             self.step = ckpt['global_step']
+            if self.mode == 'train':
+                self.load_train_state(ckpt)
             self.verbose('Load ckpt from {}, restarting at step {}'.format(
                 self.args.load, self.step))
 
+        if self.args.compile:
+            num_bboxs = self.config['model']['num_bboxs']
+            warmup_shapes = [(self.model, False, self.valid_set.batch_size, num_bboxs, False)]
+            if self.mode == 'train':
+                warmup_shapes.append((self.model, True, self.train_set.batch_size, num_bboxs, False))
+            self.compile_model(warmup_shapes)
+
     def exec(self):
         if self.mode == 'train':
             self.train()
@@ -186,6 +200,23 @@ class QGenSolver(BaseSolver):
             self.sanity_check(self.valid_set)
         
 
+    def forward_loss(self, qs, *inputs, update_vilbert=False):
+        '''
+        Teacher-forced word loss (mean over non-pad targets), number of target words
+        and number of correctly predicted words
+        '''
+        if self.loss_chunk_size > 0:
+            (loss, n_tokens, n_hits), _, _ = self.model.forward(
+                qs, *inputs, update_vilbert=update_vilbert, loss_chunk_size=self.loss_chunk_size)
+            return loss / n_tokens.clamp(min=1), n_tokens, n_hits
+        tgt = qs[:, :, 1:]
+        # (batch_size, max_num_turns, max_q_len, num_classes)
+        pred, _, _ = self.model.forward(qs, *inputs, update_vilbert=update_vilbert)
+        loss = self.loss(pred.reshape(-1, pred.size(-1)), tgt.reshape(-1))
+        not_pad = tgt != self.tokenizer.pad_id
+        n_hits = ((pred.argmax(dim=-1) == tgt) & not_pad).sum()
+        return loss, not_pad.sum(), n_hits
+
     def train(self):
         self.verbose(['Total training epoch/steps: {}/{}'.format(
             self.max_epoch, human_format(self.max_step))])
@@ -193,40 +224,39 @@ class QGenSolver(BaseSolver):
             human_format(self.steps_per_epoch))])
         while self.step < self.max_step:
             # Validate every epoch
-            self.validate(self.valid_set)
-            self.timer.set()
-            epoch = self.step // self.steps_per_epoch
-            if self.distributed:
-                # The random seed depends on # of epoch in DistributedSampler
-                self.train_sampler.set_epoch(epoch)
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set)
+            epoch = self.begin_epoch()
+            self.telemetry.start()
             for data in self.train_set:
+                self.telemetry.lap('data')
                 game, qs, qs_tf_in, answers, q_len, img_feats, bboxs, txt_attn_mask, end_turn = self.fetch_data(data)
-                tgt = qs[:, :, 1:]
 
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
-                # (batch_size, max_num_turns, max_q_len, num_classes)             
-                pred, _, guess_logits = self.model.forward(
-                    qs, qs_tf_in, q_len, answers, img_feats, bboxs, txt_attn_mask, end_turn, update_vilbert=self.config['model']['update_state_handler'])
-                loss = self.loss(pred.reshape(-1, pred.size(-1)), tgt.reshape(-1))
-
-
-                self.timer.cnt('fw')
+                with self.autocast():
+                    loss, n_tokens, n_hits = self.forward_loss(
+                        qs, qs_tf_in, q_len, answers, img_feats, bboxs, txt_attn_mask, end_turn,
+                        update_vilbert=self.config['model']['update_state_handler'])
+                    self.train_metrics.update(loss=loss, tokens=n_tokens, hits=n_hits)
+                self.telemetry.lap('forward')
                 # Backward
                 grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                self.telemetry.step(len(game), n_tokens)
 
                 self.step += 1
+                self.save_last()
                 # Log
                 
                 if (self.step == 1) or (self.step % self._progress_step == 0):
-                    self.progress("{} - Tr stat. | Loss - {:.4f} | Grad. norm - {:.2f} | {}".format(
-                        epoch, loss.item(), grad_norm, self.timer.show()))            
-                    self.write_log('scalars', 'loss', {'train': loss})
+                    stats, n_steps = self.train_metrics.read()
+                    self.progress("{} - Tr stat. | Loss - {:.4f} | Acc. - {:.3f} | Grad. norm - {:.2f} | {}".format(
+                        epoch, stats['loss'] / n_steps, stats['hits'] / stats['tokens'], grad_norm, self.telemetry.report(self.step)))
+                    self.write_log('scalars', 'loss', {'train': stats['loss'] / n_steps})
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     self.logger.close()
@@ -234,38 +264,46 @@ class QGenSolver(BaseSolver):
 
     def validate(self, specified_set):
         self.model.eval()
-        total_loss = 0
+        metrics = Metrics(self.device)
         for val_step, data in enumerate(specified_set):
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 game, qs, qs_tf_in, answers, q_len, img_feats, bboxs, txt_attn_mask, end_turn = self.fetch_data(data)
-                tgt = qs[:, :, 1:]
 
-                pred, _, guess_logits = self.model.forward(
+                loss, n_tokens, n_hits = self.forward_loss(
                     qs, qs_tf_in, q_len, answers, img_feats, bboxs, txt_attn_mask, end_turn)
-                loss = self.loss(pred.reshape(-1, pred.size(-1)), tgt.reshape(-1))
 
-                total_loss += loss
+                metrics.update(loss=loss, tokens=n_tokens, hits=n_hits)
                 if (val_step == 0) or ((val_step+1) % self._progress_step == 0):
-                    self.progress("Dev stat. ({}/{}) | Loss - {:.4f}".format(
-                        val_step+1, len(specified_set), total_loss/float(val_step+1)))
+                    stats, n_steps = metrics.read(reset=False)
+                    self.progress("Dev stat. ({}/{}) | Loss - {:.4f} | Acc. - {:.4f}".format(
+                        val_step+1, len(specified_set), stats['loss'] / n_steps, stats['hits'] / stats['tokens']))
                 # Log
                 if self.mode == 'train':
                     pass
 
                         
-        avg_loss = total_loss / float(len(specified_set))
-        self.write_log('scalars', 'loss', {'dev': avg_loss})
+        # Sum over the validation shards of all ranks
+        stats, n_steps = metrics.read()
+        total_loss, total_tokens, total_hits, n_batches = all_reduce_sum(
+            [stats['loss'], stats['tokens'], stats['hits'], n_steps], self.device)
+        avg_loss = total_loss / float(n_batches)
+        token_acc = total_hits / float(total_tokens)
+        if self.main_proc:
+            self.write_log('scalars', 'loss', {'dev': avg_loss})
+            self.write_log('scalars', 'token_acc', {'dev': token_acc})
         score = -avg_loss
         epoch = self.step // self.steps_per_epoch
-        if self.main_proc and self.mode == 'train':
+        if self.mode == 'train':
             if score > self.best_score:
                 #self.save_checkpoint('step_{}.pth'.format(self.step), score)
-                self.save_checkpoint('best.pth', score)
+                if self.main_proc:
+                    self.save_checkpoint('best.pth', score)
                 self.best_score = score
-            elif epoch % SAVE_EVERY_EPOCH == 0:
+            elif self.main_proc and epoch % SAVE_EVERY_EPOCH == 0:
                 self.save_checkpoint('checkpoint-%d.pth' % epoch, score)
 
-        self.verbose(["Val stat. @ step {} | Loss - {:.4f}"
-                      .format(self.step, avg_loss)])
+        self.verbose(["Val stat. @ step {} | Loss - {:.4f} | Acc. - {:.4f}"
+                      .format(self.step, avg_loss, token_acc)])
+        self.log_compile_stats()
 
         self.model.train()
@@ -1,20 +1,32 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: CC-BY-NC-4.0
 import os
+import time
 import torch
 import torch.nn as nn
 from functools import partial
 from matplotlib.image import imread
 from solver.solver import BaseSolver
-from solver.utils import human_format, cal_hit
-from torch.utils.data import DataLoader
-from src.model.self_play_all_vilbert import SelfPlayModel
+from solver.utils import human_format
+from solver.metrics import hits
+from solver.telemetry import resident_memory_mb
+from torch.utils.data import DataLoader, Subset
+from src.model.self_play_all_vilbert import SelfPlayModel, dialog_log_to_lists
 from src.tools.optimizer import Optimizer
+from src.tools.compile import TXT_BUCKETS, BBOX_BUCKETS, pad_to_bucket
 from src.tools.tokenizer import GW_Tokenizer, BERT_Tokenizer
+from src.tools.utils import load_vocab_shortlist
+from src.tools.answer_cache import OracleAnswerCache, checkpoint_hash
+from src.tools.checkpoint import load_weights
+from src.tools.dialog_store import DialogWriter, DialogStore, merge_dialog_files
+from src.tools.distributed import (
+    get_rank, get_world_size, barrier, shard_indices, all_reduce_sum, shard_path, merge_shard_files)
+from src.model.guesser_vilbert import GuesserModel
+from src.model.utils import quantize_dynamic_int8, share_identical_parameters
 from src.data.image_features_reader import numpyReader as image_features_reader
 from src.data.image_features_reader import h5FeatureReaderVilbert as image_features_reader_vb
 from src.data.image_features_reader import numpyReader as image_features_reader_gt
-from src.data.self_play_all_vilbert import SelfPlayDataset, collate_fn
+from src.data.self_play_all_vilbert import SelfPlayDataset, GuesserDialogDataset, collate_fn, guesser_collate_fn
 
 
 NUM_LOG_TEXT_SAMPLES = 5 # must < len(valid_set)
@@ -26,13 +38,16 @@ class SelfPlaySolver(BaseSolver):
         self.step = 0
         self.best_score = -1e10
 
-    def load_dataloader(self, img_feat_readers, img_feat_readers_gt, tokenizer, splits):
+    def load_dataloader(self, img_feat_readers, img_feat_readers_gt, tokenizer, splits,
+                        dataset_cls=SelfPlayDataset, collate=None):
         # Prepare self.train_set, self.valid_set, self.test_set
         dataroot = self.config['data']['dataroot']
         batch_size = self.config['data']['batch_size']
+        if collate is None:
+            collate = partial(collate_fn, wrd_pad_id=tokenizer.pad_id)
         # splits = ['train', 'valid'] if self.mode == 'train' else ['test', 'valid']
         for split in splits:
-            dataset = SelfPlayDataset(
+            dataset = dataset_cls(
                 dataroot, 
                 split, 
                 img_feat_readers[split], 
@@ -42,6 +57,9 @@ class SelfPlaySolver(BaseSolver):
                 )
             if not hasattr(self, 'answer2id'):    self.answer2id = dataset.answer2id
             if not hasattr(self, 'answer2token'): self.answer2token = dataset.answer2token
+            if self.distributed and split != 'train':
+                # Each rank plays its own share of the games
+                dataset = Subset(dataset, shard_indices(len(dataset)))
             # Set self.XXX_set = torch.utils.data.Dataloader
             setattr(
                 self,
@@ -51,21 +69,23 @@ class SelfPlaySolver(BaseSolver):
                     batch_size=batch_size if split == 'train' else 4*batch_size,
                     shuffle=(split=='train'),
                     drop_last=False,
-                    collate_fn=partial(collate_fn, wrd_pad_id=tokenizer.pad_id),
+                    collate_fn=collate,
                     num_workers=self.args.n_jobs,
                     pin_memory=self.args.pin_memory)
             )
 
 
+    def load_tokenizer(self):
+        if self.config['data']['tokenizer'].lower() == 'bert':
+            self.verbose(["Use Bert tokenizer"])
+            #tokenizer = BERT_Tokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
+            return BERT_Tokenizer.initialize()
+        return GW_Tokenizer(self.config['data']['vocab_path'])
+
     def load_data(self):
         self.verbose(['Loading data...'])
         config = self.config
-        if config['data']['tokenizer'].lower() == 'bert':
-            self.verbose(["Use Bert tokenizer"])
-            #tokenizer = BERT_Tokenizer.from_pretrained('bert-base-uncased', do_lower_case=True)
-            tokenizer = BERT_Tokenizer.initialize()
-        else:
-            tokenizer = GW_Tokenizer(config['data']['vocab_path'])
+        tokenizer = self.load_tokenizer()
         
         feat_path_qgen = config['data']['features_path']['qgen']
         feat_path_oracle = config['data']['features_path']['oracle']
@@ -91,7 +111,15 @@ class SelfPlaySolver(BaseSolver):
             image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, tgt_img_feat, tgt_bbox_vb, tgt_cat, \
                 cats_guesser, bboxs_mask, label, qs, q_len = data
         # obj_feats = torch.cat([image_features_rcnn_qgen, bboxs_rcnn_qgen], dim=-1)
-
+        # Guesser regions of the batch, its initial state is uniform over these only
+        num_bboxs = bboxs_mask.size(1)
+        if self.args.compile:
+            # Bucketed guesser region counts, padded regions are masked out of the guess logits
+            # and start with a zero state
+            image_features_rcnn_gt_guesser = pad_to_bucket(image_features_rcnn_gt_guesser, 1, BBOX_BUCKETS, 0)
+            bboxs_rcnn_gt_guesser = pad_to_bucket(bboxs_rcnn_gt_guesser, 1, BBOX_BUCKETS, 0)
+            cats_guesser = pad_to_bucket(cats_guesser, 1, BBOX_BUCKETS, 0)
+            bboxs_mask = pad_to_bucket(bboxs_mask, 1, BBOX_BUCKETS, False)
 
         return (
             game, 
@@ -109,6 +137,7 @@ class SelfPlaySolver(BaseSolver):
             label.to(self.device), 
             qs.to(self.device), 
             q_len.to(self.device),
+            num_bboxs,
         )
 
     def set_model(self):
@@ -124,13 +153,49 @@ class SelfPlaySolver(BaseSolver):
         self.model = SelfPlayModel(
             qgen_kwargs=None if self.use_gt_question else self.config['model']['qgen'] ,
             oracle_kwargs=self.config['model']['oracle'],
-            guesser_kwargs=self.config['model']['guesser']
+            guesser_kwargs=self.config['model']['guesser'],
+            # All players are loaded below
+            skip_init=True,
             )
         # Load pretrained players
+        if any(self.config['model'][plyr].get('quantize', False) for plyr in players):
+            assert self.device.type == 'cpu', "Dynamic int8 quantized players only run on CPU."
+        shortlist = None
+        if 'qgen' in players and self.config['model']['qgen'].get('shortlist_path'):
+            shortlist = load_vocab_shortlist(
+                self.config['model']['qgen']['shortlist_path'], self.config['data']['dataroot'],
+                self.tokenizer, verbose=self.args.verbose)
+            self.verbose(['QGen generates from a shortlist of %d word pieces' % len(shortlist)])
         for plyr in players:
             log = self.model.load_player(
-                plyr, self.config['model'][plyr]['pretrained_path'], map_location="cpu")
+                plyr, self.config['model'][plyr]['pretrained_path'], map_location="cpu",
+                quantize=self.config['model'][plyr].get('quantize', False),
+                shortlist=shortlist if plyr == 'qgen' else None)
             self.verbose([log])
+        if self.mode != 'train' and self.config['model'].get('share_identical_weights', False):
+            # Player weights on CPU are memory-mapped from their files, dropping one tensor
+            # of a mapping does not free its pages: copy them off the mappings. On GPU the
+            # memory is saved by `.to(device)`.
+            copy = self.device.type == 'cpu'
+            rss_before = resident_memory_mb()
+            n_shared, n_bytes = share_identical_parameters(self.model, copy=copy)
+            self.verbose(['Shared {} weight tensors identical across players ({:.1f} MB)'.format(
+                n_shared, n_bytes / 2 ** 20)])
+            if copy:
+                weight_mb = sum(p.numel() * p.element_size() for p in self.model.parameters()) / 2 ** 20
+                self.verbose(['Copied {:.1f} MB of player parameters ({:.1f} MB without sharing) off the '
+                              'player files, resident memory {:.1f} MB -> {:.1f} MB'.format(
+                                  weight_mb, weight_mb + n_bytes / 2 ** 20, rss_before,
+                                  resident_memory_mb())])
+        if self.config['model']['oracle'].get('answer_cache', False):
+            # Answers are only reused with the same Oracle weights and precision
+            oracle_id = '%s-%s' % (
+                checkpoint_hash(self.config['model']['oracle']['pretrained_path']), self.precision)
+            if self.config['model']['oracle'].get('quantize', False):
+                oracle_id += '-int8'
+            self.model.answer_cache = OracleAnswerCache(
+                oracle_id, path=self.config['model']['oracle'].get('answer_cache_path'))
+            self.verbose(['Oracle answer cache with %d answers' % len(self.model.answer_cache)])
         self.model.to(self.device)
         self.optimizer = Optimizer(
             self.model.parameters(), **self.config['hparas'])
@@ -145,6 +210,19 @@ class SelfPlaySolver(BaseSolver):
             self.verbose('Load ckpt from {}, restarting at step {}'.format(
                 self.args.load, self.step))
 
+        if self.args.compile:
+            # Questions are padded to TXT_BUCKETS in play(), regions as in the first batch
+            self.model.txt_buckets = TXT_BUCKETS
+            eval_set = self.test_set if self.mode != 'train' else self.valid_set
+            data = self.fetch_data(next(iter(eval_set)))
+            warmup_shapes = [
+                (self.model.oracle, False, eval_set.batch_size, data[4].size(1) + 1, False),
+                (self.model.guesser, False, eval_set.batch_size, data[5].size(1), True)]
+            if not self.use_gt_question:
+                warmup_shapes.append(
+                    (self.model.qgen, False, eval_set.batch_size, data[2].size(1), False))
+            self.compile_model(warmup_shapes)
+
     def exec(self):
         if self.use_gt_question:
             self.verbose("Use ground truth questions.")
@@ -164,90 +242,146 @@ class SelfPlaySolver(BaseSolver):
             human_format(self.steps_per_epoch))])
         while self.step < self.max_step:
             # Validate every epoch
-            self.validate(self.valid_set)
-            self.timer.set()
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set)
+            self.telemetry.start()
             for data in self.train_set:
+                self.telemetry.lap('data')
                 game, obj_feats, tgt_cat, tgt_bbox, tgt_img_feat, cats, bboxs, bboxs_mask, label, qs, q_len = self.fetch_data(data)
                 NOT_IMPLEMENT_YET()
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
                 pred = self.model(qgen_in, qgen_in_len, img_feat, mask=None)
                 loss = self.loss(pred.view(-1, pred.size(-1)), qgen_tgt.view(-1))
-                hit = cal_hit(pred, qgen_tgt)
-                acc = hit / float(qgen_tgt.size(0) * qgen_tgt.size(1))
-                hit_nopad = cal_hit(pred, qgen_tgt, pad_id=self.tokenizer.pad_id)
-                acc_nopad = hit_nopad / float(qgen_tgt.size(0) * qgen_tgt.size(1))
-                self.timer.cnt('fw')
+                self.train_metrics.update(
+                    loss=loss, hit=hits(pred, qgen_tgt), hit_nopad=hits(pred, qgen_tgt, self.tokenizer.pad_id),
+                    cnt=qgen_tgt.size(0) * qgen_tgt.size(1))
+                self.telemetry.lap('forward')
                 # Backward
                 grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                self.telemetry.step(len(game))
 
                 self.step += 1
                 # Log
                 if (self.step == 1) or (self.step % self._progress_step == 0):
+                    stats, n_steps = self.train_metrics.read()
+                    acc, acc_nopad = stats['hit'] / stats['cnt'], stats['hit_nopad'] / stats['cnt']
                     self.progress("Tr stat. | Loss - {:.4f} | Acc.(pad/nopad) - {:.3f}/{:.3f} | Grad. norm - {:.2f} | {}".format(
-                        loss.item(), acc, acc_nopad, grad_norm, self.timer.show()))            
+                        stats['loss'] / n_steps, acc, acc_nopad, grad_norm, self.telemetry.report(self.step)))
                     self.write_log('scalars', 'accuracy', {'train': acc})
                     self.write_log('scalars', 'accuracy', {'train-nopad': acc_nopad})
-                    self.write_log('scalars', 'loss', {'train': loss})
+                    self.write_log('scalars', 'loss', {'train': stats['loss'] / n_steps})
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     self.logger.close()
                     break
 
 
+    def write_game(self, out_file, game, pred_obj, answer_obj, q_log, a_log, a_conf_log):
+        out_prefix = "{}|{}|{}".format(game.id, pred_obj, answer_obj)
+        for t in range(len(q_log)):
+            out_str = out_prefix + "|{}|{}|".format(t, self.tokenizer.decode(q_log[t]))
+            if len(a_log) > t:
+                out_str += "{}|{:.3f}".format(self.tokenizer.decode(a_log[t]), a_conf_log[t])
+            out_file.write(out_str+'\n')
+        token2answer = {self.answer2token[k]: self.answer2id[k] for k in self.answer2id}
+        self.dialog_writer.add(
+            game.id, answer_obj, q_log, [token2answer[a[0]] for a in a_log], a_conf_log)
+
+    def validate_continuous(self, specified_set, out_file):
+        '''
+        Self-play with continuous batching: finished games leave the working batch
+        each turn and free slots are refilled from the next batches of `specified_set`.
+        The working batch holds `specified_set.batch_size` games (4x `data.batch_size`
+        for the dev / test loaders), the batch size of per-batch play.
+        Games are written in the order they end.
+        '''
+        def batches():
+            for data in specified_set:
+                game, qgen_img_feats, qgen_bboxs, image_features_rcnn_oracle, bboxs_rcnn_oracle, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, \
+                     tgt_img_feat, tgt_bbox_vb, tgt_cat, cats_guesser, bboxs_mask, label, qs, q_len, num_bboxs = self.fetch_data(data)
+                inputs = (
+                    qgen_img_feats, qgen_bboxs, image_features_rcnn_oracle, bboxs_rcnn_oracle,
+                    image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser,
+                    tgt_cat, tgt_bbox_vb, tgt_img_feat, cats_guesser, bboxs_mask)
+                yield inputs, list(zip(game, label)), [(g.id, g.object_id) for g in game], num_bboxs
+
+        total_hit = 0
+        total_cnt = 0
+        with torch.no_grad(), self.autocast():
+            for (game, label), pred, dialog, q_log, a_log, a_conf_log in self.model.play_continuous(
+                batches(), specified_set.batch_size,
+                self.tokenizer.sos_id, self.tokenizer.pad_id,
+                self.tokenizer.eoq_id, self.tokenizer.eod_id,
+                self.answer2id, self.answer2token, max_q_len=20, max_turns=8,
+            ):
+                pred_obj, answer_obj = pred.argmax(dim=-1).item(), label.item()
+                self.write_game(out_file, game, pred_obj, answer_obj, q_log, a_log, a_conf_log)
+                total_hit += pred_obj == answer_obj
+                total_cnt += 1
+                if total_cnt % specified_set.batch_size == 0:
+                    self.progress("Dev stat. ({}/{} games) |  Acc. - {:.3f}".format(
+                        total_cnt, len(specified_set.dataset), total_hit/float(total_cnt)))
+        return total_hit, total_cnt
+
     def validate(self, specified_set):
+        start_time = time.time()
         self.model.eval()
         total_hit = 0
         total_cnt = 0
         out_name = self.exp_name + ('_gt' if self.use_gt_question else '') + '.txt'
-        out_file = open(out_name, 'w')
+        out_file = open(shard_path(out_name), 'w')
+        # Dialogs for re-scoring with other Guessers (`rescore-self-play-all-vilbert`)
+        self.dialog_writer = DialogWriter()
         out_file.write('game_id|pred_obj|answer_obj|turn_id|question|answer|answer_confidence\n')
 
-        for val_step, data in enumerate(specified_set):
-            # game, obj_feats, tgt_cat, tgt_bbox, tgt_img_feat, cats, bboxs, bboxs_mask, label, qs, q_len = self.fetch_data(data)
-            game, qgen_img_feats, qgen_bboxs, image_features_rcnn_oracle, bboxs_rcnn_oracle, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, \
-                 tgt_img_feat, tgt_bbox_vb, tgt_cat, cats_guesser, bboxs_mask, label, qs, q_len = self.fetch_data(data)
-            with torch.no_grad(): 
-                if self.use_gt_question:
-                    pred, dialog, q_log, a_log, a_conf_log = self.model.play_with_gt_questions(
-                        qs, q_len, image_features_rcnn_oracle, bboxs_rcnn_oracle, 
-                        image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser,
-                        tgt_cat, tgt_bbox_vb, tgt_img_feat, cats_guesser, bboxs_mask,
-                        self.tokenizer.sos_id, self.tokenizer.pad_id, 
-                        self.tokenizer.eoq_id, self.tokenizer.eod_id,
-                        self.answer2id, self.answer2token,
-                    )
-                else:
-                    pred, dialog, q_log, a_log, a_conf_log = self.model.play(
-                        qgen_img_feats, qgen_bboxs, image_features_rcnn_oracle, bboxs_rcnn_oracle, 
-                        image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser,
-                        tgt_cat, tgt_bbox_vb, tgt_img_feat, cats_guesser, bboxs_mask,
-                        self.tokenizer.sos_id, self.tokenizer.pad_id, 
-                        self.tokenizer.eoq_id, self.tokenizer.eod_id,
-                        self.answer2id, self.answer2token, max_q_len=20, max_turns=8,
-                    )
-                question_tokens = self.tokenizer.decode(q_log[0][0].tolist())
-                for b in range(pred.size(0)):
-                    out_prefix = "{}|{}|{}".format(game[b].id, pred[b].argmax(dim=-1).item(), label[b].item())
-                    for t in range(len(q_log[b])):
-                        out_str = out_prefix + "|{}|{}|".format(t, self.tokenizer.decode(q_log[b][t].tolist()))
-                        if len(a_log[b]) > t:
-                            out_str += "{}|{:.3f}".format(self.tokenizer.decode(a_log[b][t].tolist()), a_conf_log[b][t])
-                        out_file.write(out_str+'\n')
-
-                total_hit += (pred.argmax(dim=-1) == label).sum().item()
-                total_cnt += pred.size(0)
-                # if (val_step == 0) or ((val_step+1) % self._progress_step == 0):
-                self.progress("Dev stat. ({}/{}) |  Acc. - {:.3f}".format(
-                    val_step, len(specified_set), total_hit/float(total_cnt)))
-                # Log
-                if self.mode == 'train':
-                    NOT_IMPLEMENT_YET()
+        if self.config['data'].get('continuous_batching', False) and not self.use_gt_question:
+            total_hit, total_cnt = self.validate_continuous(specified_set, out_file)
+        else:
+            for val_step, data in enumerate(specified_set):
+                # game, obj_feats, tgt_cat, tgt_bbox, tgt_img_feat, cats, bboxs, bboxs_mask, label, qs, q_len = self.fetch_data(data)
+                game, qgen_img_feats, qgen_bboxs, image_features_rcnn_oracle, bboxs_rcnn_oracle, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, \
+                     tgt_img_feat, tgt_bbox_vb, tgt_cat, cats_guesser, bboxs_mask, label, qs, q_len, num_bboxs = self.fetch_data(data)
+                with torch.no_grad(), self.autocast():
+                    if self.use_gt_question:
+                        pred, dialog_log = self.model.play_with_gt_questions(
+                            qs, q_len, image_features_rcnn_oracle, bboxs_rcnn_oracle, 
+                            image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser,
+                            tgt_cat, tgt_bbox_vb, tgt_img_feat, cats_guesser, bboxs_mask,
+                            self.tokenizer.sos_id, self.tokenizer.pad_id, 
+                            self.tokenizer.eoq_id, self.tokenizer.eod_id,
+                            self.answer2id, self.answer2token,
+                            oracle_batch_size=self.config['data'].get('oracle_batch_size'),
+                            guesser_num_bboxs=num_bboxs,
+                        )
+                    else:
+                        pred, dialog_log = self.model.play(
+                            qgen_img_feats, qgen_bboxs, image_features_rcnn_oracle, bboxs_rcnn_oracle, 
+                            image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser,
+                            tgt_cat, tgt_bbox_vb, tgt_img_feat, cats_guesser, bboxs_mask,
+                            self.tokenizer.sos_id, self.tokenizer.pad_id, 
+                            self.tokenizer.eoq_id, self.tokenizer.eod_id,
+                            self.answer2id, self.answer2token, max_q_len=20, max_turns=8,
+                            game_keys=[(g.id, g.object_id) for g in game],
+                            guesser_num_bboxs=num_bboxs,
+                        )
+                    dialog, q_log, a_log, a_conf_log = dialog_log_to_lists(dialog_log)
+                    pred_obj, answer_obj = pred.argmax(dim=-1).tolist(), label.tolist()
+                    for b in range(pred.size(0)):
+                        self.write_game(out_file, game[b], pred_obj[b], answer_obj[b], q_log[b], a_log[b], a_conf_log[b])
+
+                    total_hit += sum(p == l for p, l in zip(pred_obj, answer_obj))
+                    total_cnt += pred.size(0)
+                    # if (val_step == 0) or ((val_step+1) % self._progress_step == 0):
+                    self.progress("Dev stat. ({}/{}) |  Acc. - {:.3f}".format(
+                        val_step, len(specified_set), total_hit/float(total_cnt)))
+                    # Log
+                    if self.mode == 'train':
+                        NOT_IMPLEMENT_YET()
 
                         
         if self.mode == 'train':
@@ -259,17 +393,130 @@ class SelfPlaySolver(BaseSolver):
                 self.best_score = score
             self.model.train()
 
+        # Games of all ranks
+        total_hit, total_cnt = all_reduce_sum([total_hit, total_cnt], self.device)
+        self.record_eval(total_hit / float(total_cnt), total_cnt, start_time)
         self.verbose(["Val stat. @ step {} | Acc. - {:.3f}"
                       .format(self.step, total_hit / float(total_cnt))])
+        if self.model.answer_cache is not None:
+            self.verbose([self.model.answer_cache.stats()])
+            self.model.answer_cache.save()
+        self.log_compile_stats()
         
         out_file.close()
+        self.dialog_writer.save(shard_path(dialog_path(out_name)))
+        if self.distributed:
+            self.merge_shards(out_name)
+        self.verbose(['Saved {} dialogs to {}'.format(total_cnt, dialog_path(out_name))])
+
+    def merge_shards(self, out_name):
+        ''' Merge the result and dialog files of all ranks on rank 0 '''
+        barrier()
+        if get_rank() == 0:
+            # Sorted by game id then turn id, whatever the number of ranks
+            merge_shard_files(
+                out_name, sort_key=lambda line: tuple(int(x) for x in line.split('|')[:4:3]))
+            merge_dialog_files(
+                [shard_path(dialog_path(out_name), r) for r in range(get_world_size())],
+                dialog_path(out_name))
+            for r in range(get_world_size()):
+                os.remove(shard_path(dialog_path(out_name), r))
+        barrier()
+
+
+def dialog_path(out_name):
+    ''' Saved dialogs next to the self-play result file '''
+    return os.path.splitext(out_name)[0] + '_dialogs.pth'
+
+
+class RescoreSolver(SelfPlaySolver):
+    '''
+    Guess the targets of dialogs saved by `test-self-play-all-vilbert` with a Guesser,
+    without generating the dialogs again. The Guesser is `--load`, or the `guesser`
+    player of the config, and the dialogs are `data.dialogs_path` of the config.
+    '''
+    def load_data(self):
+        self.verbose(['Loading data...'])
+        tokenizer = self.load_tokenizer()
+        # Only the Guesser features are read, not those of QGen and the Oracle
+        img_feat_readers_gt = {'test': image_features_reader_gt(self.config['data']['features_path_gt']['test'])}
+        self.load_dataloader(
+            {'test': None}, img_feat_readers_gt, tokenizer, ['test'],
+            dataset_cls=GuesserDialogDataset, collate=guesser_collate_fn)
+        self.tokenizer = tokenizer
 
+    def fetch_data(self, data):
+        game, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser, bboxs_mask, label = data
+        # Guesser regions of the batch, as in SelfPlaySolver.fetch_data
+        num_bboxs = bboxs_mask.size(1)
+        if self.args.compile:
+            image_features_rcnn_gt_guesser = pad_to_bucket(image_features_rcnn_gt_guesser, 1, BBOX_BUCKETS, 0)
+            bboxs_rcnn_gt_guesser = pad_to_bucket(bboxs_rcnn_gt_guesser, 1, BBOX_BUCKETS, 0)
+            cats_guesser = pad_to_bucket(cats_guesser, 1, BBOX_BUCKETS, 0)
+            bboxs_mask = pad_to_bucket(bboxs_mask, 1, BBOX_BUCKETS, False)
+        return (
+            game,
+            image_features_rcnn_gt_guesser.to(self.device),
+            bboxs_rcnn_gt_guesser.to(self.device),
+            cats_guesser.to(self.device),
+            bboxs_mask.to(self.device),
+            label.to(self.device),
+            num_bboxs,
+        )
 
+    def set_model(self):
+        self.verbose(['Set model...'])
+        self.use_gt_question = False
+        self.config['model']['guesser']['num_wrds'] = len(self.tokenizer)
+        self.config['model']['guesser']['wrd_pad_id'] = self.tokenizer.pad_id
+        with torch.device('meta'):
+            # No random init, the weights are assigned from the file
+            self.model = GuesserModel(**self.config['model']['guesser'])
+        self.guesser_path = self.args.load or self.config['model']['guesser']['pretrained_path']
+        self.model.load_state_dict(load_weights(self.guesser_path), assign=True)
+        self.model.float()
+        if self.config['model']['guesser'].get('quantize', False):
+            assert self.device.type == 'cpu', "Dynamic int8 quantized players only run on CPU."
+            self.model = quantize_dynamic_int8(self.model)
+        self.model.to(self.device)
+        self.verbose(['Load guesser from %s' % self.guesser_path])
+        self.dialogs = DialogStore(self.config['data']['dialogs_path'])
+        self.verbose(['Load {} dialogs from {}'.format(len(self.dialogs), self.config['data']['dialogs_path'])])
 
-
-
-
-
-
-
-
+    def exec(self):
+        self.model.eval()
+        total_hit = 0
+        total_cnt = 0
+        out_name = self.exp_name + '_rescore.txt'
+        out_file = open(shard_path(out_name), 'w')
+        out_file.write('game_id|pred_obj|answer_obj\n')
+        for step, data in enumerate(self.test_set):
+            game, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser, bboxs_mask, label, \
+                num_bboxs = self.fetch_data(data)
+            for g in game:
+                assert g.id in self.dialogs, "Game %d is not in the saved dialogs." % g.id
+            qs, txt_attn_mask, answers, end_turn = self.dialogs.batch(
+                [g.id for g in game], self.tokenizer.sos_id, self.tokenizer.pad_id, self.device)
+            with torch.no_grad(), self.autocast():
+                pred = self.model.forward_dialog(
+                    qs, answers, end_turn, cats_guesser, image_features_rcnn_gt_guesser,
+                    bboxs_rcnn_gt_guesser, bboxs_mask=bboxs_mask, attention_mask=txt_attn_mask,
+                    image_attention_mask=bboxs_mask.long(),
+                    max_batch_size=self.config['data'].get('guesser_batch_size'),
+                    num_valid_bboxs=num_bboxs)
+            pred_obj, answer_obj = pred.argmax(dim=-1).tolist(), label.tolist()
+            for b in range(len(game)):
+                out_file.write("{}|{}|{}\n".format(game[b].id, pred_obj[b], answer_obj[b]))
+            total_hit += sum(p == l for p, l in zip(pred_obj, answer_obj))
+            total_cnt += len(game)
+            self.progress("Re-score stat. ({}/{}) |  Acc. - {:.3f}".format(
+                step, len(self.test_set), total_hit/float(total_cnt)))
+        out_file.close()
+        if self.distributed:
+            barrier()
+            if get_rank() == 0:
+                merge_shard_files(out_name, sort_key=lambda line: int(line.split('|')[0]))
+            barrier()
+        total_hit, total_cnt = all_reduce_sum([total_hit, total_cnt], self.device)
+        self.verbose(["Re-score stat. | Guesser - {} | Acc. - {:.3f}"
+                      .format(self.guesser_path, total_hit / float(total_cnt))])
@@ -6,11 +6,13 @@ import torch.nn as nn
 from functools import partial
 from matplotlib.image import imread
 from solver.solver import BaseSolver
-from solver.utils import human_format, cal_hit
+from solver.utils import human_format
+from solver.metrics import hits
 from torch.utils.data import DataLoader
 from src.model.self_play_qgen_vdst_guesser_vilbert import SelfPlayModel
 from src.tools.optimizer import Optimizer
 from src.tools.tokenizer import GW_Tokenizer, BERT_Tokenizer
+from src.tools.utils import load_vocab_shortlist
 from src.data.image_features_reader import numpyReader as image_features_reader
 from src.data.image_features_reader import h5FeatureReaderVilbert as image_features_reader_vb
 from src.data.image_features_reader import numpyReader as image_features_reader_gt
@@ -123,9 +125,19 @@ class SelfPlaySolver(BaseSolver):
             guesser_kwargs=self.config['model']['guesser']
             )
         # Load pretrained players
+        if any(self.config['model'][plyr].get('quantize', False) for plyr in players):
+            assert self.device.type == 'cpu', "Dynamic int8 quantized players only run on CPU."
+        shortlist = None
+        if 'qgen' in players and self.config['model']['qgen'].get('shortlist_path'):
+            shortlist = load_vocab_shortlist(
+                self.config['model']['qgen']['shortlist_path'], self.config['data']['dataroot'],
+                self.tokenizer, verbose=self.args.verbose)
+            self.verbose(['QGen generates from a shortlist of %d word pieces' % len(shortlist)])
         for plyr in players:
             log = self.model.load_player(
-                plyr, self.config['model'][plyr]['pretrained_path'], map_location="cpu")
+                plyr, self.config['model'][plyr]['pretrained_path'], map_location="cpu",
+                quantize=self.config['model'][plyr].get('quantize', False),
+                shortlist=shortlist if plyr == 'qgen' else None)
             self.verbose([log])
         self.model.to(self.device)
         self.optimizer = Optimizer(
@@ -160,36 +172,39 @@ class SelfPlaySolver(BaseSolver):
             human_format(self.steps_per_epoch))])
         while self.step < self.max_step:
             # Validate every epoch
-            self.validate(self.valid_set)
-            self.timer.set()
+            with self.telemetry.span('validation'):
+                self.validate(self.valid_set)
+            self.telemetry.start()
             for data in self.train_set:
+                self.telemetry.lap('data')
                 game, obj_feats, tgt_cat, tgt_bbox, tgt_img_feat, cats, bboxs, bboxs_mask, label, qs, q_len = self.fetch_data(data)
                 NOT_IMPLEMENT_YET()
-                self.timer.cnt('rd')
+                self.telemetry.lap('h2d')
                 # Forward
                 self.optimizer.pre_step(self.step)
                 pred = self.model(qgen_in, qgen_in_len, img_feat, mask=None)
                 loss = self.loss(pred.view(-1, pred.size(-1)), qgen_tgt.view(-1))
-                hit = cal_hit(pred, qgen_tgt)
-                acc = hit / float(qgen_tgt.size(0) * qgen_tgt.size(1))
-                hit_nopad = cal_hit(pred, qgen_tgt, pad_id=self.tokenizer.pad_id)
-                acc_nopad = hit_nopad / float(qgen_tgt.size(0) * qgen_tgt.size(1))
-                self.timer.cnt('fw')
+                self.train_metrics.update(
+                    loss=loss, hit=hits(pred, qgen_tgt), hit_nopad=hits(pred, qgen_tgt, self.tokenizer.pad_id),
+                    cnt=qgen_tgt.size(0) * qgen_tgt.size(1))
+                self.telemetry.lap('forward')
                 # Backward
                 grad_norm = self.backward(loss)
-                self.timer.cnt('bw')
+                self.telemetry.step(len(game))
 
                 self.step += 1
                 # Log
                 if (self.step == 1) or (self.step % self._progress_step == 0):
+                    stats, n_steps = self.train_metrics.read()
+                    acc, acc_nopad = stats['hit'] / stats['cnt'], stats['hit_nopad'] / stats['cnt']
                     self.progress("Tr stat. | Loss - {:.4f} | Acc.(pad/nopad) - {:.3f}/{:.3f} | Grad. norm - {:.2f} | {}".format(
-                        loss.item(), acc, acc_nopad, grad_norm, self.timer.show()))            
+                        stats['loss'] / n_steps, acc, acc_nopad, grad_norm, self.telemetry.report(self.step)))
                     self.write_log('scalars', 'accuracy', {'train': acc})
                     self.write_log('scalars', 'accuracy', {'train-nopad': acc_nopad})
-                    self.write_log('scalars', 'loss', {'train': loss})
+                    self.write_log('scalars', 'loss', {'train': stats['loss'] / n_steps})
 
                 # End of step
-                self.timer.set()
+                self.telemetry.lap('log')
                 if self.step > self.max_step:
                     self.verbose("Reach max training step.")
                     self.logger.close()
@@ -208,7 +223,7 @@ class SelfPlaySolver(BaseSolver):
             # game, obj_feats, tgt_cat, tgt_bbox, tgt_img_feat, cats, bboxs, bboxs_mask, label, qs, q_len = self.fetch_data(data)
             game, obj_feats, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, \
                 tgt_bbox_gw, tgt_cat, cats_guesser, bboxs_mask, label, qs, q_len = self.fetch_data(data)
-            with torch.no_grad(): 
+            with torch.no_grad(), self.autocast():
                 if self.use_gt_question:
                     raise NotImplementedError
 
@@ -11,6 +11,7 @@ from torch.utils.data import DataLoader
 from src.model.self_play_qgen_vilbert import SelfPlayModel
 from src.tools.optimizer import Optimizer
 from src.tools.tokenizer import GW_Tokenizer, BERT_Tokenizer
+from src.tools.utils import load_vocab_shortlist
 from src.data.image_features_reader import h5FeatureReaderVilbert as image_features_reader
 from src.data.self_play_qgen_vilbert import SelfPlayDataset, collate_fn
 
@@ -107,9 +108,19 @@ class SelfPlaySolver(BaseSolver):
             guesser_kwargs=self.config['model']['guesser']
             )
         # Load pretrained players
+        if any(self.config['model'][plyr].get('quantize', False) for plyr in players):
+            assert self.device.type == 'cpu', "Dynamic int8 quantized players only run on CPU."
+        shortlist = None
+        if 'qgen' in players and self.config['model']['qgen'].get('shortlist_path'):
+            shortlist = load_vocab_shortlist(
+                self.config['model']['qgen']['shortlist_path'], self.config['data']['dataroot'],
+                self.tokenizer, verbose=self.args.verbose)
+            self.verbose(['QGen generates from a shortlist of %d word pieces' % len(shortlist)])
         for plyr in players:
             log = self.model.load_player(
-                plyr, self.config['model'][plyr]['pretrained_path'], map_location="cpu")
+                plyr, self.config['model'][plyr]['pretrained_path'], map_location="cpu",
+                quantize=self.config['model'][plyr].get('quantize', False),
+                shortlist=shortlist if plyr == 'qgen' else None)
             self.verbose([log])
         self.model.to(self.device)
         self.optimizer = Optimizer(
@@ -151,7 +162,7 @@ class SelfPlaySolver(BaseSolver):
         
         for val_step, data in enumerate(specified_set):
             game, qgen_img_feats, qgen_bboxs, tgt_cat, tgt_bbox, cats, bboxs, bboxs_mask, label, qs, q_len = self.fetch_data(data)
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 pred, dialog, q_log, a_log, a_conf_log = self.model.play(
                     qgen_img_feats, qgen_bboxs, tgt_cat, tgt_bbox, cats, bboxs, bboxs_mask,
                     self.tokenizer.sos_id, self.tokenizer.pad_id, 
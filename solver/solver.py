@@ -4,17 +4,30 @@ import os
 import sys
 import abc
 import math
+import time
 import torch
+import contextlib
 from shutil import copyfile
 # from tensorboardX import SummaryWriter
 from torch.utils.tensorboard import SummaryWriter
+from torch.nn.parallel import DistributedDataParallel
 from datetime import datetime
-from solver.utils import Timer, human_format
+from solver.utils import human_format
+from solver.metrics import Metrics
+from solver.telemetry import Telemetry
+from src.tools.compile import TXT_BUCKETS, compile_vilbert, warmup_vilbert, num_compiled_graphs, \
+    num_cache_limit_hits
+from src.tools.checkpoint import CheckpointWriter, get_rng_state, set_rng_state
 
 INFO_MARK = "[INFO]"
 TB_FLUSH_FREQ = 180
 PROGRESS_STEP = 20
 CLIP_GRAD_NORM = 5.0
+PRECISIONS = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
 
 
 class BaseSolver(object):
@@ -39,18 +52,47 @@ class BaseSolver(object):
         print('self.logdir')
         print(self.logdir)
         self._clip_grad_norm = self.config['hparas'].get('clip_grad_norm', CLIP_GRAD_NORM)
+        # Batches (micro-batches) accumulated per optimizer step
+        self.grad_accum_steps = self.config['hparas'].get('grad_accum_steps', 1)
+        assert self.grad_accum_steps >= 1, "`grad_accum_steps` should be at least 1."
+        self._grad_norm = 0.0
         self._progress_step = PROGRESS_STEP
+        # Accuracy, number of samples and time of each evaluation, see `record_eval`
+        self.eval_log = []
+        # Mixed precision: autocast for forwards, loss scaling for fp16 backwards
+        self.precision = getattr(args, 'precision', 'fp32')
+        assert self.precision in PRECISIONS, \
+            "`precision` should be one of %s." % str(tuple(PRECISIONS))
+        assert not (self.precision == 'fp16' and self.device.type == 'cpu'), \
+            "fp16 autocast is only supported on GPU, use bf16 on CPU."
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.precision == 'fp16')
         self.mode = mode
         if mode == 'train':
             os.makedirs(self.ckptdir, exist_ok=True)
             copyfile(args.config, os.path.join(self.ckptdir, 'config.yaml'))
             self.logger = SummaryWriter(self.logdir, flush_secs=TB_FLUSH_FREQ)
-            self.timer = Timer()
+            # Rolling checkpoints (all but best.pth) kept on disk, null: all
+            self.ckpt_writer = CheckpointWriter(
+                keep_last=config['hparas'].get('keep_last_ckpts'), log=self.verbose)
+            # Batches between two last.pth checkpoints, 0: only checkpoint at validation
+            self.ckpt_every_steps = config['hparas'].get('ckpt_every_steps', 0)
+            assert self.ckpt_every_steps % self.grad_accum_steps == 0, \
+                "`ckpt_every_steps` should be a multiple of `grad_accum_steps`."
+            # Per-stage times, throughput and memory, written to TensorBoard and telemetry.jsonl
+            self.telemetry = Telemetry(
+                self.device,
+                sync=config['hparas'].get('telemetry_sync', False),
+                logger=self.logger if self.main_proc else None,
+                jsonl_path=os.path.join(self.logdir, 'telemetry.jsonl') if self.main_proc else None)
+            # Training losses and hits, read at the progress interval only
+            self.train_metrics = Metrics(self.device)
             # Hyperparameters
             self.step = 0
             self.max_epoch = config['hparas']['max_epoch']
 
         self.verbose(['Experiment: %s' % self.exp_name])
+        if self.precision != 'fp32':
+            self.verbose(['Run with %s autocast on %s' % (self.precision, self.device.type)])
 
     @abc.abstractmethod
     def load_data(self):
@@ -95,36 +137,171 @@ class BaseSolver(object):
     def _clean_line(self):
         sys.stdout.write("\033[K")
 
-    def save_checkpoint(self, filename, score):
+    def autocast(self):
+        '''
+        Context for running forwards in `self.precision`, no-op for fp32
+        '''
+        if self.precision == 'fp32':
+            return contextlib.ExitStack()
+        return torch.autocast(
+            device_type=self.device.type, dtype=PRECISIONS[self.precision])
+
+    def compile_model(self, warmup_shapes):
+        '''
+        Compile the ViLBERT trunks of self.model and warm them up for every text bucket
+            <list> warmup_shapes - (module, training, batch_size, num_bboxs, image_mask) to warm up
+        '''
+        n_compiled = compile_vilbert(self.model)
+        self.verbose(['Compiled %d ViLBERT trunk(s), warming up...' % n_compiled])
+        training = self.model.training
+        for module, train_mode, batch_size, num_bboxs, image_mask in warmup_shapes:
+            module.train(train_mode)
+            with torch.set_grad_enabled(train_mode), self.autocast():
+                warmup_vilbert(module, batch_size, num_bboxs, self.device, TXT_BUCKETS, image_mask)
+        self.model.train(training)
+        self.log_compile_stats()
+
+    def log_compile_stats(self):
+        '''
+        Report the number of compiled graphs, which grows with every recompile, and
+        warn when trunks fell back to eager mode after hitting the cache size limit
+        '''
+        if not getattr(self.args, 'compile', False):
+            return
+        n_graphs = num_compiled_graphs()
+        n_limit_hits = num_cache_limit_hits()
+        self.verbose('Compiled graphs: %d' % n_graphs)
+        if n_limit_hits > 0:
+            self.verbose('Dynamo cache size limit ({}) hit {} time(s), the trunks ran in eager mode for '
+                         'new shapes'.format(torch._dynamo.config.cache_size_limit, n_limit_hits))
+        if self.mode == 'train':
+            self.logger.add_scalars('compile', {'graphs': n_graphs, 'cache_limit_hits': n_limit_hits}, self.step)
+
+    def record_eval(self, acc, num_samples, start_time):
+        '''
+        Keep the results of an evaluation started at `start_time` (time.time()) in self.eval_log
+            <float> acc       - accuracy over all ranks
+            <int> num_samples - samples evaluated over all ranks
+        '''
+        elapsed = time.time() - start_time
+        self.eval_log.append({
+            'acc': float(acc), 'samples': int(num_samples), 'sec': elapsed,
+            'samples_per_sec': num_samples / max(elapsed, 1e-9)})
+
+    def save_checkpoint(self, filename, score=float('nan')):
         ''''
         Ckpt saver
-            <str> filename  - the name of ckpt file (w/o prefix) to store, overwrite if existed
+            <str/list> filename  - the name(s) of ckpt file (w/o prefix) to store, overwrite if existed
             <float> score - The value of metric used to evaluate model
         '''
-        ckpt_path = os.path.join(self.ckptdir, filename)
+        filenames = [filename] if isinstance(filename, str) else filename
+        ckpt_paths = [os.path.join(self.ckptdir, f) for f in filenames]
         full_dict = {
             #"model": self.model.module.state_dict() if self.distributed else self.model.state_dict(),
             "model": self.model.state_dict(),
             "optimizer": self.optimizer.get_opt_state_dict(),
             "global_step": self.step,
+            # Position in the epoch and random state, to resume where training stopped
+            "steps_per_epoch": getattr(self, "steps_per_epoch", None),
+            "rng": get_rng_state(),
+            "scaler": self.scaler.state_dict(),
         }
-        torch.save(full_dict, ckpt_path)
-        self.verbose("Saved checkpoint (step = {}, score = {:.4f}) and status @ {}".\
-                                       format(human_format(self.step), score, ckpt_path))
+        # Queued to a background thread, training only waits for the copy to CPU (and for
+        # earlier writes when several snapshots are already pending). Several names share
+        # one snapshot.
+        with self.telemetry.span('checkpoint'):
+            snapshot_time = self.ckpt_writer.save(
+                full_dict, ckpt_paths,
+                keep=[p for f, p in zip(filenames, ckpt_paths) if f in ('best.pth', 'last.pth')])
+        self.verbose("Saving checkpoint (step = {}, score = {:.4f}) and status @ {} (snapshot {:.1f}s)".\
+                                       format(human_format(self.step), score, ', '.join(ckpt_paths), snapshot_time))
+
+    def save_last(self):
+        '''
+        Checkpoint to last.pth every `ckpt_every_steps` batches, call after each step
+        '''
+        if self.ckpt_every_steps and self.step % self.ckpt_every_steps == 0 and self.main_proc:
+            self.save_checkpoint('last.pth')
 
-    def backward(self, loss):
+    def load_train_state(self, ckpt):
         '''
-        Standard backward step with self.timer and debugger
+        Restore the random state and loss scale of a checkpoint, self.step is set by the caller
+        '''
+        if 'rng' in ckpt:
+            set_rng_state(ckpt['rng'])
+        if 'scaler' in ckpt:
+            self.scaler.load_state_dict(ckpt['scaler'])
+        if ckpt.get('steps_per_epoch', self.steps_per_epoch) != self.steps_per_epoch:
+            self.verbose('Warning : {} steps per epoch in the checkpoint, {} now, the epoch order changes'.format(
+                ckpt['steps_per_epoch'], self.steps_per_epoch))
+
+    def begin_epoch(self):
+        '''
+        Shuffle self.train_sampler (a `ResumableSampler`) for the epoch of self.step and
+        skip the batches of the epoch done before a resume, so they are not even loaded
+        return: epoch
+        '''
+        epoch, batch = divmod(self.step, self.steps_per_epoch)
+        self.train_sampler.set_epoch(epoch)
+        self.train_sampler.set_start(batch * self.train_set.batch_size)
+        if batch > 0:
+            self.verbose('Resume epoch {} at batch {}/{}'.format(epoch, batch, self.steps_per_epoch))
+        return epoch
+
+    def data_parallel(self, model):
+        '''
+        Wrap a model in torch DistributedDataParallel, which averages gradients over
+        the ranks with the backend of the process group (gloo or nccl)
+            <nn.Module> model - model on self.device
+        '''
+        kwargs = dict()
+        bucket_cap_mb = self.config['hparas'].get('ddp_bucket_cap_mb')
+        if bucket_cap_mb is not None:
+            kwargs['bucket_cap_mb'] = bucket_cap_mb
+        if self.device.type == 'cuda':
+            kwargs.update(device_ids=[self.device.index], output_device=self.device.index)
+        return DistributedDataParallel(
+            model,
+            find_unused_parameters=self.config['hparas'].get('ddp_find_unused_parameters', True),
+            gradient_as_bucket_view=True,
+            **kwargs)
+
+    def grad_sync(self, model, sync=True):
+        '''
+        Context for a backward of `model`, which skips the gradient all-reduce when not `sync`
+        (e.g. all but the last accumulated micro-batch), no-op when not distributed
+        '''
+        if isinstance(model, DistributedDataParallel) and not sync:
+            return model.no_sync()
+        return contextlib.ExitStack()
+
+    def backward(self, loss, model=None):
+        '''
+        Standard backward step with self.telemetry and debugger. With `grad_accum_steps` > 1,
+        gradients of self.step's batch are accumulated and the optimizer only steps
+        (after clipping the accumulated gradients) on the last batch of each group.
             <torch> loss - the loss to perform loss.backward()
+            <nn.Module> model - model the loss was computed with, default: self.model
+        return: gradient norm of the last optimizer step
         '''
-        self.timer.set()
-        loss.backward()
-        grad_norm = torch.nn.utils.clip_grad_norm_(
-            self.model.parameters(), self._clip_grad_norm)
-        if math.isnan(grad_norm):
-            self.verbose('Error : grad norm is NaN @ step ' + str(self.step))
-        else:
-            self.optimizer.step()
+        model = self.model if model is None else model
+        sync = (self.step + 1) % self.grad_accum_steps == 0
+        # Scaling is a no-op unless running with fp16; the mean over the group of
+        # batches is the loss of the effective batch
+        with self.telemetry.span('backward'), self.grad_sync(model, sync):
+            self.scaler.scale(loss / self.grad_accum_steps).backward()
+        if not sync:
+            return self._grad_norm
+        with self.telemetry.span('optimizer'):
+            self.scaler.unscale_(self.optimizer.opt)
+            grad_norm = torch.nn.utils.clip_grad_norm_(
+                self.model.parameters(), self._clip_grad_norm)
+            if math.isnan(grad_norm):
+                self.verbose('Error : grad norm is NaN @ step ' + str(self.step))
+            else:
+                self.scaler.step(self.optimizer.opt)
+            self.scaler.update()
+        self._grad_norm = grad_norm
         return grad_norm
 
     def write_log(self, log_type, name, vals):
@@ -0,0 +1,166 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import os
+import json
+import time
+import resource
+import contextlib
+import torch
+from solver.metrics import Metrics
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, q):
+    ''' Nearest-rank q-th percentile of a non-empty list '''
+    values = sorted(values)
+    rank = max(1, int(round(q / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def peak_memory_mb(device):
+    '''
+    Peak memory (MB) allocated by tensors on a cuda `device` since the last call,
+    peak resident memory of the process on CPU
+    '''
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        return peak / 2**20
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def resident_memory_mb():
+    ''' Current resident memory (MB) of the process, peak resident memory if unavailable '''
+    try:
+        with open('/proc/self/statm') as f:
+            n_pages = int(f.read().split()[1])
+        return n_pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class Telemetry(object):
+    '''
+    Time spent in the named stages of training, replacing the previous Timer.
+    Stages are either spans (`with telemetry.span('checkpoint'):`), or laps
+    (`telemetry.lap('forward')`: time since the end of the previous stage) for
+    stages that cannot be wrapped, e.g. waiting for the next batch of a DataLoader.
+    Stages inside a span are named after it, e.g. 'validation/checkpoint'.
+    `step` counts samples and tokens, `report` summarizes the steps since the
+    previous report into TensorBoard and a JSONL file.
+        <torch.device> device - device the stages run on
+        <bool> sync           - synchronize a cuda device at stage boundaries, so
+                                stages are charged with their kernels (slower);
+                                otherwise only host time is measured
+        <SummaryWriter> logger - TensorBoard writer, None: do not write
+        <str> jsonl_path      - file to append one summary per line to, None: do not write
+    '''
+    def __init__(self, device, sync=False, logger=None, jsonl_path=None):
+        self.device = device
+        self.sync = sync and device.type == 'cuda'
+        self.logger = logger
+        self.jsonl_path = jsonl_path
+        self.stack = []
+        # Samples and tokens are summed on the device like training metrics
+        self.counts = Metrics(device)
+        self.clear()
+        self.start()
+
+    def clear(self):
+        self.time_table = dict()
+        self.latencies = []
+        self.window_start = time.time()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        return time.time()
+
+    def _add(self, name, seconds):
+        name = '/'.join(self.stack + [name])
+        self.time_table[name] = self.time_table.get(name, 0) + seconds
+
+    def start(self):
+        ''' Restart the lap and step clocks, e.g. when training resumes after validation '''
+        self.prev_t = self.step_t = self._now()
+
+    def lap(self, name):
+        ''' Charge the time since the end of the previous stage to `name` '''
+        now = self._now()
+        self._add(name, now - self.prev_t)
+        self.prev_t = now
+
+    @contextlib.contextmanager
+    def span(self, name):
+        ''' Charge the time spent in the context to `name` '''
+        start = self._now()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            self.prev_t = self._now()
+            self._add(name, self.prev_t - start)
+
+    def step(self, samples, tokens=None):
+        '''
+        End of a training step over `samples` samples (and `tokens` tokens)
+            <int/torch> samples, tokens - numbers or device tensors
+        '''
+        now = time.time()
+        self.latencies.append(now - self.step_t)
+        self.step_t = now
+        if tokens is None:
+            self.counts.update(samples=samples)
+        else:
+            self.counts.update(samples=samples, tokens=tokens)
+
+    def summary(self):
+        ''' Stats of the steps since the previous summary, resets them '''
+        elapsed = max(time.time() - self.window_start, 1e-9)
+        counts, n_steps = self.counts.read()
+        summary = {
+            'steps': n_steps,
+            'samples_per_sec': counts.get('samples', 0) / elapsed,
+            'tokens_per_sec': counts.get('tokens', 0) / elapsed,
+            'peak_memory_mb': peak_memory_mb(self.device),
+            'span_sec': dict(self.time_table),
+        }
+        if self.latencies:
+            summary['step_latency_ms'] = {
+                'p%d' % q: 1000 * percentile(self.latencies, q) for q in PERCENTILES}
+            summary['sec_per_step'] = sum(self.latencies) / len(self.latencies)
+        self.clear()
+        return summary
+
+    def report(self, step):
+        '''
+        Summarize the steps since the previous report, write it to TensorBoard
+        and the JSONL file at `step`
+        return: one line message for the progress bar
+        '''
+        summary = self.summary()
+        if self.logger is not None:
+            self.logger.add_scalars('telemetry/span_sec', summary['span_sec'], step)
+            self.logger.add_scalars('telemetry/throughput', {
+                'samples_per_sec': summary['samples_per_sec'],
+                'tokens_per_sec': summary['tokens_per_sec']}, step)
+            self.logger.add_scalars('telemetry/step_latency_ms', summary.get('step_latency_ms', {}), step)
+            self.logger.add_scalar('telemetry/peak_memory_mb', summary['peak_memory_mb'], step)
+        if self.jsonl_path is not None:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(dict(step=step, time=time.time(), **summary)) + '\n')
+        return self.show(summary)
+
+    def show(self, summary):
+        total_time = max(sum(t for k, t in summary['span_sec'].items() if '/' not in k), 1e-9)
+        stages = ' | '.join('{} {:.1f}%'.format(k, 100 * t / total_time)
+                            for k, t in summary['span_sec'].items() if '/' not in k)
+        msg = '{:.3f} sec/step, p90 {:.0f}ms | {:.1f} samples/s'.format(
+            summary.get('sec_per_step', 0), summary.get('step_latency_ms', {}).get('p90', 0),
+            summary['samples_per_sec'])
+        if summary['tokens_per_sec']:
+            msg += ' | {:.0f} tokens/s'.format(summary['tokens_per_sec'])
+        return '{} | {:.0f}MB ({})'.format(msg, summary['peak_memory_mb'], stages)
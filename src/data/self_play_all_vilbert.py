@@ -90,6 +90,13 @@ class SelfPlayDataset(GuessWhatDataset):
             # entry['qgen_image_features'] = torch.from_numpy(np.array(entry['qgen_image_features']))
             # entry['qgen_bboxs'] = torch.from_numpy(np.array(entry['qgen_bboxs']))
 
+    def _guesser_inputs(self, image_features_rcnn_gt, entry):
+        ''' Guesser region features, boxes and categories, with the global image region first '''
+        image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser = add_global_vilbert_feats(
+            image_features_rcnn_gt.float(), entry['bboxs_gt_vb'].float(), input_torch=True)
+        cats_guesser = torch.cat([torch.LongTensor([99]) , entry['categories']], dim=0)
+        return image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser
+
     def __getitem__(self, index):
         entry = self.entries[index]
         #image_id = entry['image_id']
@@ -126,9 +133,8 @@ class SelfPlayDataset(GuessWhatDataset):
         label = torch.LongTensor([tgt_index])
 
         # Add global information (visual side)
-        image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser = add_global_vilbert_feats(
-            image_features_rcnn_gt.float(), bboxs_gt_vb.float(), input_torch=True)
-        cats_guesser = torch.cat([torch.LongTensor([99]) , cats], dim=0)
+        image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser = self._guesser_inputs(
+            image_features_rcnn_gt, entry)
         qs = entry['qs']
         # q_len = entry['q_len']
 
@@ -153,6 +159,33 @@ class SelfPlayDataset(GuessWhatDataset):
         )
 
 
+class GuesserDialogDataset(SelfPlayDataset):
+    '''
+    Games of `SelfPlayDataset` with the Guesser inputs only, to re-score saved dialogs:
+    the QGen and Oracle image features are not read (`image_features_reader` may be None).
+    '''
+    def __getitem__(self, index):
+        entry = self.entries[index]
+        feats, _, _ = self._image_features_reader_gt[entry['image_id']]
+        image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser = self._guesser_inputs(
+            torch.from_numpy(np.array(feats)), entry)
+        label = torch.LongTensor([entry['target_index']])
+        return entry['game'], image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser, label
+
+
+def guesser_collate_fn(batch):
+    ''' Batch of `GuesserDialogDataset` items, regions padded as in `collate_fn` '''
+    game, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser, label = zip(*batch)
+    # (batch_size, padded_num_obj)
+    cats_guesser = pad_sequence(cats_guesser, batch_first=True).long()
+    bboxs_mask = [torch.ones(len(xs)) for xs in bboxs_rcnn_gt_guesser]
+    bboxs_mask = pad_sequence(bboxs_mask, batch_first=True).bool()
+    label = torch.stack(label).view(-1)
+    image_features_rcnn_gt_guesser = pad_sequence(image_features_rcnn_gt_guesser, batch_first=True).float()
+    bboxs_rcnn_gt_guesser = pad_sequence(bboxs_rcnn_gt_guesser, batch_first=True).float()
+    return game, image_features_rcnn_gt_guesser, bboxs_rcnn_gt_guesser, cats_guesser, bboxs_mask, label
+
+
 def collate_fn(batch, wrd_pad_id):
     batch_size = len(batch)
     # batch
@@ -47,8 +47,15 @@ class GuesserModel(nn.Module):
         mismatch = self.load_state_dict(ckpt, strict=False)
         return mismatch
 
-    def init_state(self, batch_size, num_bboxs, device):
-        return torch.ones(batch_size, num_bboxs).to(device) / num_bboxs
+    def init_state(self, batch_size, num_bboxs, device, num_valid_bboxs=None):
+        '''
+        Uniform state over the first `num_valid_bboxs` regions (default: all), zero over
+        the rest, e.g. regions only added to pad the batch to a compile bucket
+        '''
+        num_valid_bboxs = num_bboxs if num_valid_bboxs is None else num_valid_bboxs
+        state = torch.zeros(batch_size, num_bboxs).to(device)
+        state[:, :num_valid_bboxs] = 1. / num_valid_bboxs
+        return state
 
     def compute_next_state(
         self, curr_state, seq_out_vis, sent_feat, ans_emb, cats_emb, bboxs_mask=None):
@@ -91,6 +98,7 @@ class GuesserModel(nn.Module):
         output_all_encoded_layers=False,
         output_all_attention_masks=False,
         update_vilbert=True,
+        num_valid_bboxs=None,
         ):
         if update_vilbert:
             seq_out_txt, seq_out_vis, pooled_out_txt, pooled_out_vis, _ = self.bert(
@@ -124,11 +132,15 @@ class GuesserModel(nn.Module):
         cats = self.cat_embed(cats) if self.use_category else None
         if curr_state is None:
             curr_state = self.init_state(
-                img_feats.size(0), img_feats.size(1), img_feats.device)
+                img_feats.size(0), img_feats.size(1), img_feats.device, num_valid_bboxs)
         stat, logits = self.compute_next_state(
             curr_state, seq_out_vis, pooled_out_txt, ans, cats, bboxs_mask)
         return stat, logits
 
+    def forward(self, *inputs, **kwargs):
+        ''' `forward_session`, the forward data-parallel wrappers go through '''
+        return self.forward_session(*inputs, **kwargs)
+
     def forward_session(
         self, 
         qs, 
@@ -148,10 +160,11 @@ class GuesserModel(nn.Module):
         output_all_attention_masks=False,
         update_vilbert=True,
         return_state_history=False,
+        num_valid_bboxs=None,
         ):
 
         stat = self.init_state(
-            img_feats.size(0), img_feats.size(1), img_feats.device)
+            img_feats.size(0), img_feats.size(1), img_feats.device, num_valid_bboxs)
         batch_size = qs.size(0)
         max_turns = qs.size(1)
         
@@ -175,7 +188,7 @@ class GuesserModel(nn.Module):
                 update_vilbert=update_vilbert,
                 )
             end = end_turn == t
-            final_logits[end] = logits[end]
+            final_logits[end] = logits[end].type_as(final_logits)
             stat = next_stat
             stat_his.append(stat)
         
@@ -186,3 +199,66 @@ class GuesserModel(nn.Module):
             # First one is for global feat.
             return final_logits[:, 1:]
         
+
+    def forward_dialog(
+        self, 
+        qs, 
+        ans, 
+        end_turn,
+        cats, 
+        img_feats,
+        bboxs, 
+        bboxs_mask=None,
+        attention_mask=None,
+        image_attention_mask=None,
+        max_batch_size=None,
+        num_valid_bboxs=None,
+        ):
+        """
+        `forward_session` for inference: the ViLBERT forwards of all turns up to
+        `end_turn` run as one (batch x turns) batch, or chunks of `max_batch_size`
+        turns, and only the state update goes turn by turn.
+            num_valid_bboxs: regions of the batch before padding to a compile bucket,
+                             see `init_state`
+        """
+        batch_size = qs.size(0)
+        max_turns = qs.size(1)
+        asked = torch.arange(max_turns, device=qs.device).unsqueeze(0) <= end_turn.unsqueeze(1)
+        b_idx, t_idx = asked.nonzero(as_tuple=True)
+        stat = self.init_state(
+            img_feats.size(0), img_feats.size(1), img_feats.device, num_valid_bboxs)
+        final_logits = torch.zeros_like(stat)
+        if b_idx.size(0) == 0:
+            return final_logits[:, 1:]
+
+        chunk_size = max_batch_size or b_idx.size(0)
+        seq_out_vis, pooled_out_txt = [], []
+        for i in range(0, b_idx.size(0), chunk_size):
+            b, t = b_idx[i:i+chunk_size], t_idx[i:i+chunk_size]
+            _, _seq_out_vis, _pooled_out_txt, _, _ = self.bert(
+                qs[b, t],
+                img_feats[b],
+                bboxs[b],
+                None,
+                attention_mask[b, t] if attention_mask is not None else None,
+                image_attention_mask[b] if image_attention_mask is not None else None,
+            )
+            seq_out_vis.append(_seq_out_vis)
+            pooled_out_txt.append(_pooled_out_txt)
+        seq_out_vis, pooled_out_txt = torch.cat(seq_out_vis), torch.cat(pooled_out_txt)
+        # (batch_size, max_turns, ...), zeros for turns after `end_turn`
+        _seq_out_vis = seq_out_vis.new_zeros((batch_size, max_turns) + seq_out_vis.shape[1:])
+        _seq_out_vis[b_idx, t_idx] = seq_out_vis
+        _pooled_out_txt = pooled_out_txt.new_zeros((batch_size, max_turns) + pooled_out_txt.shape[1:])
+        _pooled_out_txt[b_idx, t_idx] = pooled_out_txt
+
+        ans = self.ans_embed(ans)
+        cats = self.cat_embed(cats) if self.use_category else None
+        for t in range(max_turns):
+            next_stat, logits = self.compute_next_state(
+                stat, _seq_out_vis[:, t], _pooled_out_txt[:, t], ans[:, t], cats, bboxs_mask)
+            end = end_turn == t
+            final_logits[end] = logits[end].type_as(final_logits)
+            stat = next_stat
+        # First one is for global feat.
+        return final_logits[:, 1:]
@@ -102,7 +102,7 @@ class QGenModel(nn.Module):
             
             updated_indices = torch.logical_not(finished).nonzero().view(-1)
             actual_length[updated_indices] = actual_length[updated_indices] + 1
-            last_state[:, :, updated_indices] = state[:, :, updated_indices]
+            last_state[:, :, updated_indices] = state[:, :, updated_indices].type_as(last_state)
             last_wrd[updated_indices] = q_t[updated_indices]
             # _q_tokens.append(last_wrd) # Bad because this "last_wrd" will be altered in-place
             _q_tokens.append(q_t)
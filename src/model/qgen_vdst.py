@@ -4,9 +4,13 @@ import math
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pad_sequence
+from src.model.utils import osda_glimpse_logits, osda_hard_diff, decode_candidates
 
 
 class QGenModel(nn.Module):
+    # `attn_glimpse` weights are read directly by the closed-form OsDA
+    quantize_skip = ('attn_glimpse',)
+
     def __init__(
         self,
         num_wrds,
@@ -70,6 +74,10 @@ class QGenModel(nn.Module):
             self.ans_proj = nn.Linear(wrd_embed_size, lstm_hidden_size)
         self.proj = nn.Linear(lstm_hidden_size, num_wrds)
         self.softmax = nn.Softmax(dim=-1)
+        # Word pieces allowed in generated questions, see `set_shortlist`
+        self.register_buffer('shortlist', None, persistent=False)
+        self.register_buffer('shortlist_weight', None, persistent=False)
+        self.register_buffer('shortlist_bias', None, persistent=False)
         # TODO: Make no sense
         self.pi_obj_proj = nn.Linear(wrd_embed_size, wrd_embed_size)
         self.pi_wrd_proj = nn.Linear(2 * wrd_embed_size, wrd_embed_size)
@@ -116,11 +124,8 @@ class QGenModel(nn.Module):
         obj_feat_dim = obj_repr.size(-1)
 
         # Object-self Difference Attention (OsDA)
-        # (batch_size, num_bboxs, num_bboxs, obj_feat_dim)
-        diff = obj_repr.view(-1, num_bboxs, 1, obj_feat_dim) -\
-                obj_repr.view(-1, 1, num_bboxs, obj_feat_dim)
-        diff = obj_repr.unsqueeze(2) * diff
-        diff = diff.view(-1, num_bboxs, num_bboxs * obj_feat_dim)
+        # The (batch_size, num_bboxs, num_bboxs, obj_feat_dim) difference
+        # tensor is never materialised, see `src.model.utils`.
 
         if self.see_one_region_per_q:
             picked_idx = pi.argmax(dim=-1)
@@ -130,15 +135,13 @@ class QGenModel(nn.Module):
             # obj_repr_hard: (batch_size, obj_feat_dim)
             obj_repr_hard = (obj_repr * pi_hard.unsqueeze(-1)).sum(dim=1)
 
-            # diff:      (batch_size, num_bboxs, num_bboxs * obj_feat_dim)
-            # diff_hard: (batch_size, num_bboxs * obj_feat_dim)
-            diff_hard = (diff * pi_hard.unsqueeze(-1)).sum(dim=1).reshape(-1, num_bboxs, obj_feat_dim)
-            vis_repr = diff_hard.sum(dim=1)
+            # vis_repr: (batch_size, obj_feat_dim)
+            vis_repr = osda_hard_diff(obj_repr, pi_hard)
             vis_repr = self.post_mlp(torch.cat([obj_repr_hard, vis_repr], dim=-1))
             weight = pi_hard
         elif self.use_osda_glimpse:
             # (batch_size, num_bboxs, num_glimpses)
-            logits = self.attn_glimpse[0](diff)
+            logits = osda_glimpse_logits(obj_repr, self.attn_glimpse[0])
             if bboxs_mask is not None:
                 bboxs_mask = bboxs_mask.unsqueeze(-1).repeat(1, 1, self.num_glimpses)
                 logits[~bboxs_mask] = -1e10
@@ -224,7 +227,7 @@ class QGenModel(nn.Module):
             not_finished = question_len[:, t] != 0
             if self.keep_lstm_state:
                 last_state = last_state.clone()
-                last_state[:, :, not_finished] = state[:, :, not_finished]
+                last_state[:, :, not_finished] = state[:, :, not_finished].type_as(last_state)
             # last_state = state
             result_logits.append(logits)
             # update pi
@@ -233,11 +236,27 @@ class QGenModel(nn.Module):
                 entropy[not_finished] = 0.95 * entropy[not_finished] + torch.distributions.Categorical(probs=pi).entropy()[not_finished].sum()
                 if end_turn is not None:
                     end = t == end_turn
-                    final_pi_logits[end] = pi_logits[end]
+                    final_pi_logits[end] = pi_logits[end].type_as(final_pi_logits)
         
         result_logits = torch.stack(result_logits).transpose(0, 1) 
         return result_logits, final_pi_logits, entropy.sum()
 
+    def set_shortlist(self, token_ids):
+        """
+        Generate questions from `token_ids` only, or from the full vocabulary
+        if None. The rows of `proj` are copied, so call it after loading the
+        weights (and before quantizing them).
+        """
+        if token_ids is None:
+            self.shortlist = self.shortlist_weight = self.shortlist_bias = None
+            return
+        assert isinstance(self.proj.weight, torch.Tensor), \
+            "Set the shortlist before quantizing `proj`."
+        shortlist = torch.tensor(sorted(set(token_ids))).long().to(self.proj.weight.device)
+        self.shortlist = shortlist
+        self.shortlist_weight = self.proj.weight.detach()[shortlist].clone()
+        self.shortlist_bias = self.proj.bias.detach()[shortlist].clone()
+
     # w/o teacher forcing
     def generate_word(self, wrd, vis_repr, state):
         batch_size = wrd.size(0)
@@ -246,8 +265,12 @@ class QGenModel(nn.Module):
         lstm_input = torch.cat([wrd_embed, vis_repr], dim=-1).unsqueeze(1)
         lstm_hidden, state = self.lstm(lstm_input, tuple(state))        
         lstm_hidden = lstm_hidden.view(batch_size, -1)
-        # (batch_size, num_wrds)
-        logit = self.proj(lstm_hidden)
+        if self.shortlist is None:
+            # (batch_size, num_wrds)
+            logit = self.proj(lstm_hidden)
+        else:
+            # (batch_size, len(shortlist)), index with `self.shortlist` to get word ids
+            logit = nn.functional.linear(lstm_hidden, self.shortlist_weight, self.shortlist_bias)
         # (2, ...)
         state = torch.stack(state)
         return logit, state
@@ -255,7 +278,7 @@ class QGenModel(nn.Module):
     # w/o teacher forcing
     def generate_sentence(
         self, last_wrd, obj_feats, eoq_token, eod_token, end_of_dialog, 
-        max_q_len, pi=None, last_state=None, greedy=True, bboxs_mask=None):
+        max_q_len, pi=None, last_state=None, greedy=True, bboxs_mask=None, pad_token=0, sync_every=4):
         last_wrd = last_wrd.clone()
         batch_size = last_wrd.size(0)
         device = last_wrd.device
@@ -282,33 +305,70 @@ class QGenModel(nn.Module):
         obj_repr = init_obj_repr * pi.unsqueeze(-1)
         vis_repr, weight = self.self_diff_attention(obj_repr, pi, bboxs_mask)
         
-        _q_tokens = []
+        # Fixed-shape decoding: finished questions are masked out with `torch.where`
+        # instead of indexing, and the all-finished check (a host sync) only runs
+        # every `sync_every` steps. Steps after every question has finished are
+        # no-ops, so the outputs match stopping right away. Sampling checks every
+        # step, as extra `torch.multinomial` calls would shift the random stream.
+        if not greedy:
+            sync_every = 1
+        running = torch.ones((), dtype=torch.bool, device=device)
+        q_tokens = torch.full((batch_size, max_q_len), pad_token, dtype=torch.long, device=device)
         for t in range(max_q_len):
             logit, state = self.generate_word(last_wrd, vis_repr, last_state)
             if greedy:
                 q_t = logit.argmax(dim=-1)
             else:
                 q_t = torch.multinomial(self.softmax(logit), 1).view(-1)
-            
+            if self.shortlist is not None:
+                q_t = self.shortlist[q_t]
+
             # Only update those not finished
-            updated_indices = torch.logical_not(finished).nonzero().view(-1)
-            actual_length[updated_indices] = actual_length[updated_indices] + 1
-            last_state[:, :, updated_indices] = state[:, :, updated_indices]
-            last_wrd[updated_indices] = q_t[updated_indices]
-            # _q_tokens.append(last_wrd) # Bad because this "last_wrd" will be altered in-place
-            _q_tokens.append(q_t)
+            updated = torch.logical_not(finished) & running
+            actual_length = actual_length + updated.long()
+            last_state = torch.where(
+                updated.view(1, 1, -1, 1), state.type_as(last_state), last_state)
+            last_wrd = torch.where(updated, q_t, last_wrd)
+            q_tokens[:, t] = torch.where(updated, q_t, q_tokens[:, t])
+
             # Update finished flags
-            new_end_of_question = (q_t == eoq_token)
-            new_end_of_dialog = (q_t == eod_token)
-            new_finished_indices = (new_end_of_question | new_end_of_dialog).nonzero().view(-1)
-            finished[new_finished_indices] = 1
+            new_end_of_question = (q_t == eoq_token) & running
+            new_end_of_dialog = (q_t == eod_token) & running
+            finished = finished | new_end_of_question | new_end_of_dialog
             end_of_dialog = end_of_dialog | new_end_of_dialog
-            if finished.sum() == batch_size:
+            running = running & torch.logical_not(finished.all())
+            if (t + 1) % sync_every == 0 and not running.item():
                 # all finished
                 break
 
-        _q_tokens = torch.stack(_q_tokens).transpose(0, 1)
-        q_tokens = []
-        for _q_tok, act_len in zip(_q_tokens, actual_length):
-            q_tokens.append(_q_tok[:act_len])
+        # (batch_size, max_q_len), padded with `pad_token` after `actual_length`
         return q_tokens, actual_length, last_state, obj_repr, end_of_dialog
+
+    # w/o teacher forcing, `num_candidates` questions per dialog
+    def generate_candidates(
+        self, last_wrd, obj_feats, eoq_token, eod_token, end_of_dialog,
+        max_q_len, num_candidates, pi=None, last_state=None, beam=True, length_penalty=1.0,
+        bboxs_mask=None, pad_token=0, sync_every=4):
+        """
+        Beam search (beam=True) or independent sampling of `num_candidates` questions,
+        see `src.model.utils.decode_candidates` for the outputs.
+        """
+        batch_size = last_wrd.size(0)
+        device = last_wrd.device
+        if last_state is None:
+            last_state = torch.zeros(2, 1, batch_size, self.lstm_hidden_size).to(device)
+        if pi is None:
+            pi = torch.ones(batch_size, self.num_bboxs).to(device)
+            true_num_bboxs = self.num_bboxs
+            if bboxs_mask is not None:
+                pi[~bboxs_mask] = 0
+                true_num_bboxs = bboxs_mask.sum(dim=-1).unsqueeze(1)
+            pi = (pi / true_num_bboxs)
+
+        # UoDR + OsDA
+        obj_repr = self.img_mlp(obj_feats) * pi.unsqueeze(-1)
+        vis_repr, _ = self.self_diff_attention(obj_repr, pi, bboxs_mask)
+        return decode_candidates(
+            self, last_wrd, vis_repr, last_state, end_of_dialog, eoq_token, eod_token, max_q_len,
+            num_candidates, beam=beam, length_penalty=length_penalty, pad_token=pad_token,
+            sync_every=sync_every)
@@ -4,11 +4,15 @@ import math
 import torch
 import torch.nn as nn
 from torch.nn.utils.rnn import pad_sequence
+from src.model.utils import osda_glimpse_logits, osda_hard_diff, chunked_cross_entropy, decode_candidates
 # from src.model.guesser_vilbert import GuesserModel
 from src.model.vilbert.vilbert import BertConfig, BertModel
 
 
 class QGenModel(nn.Module):
+    # `attn_glimpse` weights are read directly by the closed-form OsDA
+    quantize_skip = ('attn_glimpse',)
+
     def __init__(
         self,
         num_wrds,
@@ -63,16 +67,17 @@ class QGenModel(nn.Module):
             self.ans_proj = nn.Linear(wrd_embed_size, lstm_hidden_size)
         self.proj = nn.Linear(lstm_hidden_size, num_wrds)
         self.softmax = nn.Softmax(dim=-1)
+        # Word pieces allowed in generated questions, see `set_shortlist`
+        self.register_buffer('shortlist', None, persistent=False)
+        self.register_buffer('shortlist_weight', None, persistent=False)
+        self.register_buffer('shortlist_bias', None, persistent=False)
 
     def self_diff_attention(self, obj_repr, pi):
         num_bboxs = obj_repr.size(1)
         obj_feat_dim = obj_repr.size(-1)
         # Object-self Difference Attention (OsDA)
-        # (batch_size, num_bboxs, num_bboxs, obj_feat_dim)
-        diff = obj_repr.view(-1, num_bboxs, 1, obj_feat_dim) -\
-                obj_repr.view(-1, 1, num_bboxs, obj_feat_dim)
-        diff = obj_repr.unsqueeze(2) * diff
-        diff = diff.view(-1, num_bboxs, num_bboxs * obj_feat_dim)
+        # The (batch_size, num_bboxs, num_bboxs, obj_feat_dim) difference
+        # tensor is never materialised, see `src.model.utils`.
 
         if self.see_one_region_per_q:
             picked_idx = pi.argmax(dim=-1)
@@ -82,15 +87,14 @@ class QGenModel(nn.Module):
             # obj_repr_hard: (batch_size, obj_feat_dim)
             obj_repr_hard = (obj_repr * pi_hard.unsqueeze(-1)).sum(dim=1)
 
-            # diff:      (batch_size, num_bboxs, num_bboxs * obj_feat_dim)
-            # diff_hard: (batch_size, num_bboxs * obj_feat_dim)
-            diff_hard = (diff * pi_hard.unsqueeze(-1)).sum(dim=1).reshape(-1, num_bboxs, obj_feat_dim)
-            vis_repr = diff_hard.sum(dim=1)
+            # vis_repr: (batch_size, obj_feat_dim)
+            vis_repr = osda_hard_diff(obj_repr, pi_hard)
             vis_repr = self.post_mlp(torch.cat([obj_repr_hard, vis_repr], dim=-1))
             weight = pi_hard
         elif self.use_osda_glimpse:
             # (batch_size, num_glimpses, num_bboxs)
-            weight = self.attn_glimpse(diff).transpose(1, 2)
+            logits = osda_glimpse_logits(obj_repr, self.attn_glimpse[0])
+            weight = self.attn_glimpse[1](logits).transpose(1, 2)
             vis_repr = torch.bmm(weight, obj_repr)
             vis_repr = vis_repr.view(-1, self.num_glimpses * obj_feat_dim)
         else:
@@ -121,10 +125,13 @@ class QGenModel(nn.Module):
 
     # Forward w/ teacher forcing 
     def forward(
-        self, qs, qs_tf_in, question_len, answers, img_feats, bboxs, txt_attn_mask, end_turn, pi=None, update_vilbert=False):
+        self, qs, qs_tf_in, question_len, answers, img_feats, bboxs, txt_attn_mask, end_turn, pi=None, update_vilbert=False,
+        loss_chunk_size=0):
         # qs (an example in batch):       [[<sos>, is, it, a, dog, ?], ...]
         # q_len (an example in batch):    [5 (no <sos>), ...]
         # qs_tf_in (an example in batch): [[<sos>, is, it, a, dog], ...]
+        # loss_chunk_size > 0: return (summed loss, # target tokens, # correct) against qs[:, :, 1:]
+        # instead of the (batch_size, max_num_turns, max_q_len, num_wrds) logits
         batch_size = img_feats.size(0)
         num_bboxs = img_feats.size(1)
         device = img_feats.device
@@ -163,12 +170,16 @@ class QGenModel(nn.Module):
                 vis_repr,
                 last_state
             )
-            # (batch_size, seq_len, num_wrds)
-            logits = self.proj(lstm_hidden)
+            if loss_chunk_size > 0:
+                # Projected in chunks by `chunked_cross_entropy`
+                logits = lstm_hidden
+            else:
+                # (batch_size, seq_len, num_wrds)
+                logits = self.proj(lstm_hidden)
             # Not update finished states
             not_finished = question_len[:, t] != 0
             last_state = last_state.clone()
-            last_state[:, :, not_finished] = state[:, :, not_finished]
+            last_state[:, :, not_finished] = state[:, :, not_finished].type_as(last_state)
             # last_state = state
             result_logits.append(logits)
             # update pi
@@ -186,12 +197,31 @@ class QGenModel(nn.Module):
                 # pi = self.refresh_pi(pi, a_emb[:, t], last_state[0,0], obj_repr)
                 result_pi.append(pi)
                 end = end_turn == t
-                final_guess_logits[end] = guess_logits[end]
+                final_guess_logits[end] = guess_logits[end].type_as(final_guess_logits)
 
         result_logits = torch.stack(result_logits).transpose(0, 1)
         result_pi = torch.stack(result_pi).transpose(0, 1)
+        if loss_chunk_size > 0:
+            result_logits = chunked_cross_entropy(
+                result_logits, self.proj, qs[:, :, 1:], self.wrd_embed.padding_idx, loss_chunk_size)
         return result_logits, result_pi, final_guess_logits
 
+    def set_shortlist(self, token_ids):
+        """
+        Generate questions from `token_ids` only, or from the full vocabulary
+        if None. The rows of `proj` are copied, so call it after loading the
+        weights (and before quantizing them).
+        """
+        if token_ids is None:
+            self.shortlist = self.shortlist_weight = self.shortlist_bias = None
+            return
+        assert isinstance(self.proj.weight, torch.Tensor), \
+            "Set the shortlist before quantizing `proj`."
+        shortlist = torch.tensor(sorted(set(token_ids))).long().to(self.proj.weight.device)
+        self.shortlist = shortlist
+        self.shortlist_weight = self.proj.weight.detach()[shortlist].clone()
+        self.shortlist_bias = self.proj.bias.detach()[shortlist].clone()
+
     # w/o teacher forcing
     def generate_word(self, wrd, vis_repr, state):
         batch_size = wrd.size(0)
@@ -200,8 +230,12 @@ class QGenModel(nn.Module):
         lstm_input = torch.cat([wrd_embed, vis_repr], dim=-1).unsqueeze(1)
         lstm_hidden, state = self.lstm(lstm_input, tuple(state))        
         lstm_hidden = lstm_hidden.view(batch_size, -1)
-        # (batch_size, num_wrds)
-        logit = self.proj(lstm_hidden)
+        if self.shortlist is None:
+            # (batch_size, num_wrds)
+            logit = self.proj(lstm_hidden)
+        else:
+            # (batch_size, len(shortlist)), index with `self.shortlist` to get word ids
+            logit = nn.functional.linear(lstm_hidden, self.shortlist_weight, self.shortlist_bias)
         # (2, ...)
         state = torch.stack(state)
         return logit, state
@@ -209,7 +243,7 @@ class QGenModel(nn.Module):
     # w/o teacher forcing
     def generate_sentence(
         self, last_wrd, img_feats, bboxs, eoq_token, eod_token, end_of_dialog, 
-        max_q_len, pi=None, last_state=None, greedy=True):
+        max_q_len, pi=None, last_state=None, greedy=True, pad_token=0, sync_every=4):
         last_wrd = last_wrd.clone()
         batch_size = last_wrd.size(0)
         device = last_wrd.device
@@ -232,42 +266,71 @@ class QGenModel(nn.Module):
         obj_repr = init_obj_repr * pi.unsqueeze(-1)
         vis_repr, weight = self.self_diff_attention(obj_repr, pi)
         
-        _q_tokens = []
-
+        # Fixed-shape decoding: finished questions are masked out with `torch.where`
+        # instead of indexing, and the all-finished check (a host sync) only runs
+        # every `sync_every` steps. Steps after every question has finished are
+        # no-ops, so the outputs match stopping right away. Sampling checks every
+        # step, as extra `torch.multinomial` calls would shift the random stream.
+        if not greedy:
+            sync_every = 1
+        running = torch.ones((), dtype=torch.bool, device=device)
+        q_tokens = torch.full((batch_size, max_q_len), pad_token, dtype=torch.long, device=device)
         for t in range(max_q_len):
             logit, state = self.generate_word(last_wrd, vis_repr, last_state)
             if greedy:
                 q_t = logit.argmax(dim=-1)
             else:
                 q_t = torch.multinomial(self.softmax(logit), 1).view(-1)
-            
+            if self.shortlist is not None:
+                q_t = self.shortlist[q_t]
+
             # Only update those not finished
-            updated_indices = torch.logical_not(finished).nonzero().view(-1)
-            actual_length[updated_indices] = actual_length[updated_indices] + 1
-            last_state[:, :, updated_indices] = state[:, :, updated_indices]
-            last_wrd[updated_indices] = q_t[updated_indices]
-            # _q_tokens.append(last_wrd) # Bad because this "last_wrd" will be altered in-place
-            _q_tokens.append(q_t)
+            updated = torch.logical_not(finished) & running
+            actual_length = actual_length + updated.long()
+            last_state = torch.where(
+                updated.view(1, 1, -1, 1), state.type_as(last_state), last_state)
+            last_wrd = torch.where(updated, q_t, last_wrd)
+            q_tokens[:, t] = torch.where(updated, q_t, q_tokens[:, t])
 
             # Update finished flags
-            new_end_of_question = (q_t == eoq_token)
-
-            new_end_of_dialog = (q_t == eod_token)
-            new_finished_indices = (new_end_of_question | new_end_of_dialog).nonzero().view(-1)
-            finished[new_finished_indices] = 1
+            new_end_of_question = (q_t == eoq_token) & running
+            new_end_of_dialog = (q_t == eod_token) & running
+            finished = finished | new_end_of_question | new_end_of_dialog
             end_of_dialog = end_of_dialog | new_end_of_dialog
-            #print('end_of_dialog')
-            #print(end_of_dialog)
-            if finished.sum() == batch_size:
+            running = running & torch.logical_not(finished.all())
+            if (t + 1) % sync_every == 0 and not running.item():
                 # all finished
                 break
 
-        _q_tokens = torch.stack(_q_tokens).transpose(0, 1) # padded 1 question
-        q_tokens = [] # not padded
-        for _q_tok, act_len in zip(_q_tokens, actual_length):
-            q_tokens.append(_q_tok[:act_len])
+        # (batch_size, max_q_len), padded with `pad_token` after `actual_length`
         return q_tokens, actual_length, last_state, end_of_dialog
 
+    # w/o teacher forcing, `num_candidates` questions per dialog
+    def generate_candidates(
+        self, last_wrd, img_feats, bboxs, eoq_token, eod_token, end_of_dialog,
+        max_q_len, num_candidates, pi=None, last_state=None, beam=True, length_penalty=1.0,
+        pad_token=0, sync_every=4):
+        """
+        Beam search (beam=True) or independent sampling of `num_candidates` questions,
+        see `src.model.utils.decode_candidates` for the outputs.
+        """
+        batch_size = last_wrd.size(0)
+        device = last_wrd.device
+        num_bboxs = img_feats.size(1)
+        if last_state is None:
+            last_state = torch.zeros(2, 1, batch_size, self.lstm_hidden_size).to(device)
+        if pi is None:
+            pi = self.state_handler.init_state(batch_size, num_bboxs, device)
+
+        # UoDR + OsDA
+        obj_feats = torch.cat([img_feats, bboxs], dim=-1)
+        obj_repr = self.img_mlp(obj_feats) * pi.unsqueeze(-1)
+        vis_repr, _ = self.self_diff_attention(obj_repr, pi)
+        return decode_candidates(
+            self, last_wrd, vis_repr, last_state, end_of_dialog, eoq_token, eod_token, max_q_len,
+            num_candidates, beam=beam, length_penalty=length_penalty, pad_token=pad_token,
+            sync_every=sync_every)
+
 
 class GuesserModel(nn.Module):
     def __init__(
@@ -446,7 +509,7 @@ class GuesserModel(nn.Module):
                 update_vilbert=update_vilbert,
                 )
             end = end_turn == t
-            final_logits[end] = logits[end]
+            final_logits[end] = logits[end].type_as(final_logits)
             stat = next_stat
             stat_his.append(stat)
         
@@ -5,6 +5,7 @@ import torch.nn as nn
 from src.model.qgen import QGenModel
 from src.model.oracle import OracleModel
 from src.model.guesser import GuesserModel
+from src.model.utils import quantize_dynamic_int8
 from torch.nn.utils.rnn import pad_sequence
 
 class SelfPlayModel(nn.Module):
@@ -21,16 +22,20 @@ class SelfPlayModel(nn.Module):
         self.oracle = OracleModel(**oracle_kwargs)
         self.guesser = GuesserModel(**guesser_kwargs)
 
-    def load_player(self, player, path, map_location="cpu"):
+    def load_player(self, player, path, map_location="cpu", quantize=False):
         """
         Usage: 
             self_play_obj.load_play("guesser", ckpt_path)
+            self_play_obj.load_play("guesser", ckpt_path, quantize=True) # int8, CPU only
         """
         assert player in ['qgen', 'oracle', 'guesser'],\
             "`player` should be one of ('qgen', 'oracle', 'guesser')."  
         getattr(self, player).load_state_dict(
             torch.load(path, map_location=map_location)['model']
         )
+        if quantize:
+            setattr(self, player, quantize_dynamic_int8(getattr(self, player)))
+            return "Load %s from %s (dynamic int8)" % (player, path)
         return "Load %s from %s" % (player, path)
 
     def play_with_gt_question(
@@ -1,11 +1,15 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: CC-BY-NC-4.0
+import time
+import contextlib
 import torch
 import torch.nn as nn
 from src.model.qgen_vilbert import QGenModel
 from src.model.oracle_vilbert import OracleModel
 from src.model.guesser_vilbert import GuesserModel
-from torch.nn.utils.rnn import pad_sequence
+from src.model.utils import quantize_dynamic_int8
+from src.tools.compile import pad_to_bucket
+from src.tools.checkpoint import load_weights
 
 class SelfPlayModel(nn.Module):
     def __init__(
@@ -13,41 +17,45 @@ class SelfPlayModel(nn.Module):
         qgen_kwargs, 
         oracle_kwargs,
         guesser_kwargs,
+        skip_init=False,
     ):
         super(SelfPlayModel, self).__init__()
-        self.qgen = None
-        if qgen_kwargs is not None:
-            self.qgen = QGenModel(**qgen_kwargs)
-        self.oracle = OracleModel(**oracle_kwargs)
-        self.guesser = GuesserModel(**guesser_kwargs)
+        # With `skip_init`, players are built on the meta device (no allocation nor random
+        # init) and every player has to be loaded with `load_player`
+        with torch.device('meta') if skip_init else contextlib.ExitStack():
+            self.qgen = None
+            if qgen_kwargs is not None:
+                self.qgen = QGenModel(**qgen_kwargs)
+            self.oracle = OracleModel(**oracle_kwargs)
+            self.guesser = GuesserModel(**guesser_kwargs)
+        # Text lengths the questions are padded to for compiled ViLBERT trunks
+        self.txt_buckets = None
+        # Optional `OracleAnswerCache` consulted by `play` when game keys are given
+        self.answer_cache = None
 
-    def load_player(self, player, path, map_location="cpu"):
+    def load_player(self, player, path, map_location="cpu", quantize=False, shortlist=None):
         """
         Usage: 
             self_play_obj.load_play("guesser", ckpt_path)
+            self_play_obj.load_play("guesser", ckpt_path, quantize=True) # int8, CPU only
+            self_play_obj.load_play("qgen", ckpt_path, shortlist=token_ids) # restricted vocabulary
         """
         assert player in ['qgen', 'oracle', 'guesser'],\
             "`player` should be one of ('qgen', 'oracle', 'guesser')."
 
-        # qing add
-        if player in [ 'qgen','oracle']:
-            from collections import OrderedDict
-            player_model = torch.load(path, map_location=map_location)
-            new_state_dict = OrderedDict()
-            for k, v in player_model['model'].items():
-                name = k[7:]  # remove `module.`
-                new_state_dict[name] = v
-            getattr(self, player).load_state_dict(
-                new_state_dict
-            )
-        else:
-
-
-
-            getattr(self, player).load_state_dict(
-                torch.load(path, map_location=map_location)['model']
-            )
-        return "Load %s from %s" % (player, path)
+        start = time.time()
+        # Training checkpoint or exported weights (`bin.export_weights`), memory-mapped on
+        # CPU and assigned to the player as they are, then cast to fp32 if exported in 16 bits
+        getattr(self, player).load_state_dict(load_weights(path), assign=True)
+        getattr(self, player).float()
+        load_time = time.time() - start
+        if shortlist is not None:
+            assert player == 'qgen', "Only QGen generates from a shortlist."
+            self.qgen.set_shortlist(shortlist)
+        if quantize:
+            setattr(self, player, quantize_dynamic_int8(getattr(self, player)))
+            return "Load %s from %s in %.1fs (dynamic int8)" % (player, path, load_time)
+        return "Load %s from %s in %.1fs" % (player, path, load_time)
 
 
     def play_with_gt_questions(
@@ -69,44 +77,37 @@ class SelfPlayModel(nn.Module):
         eod_token, 
         answer2id, 
         answer2token, 
+        oracle_batch_size=None,
+        guesser_num_bboxs=None,
         ):
         device = qs.device
         batch_size = qs.size(0)
         max_turns = qs.size(1)
         end_of_dialog = torch.zeros(batch_size).bool().to(device)
         sos = torch.zeros(batch_size, 1).fill_(sos_token).long().to(device)
-
-        dialog = [torch.LongTensor(0).to(device) for _ in range(batch_size)]
-        q_log = [[] for _ in range(batch_size)]
-        a_log = [[] for _ in range(batch_size)]
-        a_conf_log = [[] for _ in range(batch_size)]
+        dialog_log = new_dialog_log(batch_size, max_turns, qs.size(-1), pad_token, device)
+        # Ground-truth questions do not depend on earlier answers: the Oracle answers
+        # all turns up front, only the Guesser runs turn by turn
+        a_idx_all, a_conf_all = self.answer_gt_questions(
+            qs, q_len, image_features_rcnn_oracle, bboxs_rcnn_oracle, tgt_cat, tgt_bbox, tgt_img_feat,
+            sos_token, pad_token, oracle_batch_size=oracle_batch_size)
 
         guesser_state = self.guesser.init_state(
-            batch_size, image_features_rcnn_gt_guesser.size(1), device)
+            batch_size, image_features_rcnn_gt_guesser.size(1), device, guesser_num_bboxs)
         guesser_final_logits = torch.zeros_like(guesser_state)
+        final_logged = torch.zeros(batch_size).bool().to(device)
         for turn in range(max_turns):
             q_t = qs[:, turn]
             q_len_t = q_len[:, turn] 
             # HACK: length == 0 can not forward in RNN
             end_of_dialog = q_len_t == 0
-            # pad_q = pad_sequence(q, batch_first=True, padding_value=pad_token)
             q_plus_cls_token = torch.cat([sos, q_t], dim=-1)
-            # For oracle vilbert
-            # +1 : [CLS] token
-            txt_attn_mask = [[1] * ql + [0] * (qs.size(-1)+1 - ql) for ql in q_len_t]
-            txt_attn_mask = torch.tensor(txt_attn_mask).to(device)
-            # a = self.oracle(pad_q, tgt_cat, tgt_bbox, tgt_img_feat, fake_q_len)
-            a = self.oracle(
-                q_plus_cls_token, 
-                tgt_cat, 
-                tgt_bbox, 
-                tgt_img_feat, 
-                bboxs_rcnn_oracle, 
-                image_features_rcnn_oracle,
-                attention_mask=txt_attn_mask
-                )
-            a_confidence = nn.functional.softmax(a, dim=-1)
-            a_idx = a.argmax(dim=-1)
+            txt_attn_mask = (torch.arange(qs.size(-1)+1, device=device).unsqueeze(0)
+                             < q_len_t.unsqueeze(1)).long()
+            if self.txt_buckets is not None:
+                q_plus_cls_token = pad_to_bucket(q_plus_cls_token, -1, self.txt_buckets, pad_token)
+                txt_attn_mask = pad_to_bucket(txt_attn_mask, -1, self.txt_buckets, 0)
+            a_idx = a_idx_all[:, turn]
             
             guesser_state, logits = self.guesser.forward_turn(
                 q_plus_cls_token, 
@@ -120,26 +121,75 @@ class SelfPlayModel(nn.Module):
                 image_attention_mask=bboxs_mask.long(),
             )
             a = oracle_output_to_answer_token(a_idx, answer2id, answer2token)
-            for b in range(batch_size):
-                if not end_of_dialog[b]:
-                    # QUESTION
-                    _q = q_t[b][:q_len_t[b]]
-                    q_log[b].append(_q)
-                    dialog[b] = torch.cat([dialog[b], _q])
-                    # ANSWER
-                    _a = a[b].view(-1)
-                    a_log[b].append(_a)
-                    a_conf_log[b].append(a_confidence[b, a_idx[b]])
-                    dialog[b] = torch.cat([dialog[b], _a])
-                else:
-                    if guesser_final_logits[b].sum() == 0:
-                        # last turn
-                        guesser_final_logits[b] = logits[b]
-            if end_of_dialog.sum() == batch_size:
+            log_turn(
+                dialog_log, turn, q_t, q_len_t, a, a_conf_all[:, turn],
+                a_mask=torch.logical_not(end_of_dialog))
+            # last turn
+            last_turn = end_of_dialog & torch.logical_not(final_logged)
+            guesser_final_logits = torch.where(last_turn.unsqueeze(1), logits, guesser_final_logits)
+            final_logged = final_logged | end_of_dialog
+            if end_of_dialog.all().item():
                 break
         # First one is global image token
         guess = guesser_final_logits[:, 1:]
-        return guess, dialog, q_log, a_log, a_conf_log
+        return guess, dialog_log
+
+    def answer_gt_questions(
+        self,
+        qs,
+        q_len,
+        image_features_rcnn_oracle,
+        bboxs_rcnn_oracle,
+        tgt_cat,
+        tgt_bbox,
+        tgt_img_feat,
+        sos_token,
+        pad_token,
+        oracle_batch_size=None,
+        ):
+        """
+        Oracle answers to the ground-truth questions of all turns, as one
+        (batch x turns) forward, or chunks of `oracle_batch_size` questions.
+        Turns after the first empty one of a dialog are skipped: the Guesser
+        makes its final guess at that turn in `play_with_gt_questions`.
+        return: a_idx, a_conf (batch_size, max_turns), 0 for skipped turns
+        """
+        device = qs.device
+        batch_size, max_turns, max_len = qs.size()
+        empty = (q_len == 0).long()
+        # Turns up to and including the first empty one
+        asked = (empty.cumsum(dim=1) - empty) == 0
+        b_idx, t_idx = asked.nonzero(as_tuple=True)
+        q = qs[b_idx, t_idx]
+        sos = torch.zeros(q.size(0), 1).fill_(sos_token).long().to(device)
+        q_plus_cls_token = torch.cat([sos, q], dim=-1)
+        # For oracle vilbert
+        txt_attn_mask = (torch.arange(max_len+1, device=device).unsqueeze(0)
+                         < q_len[b_idx, t_idx].unsqueeze(1)).long()
+        if self.txt_buckets is not None:
+            q_plus_cls_token = pad_to_bucket(q_plus_cls_token, -1, self.txt_buckets, pad_token)
+            txt_attn_mask = pad_to_bucket(txt_attn_mask, -1, self.txt_buckets, 0)
+        chunk_size = oracle_batch_size or q.size(0)
+        a = []
+        for i in range(0, q.size(0), chunk_size):
+            b = b_idx[i:i+chunk_size]
+            a.append(self.oracle(
+                q_plus_cls_token[i:i+chunk_size],
+                tgt_cat[b],
+                tgt_bbox[b],
+                tgt_img_feat[b],
+                bboxs_rcnn_oracle[b],
+                image_features_rcnn_oracle[b],
+                attention_mask=txt_attn_mask[i:i+chunk_size]
+                ))
+        a = torch.cat(a)
+        a_confidence = nn.functional.softmax(a, dim=-1)
+        a_idx = a.argmax(dim=-1)
+        a_idx_all = torch.zeros(batch_size, max_turns).long().to(device)
+        a_idx_all[b_idx, t_idx] = a_idx
+        a_conf_all = torch.zeros(batch_size, max_turns).to(device)
+        a_conf_all[b_idx, t_idx] = a_confidence.gather(1, a_idx.unsqueeze(1)).squeeze(1).float()
+        return a_idx_all, a_conf_all
 
     def play(
         self, 
@@ -162,8 +212,16 @@ class SelfPlayModel(nn.Module):
         answer2token, 
         max_q_len, 
         greedy=True, 
-        max_turns=8
+        max_turns=8,
+        game_keys=None,
+        guesser_num_bboxs=None,
         ):
+        """
+            game_keys: one hashable per game, e.g. (game id, target object id), to reuse
+                       the answers of `answer_cache`
+            guesser_num_bboxs: guesser regions of the batch before padding to a compile
+                               bucket (default: all), see `GuesserModel.init_state`
+        """
         device = qgen_img_feats.device
         batch_size = qgen_img_feats.size(0)
         num_bboxs = qgen_img_feats.size(1)
@@ -173,48 +231,45 @@ class SelfPlayModel(nn.Module):
         last_state = None
         # pi = (torch.ones(batch_size, num_bboxs) / num_bboxs).to(device)
         pi = self.qgen.state_handler.init_state(batch_size, num_bboxs, device)
-
-        dialog = [torch.LongTensor(0).to(device) for _ in range(batch_size)]
-        q_log = [[] for _ in range(batch_size)]
-        a_log = [[] for _ in range(batch_size)]
-        a_conf_log = [[] for _ in range(batch_size)]
+        dialog_log = new_dialog_log(batch_size, max_turns, max_q_len, pad_token, device)
 
         guesser_state = self.guesser.init_state(
-            batch_size, image_features_rcnn_gt_guesser.size(1), device)
+            batch_size, image_features_rcnn_gt_guesser.size(1), device, guesser_num_bboxs)
         guesser_final_logits = torch.zeros_like(guesser_state)
+        final_logged = torch.zeros(batch_size).bool().to(device)
         logits = torch.ones_like(guesser_final_logits)
         for turn in range(max_turns):
 
             q, q_len, state, end_of_dialog_next = self.qgen.generate_sentence(
                 last_wrd, qgen_img_feats, qgen_bboxs, eoq_token, eod_token, end_of_dialog, 
-                max_q_len=max_q_len, pi=pi, last_state=last_state, greedy=greedy
+                max_q_len=max_q_len, pi=pi, last_state=last_state, greedy=greedy, pad_token=pad_token
             )
 
-            pad_q = pad_sequence(q, batch_first=True, padding_value=pad_token)
+            pad_q = q[:, :q_len.max().item()]
             q_plus_cls_token = torch.cat([sos, pad_q], dim=-1)
             # For oracle vilbert
             # +1 : [CLS] token
-            txt_attn_mask = [[1] * (ql+1) + [0] * (q_len.max().item() - ql) for ql in q_len]
-            txt_attn_mask = torch.tensor(txt_attn_mask).to(device)
+            txt_attn_mask = (torch.arange(pad_q.size(1)+1, device=device).unsqueeze(0)
+                             <= q_len.unsqueeze(1)).long()
+            if self.txt_buckets is not None:
+                q_plus_cls_token = pad_to_bucket(q_plus_cls_token, -1, self.txt_buckets, pad_token)
+                txt_attn_mask = pad_to_bucket(txt_attn_mask, -1, self.txt_buckets, 0)
             # a = self.oracle(pad_q, tgt_cat, tgt_bbox, tgt_img_feat, fake_q_len)
-            a = self.oracle(
+            a_idx, a_conf = self.answer_questions(
                 q_plus_cls_token, 
+                txt_attn_mask,
                 tgt_cat, 
                 tgt_bbox, 
                 tgt_img_feat, 
                 bboxs_rcnn_oracle, 
                 image_features_rcnn_oracle,
-                attention_mask=txt_attn_mask
+                q, q_len, torch.logical_not(end_of_dialog_next), game_keys,
                 )
-            a_confidence = nn.functional.softmax(a, dim=-1)
-            a_idx = a.argmax(dim=-1)
-
 
-            for b in range(batch_size):
-                if end_of_dialog_next[b]:
-                    if guesser_final_logits[b].sum() == 0:
-                        # last turn
-                        guesser_final_logits[b] = logits[b]
+            # last turn: guess from the dialog before the <eod> question
+            last_turn = end_of_dialog_next & torch.logical_not(final_logged)
+            guesser_final_logits = torch.where(last_turn.unsqueeze(1), logits, guesser_final_logits)
+            final_logged = final_logged | end_of_dialog_next
 
             guesser_state, logits = self.guesser.forward_turn(
                 q_plus_cls_token, 
@@ -238,30 +293,333 @@ class SelfPlayModel(nn.Module):
                 update_vilbert=False,
             )
             a = oracle_output_to_answer_token(a_idx, answer2id, answer2token)
-            for b in range(batch_size):
-                if not end_of_dialog[b]:
-                    _q = q[b][:q_len[b]]
-                    q_log[b].append(_q)
-                    dialog[b] = torch.cat([dialog[b], _q])                    
-                if not end_of_dialog_next[b]:
-                    _a = a[b].view(-1)
-                    a_log[b].append(_a)
-                    a_conf_log[b].append(a_confidence[b, a_idx[b]])
-                    dialog[b] = torch.cat([dialog[b], _a])
-
-            if end_of_dialog_next.sum().item() == batch_size:
+            # Questions of finished dialogs have length 0, the <eod> question gets no answer
+            log_turn(
+                dialog_log, turn, q, q_len, a, a_conf,
+                a_mask=torch.logical_not(end_of_dialog_next))
+
+            if end_of_dialog_next.all().item():
                 break
             end_of_dialog = end_of_dialog_next
             last_wrd = a
             last_state = state
             # pi = self.qgen.refresh_pi(pi, a, last_state[0,0], obj_repr, input_token=True)
             
-        for b in range(batch_size):
-            if guesser_final_logits[b].sum() == 0:
-                guesser_final_logits[b] = logits[b]
+        guesser_final_logits = torch.where(final_logged.unsqueeze(1), guesser_final_logits, logits)
         # First one is global image token
         guess = guesser_final_logits[:, 1:]
-        return guess, dialog, q_log, a_log, a_conf_log
+        return guess, dialog_log
+
+    def play_continuous(
+        self,
+        batches,
+        batch_size,
+        sos_token,
+        pad_token,
+        eoq_token,
+        eod_token,
+        answer2id,
+        answer2token,
+        max_q_len,
+        greedy=True,
+        max_turns=8
+        ):
+        """
+        Play the same games as `play`, but finished games leave the working batch after
+        every turn and their slots are refilled with the next games of `batches`, so the
+        ViLBERT forwards only run for games still in a dialog.
+            batches:    iterable of (inputs, metas, game_keys, guesser_num_bboxs);
+                        `inputs` are the first 11 (tensor) arguments of `play`, `metas`
+                        one item per game, yielded back with its result, and
+                        `game_keys` and `guesser_num_bboxs` as in `play` (or None)
+            batch_size: max number of games played at once
+        Yields (meta, guess, dialog, q_log, a_log, a_conf_log) per game as it ends, i.e.
+        out of order; each game's outputs are those `play` gives for it (greedy decoding),
+        with the dialog as python lists (see `dialog_log_to_lists`).
+        """
+        batches = iter(batches)
+        active, games = None, []
+        pending, pending_games = None, []
+        while True:
+            # Refill free slots, taking games from the current batch first
+            while len(games) < batch_size:
+                if not pending_games:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    inputs, metas, game_keys, guesser_num_bboxs = batch
+                    pending = self._init_games(inputs, sos_token, guesser_num_bboxs)
+                    # Regions padded to a compile bucket are not part of the guess
+                    width = guesser_num_bboxs or pending['bboxs_mask'].size(1)
+                    if game_keys is None:
+                        game_keys = [None] * len(metas)
+                    pending_games = [_new_game(meta, width, key) for meta, key in zip(metas, game_keys)]
+                n = min(batch_size - len(games), len(pending_games))
+                rows = torch.arange(len(pending_games), device=pending['last_wrd'].device)
+                active = _cat_games(active, _select_games(pending, rows[:n]))
+                pending = _select_games(pending, rows[n:])
+                games, pending_games = games + pending_games[:n], pending_games[n:]
+            if len(games) == 0:
+                return
+
+            n_active = len(games)
+            device = active['last_wrd'].device
+            sos = torch.zeros(n_active, 1).fill_(sos_token).long().to(device)
+            # Games still in the working batch have not ended their dialog
+            end_of_dialog = torch.zeros(n_active).bool().to(device)
+            q, q_len, state, end_of_dialog_next = self.qgen.generate_sentence(
+                active['last_wrd'], active['qgen_img_feats'], active['qgen_bboxs'], eoq_token, eod_token,
+                end_of_dialog, max_q_len=max_q_len, pi=active['pi'], last_state=active['last_state'],
+                greedy=greedy, pad_token=pad_token
+            )
+            pad_q = q[:, :q_len.max().item()]
+            q_plus_cls_token = torch.cat([sos, pad_q], dim=-1)
+            # +1 : [CLS] token
+            txt_attn_mask = (torch.arange(pad_q.size(1) + 1, device=device).unsqueeze(0)
+                             <= q_len.unsqueeze(1)).long()
+            if self.txt_buckets is not None:
+                q_plus_cls_token = pad_to_bucket(q_plus_cls_token, -1, self.txt_buckets, pad_token)
+                txt_attn_mask = pad_to_bucket(txt_attn_mask, -1, self.txt_buckets, 0)
+            game_keys = [game['key'] for game in games]
+            a_idx, a_conf = self.answer_questions(
+                q_plus_cls_token,
+                txt_attn_mask,
+                active['tgt_cat'],
+                active['tgt_bbox'],
+                active['tgt_img_feat'],
+                active['bboxs_rcnn_oracle'],
+                active['image_features_rcnn_oracle'],
+                q, q_len, torch.logical_not(end_of_dialog_next),
+                game_keys if None not in game_keys else None,
+                )
+            a = oracle_output_to_answer_token(a_idx, answer2id, answer2token)
+
+            # One host copy per tensor for the whole working batch
+            q_list, q_len_list, a_list, ended = q.tolist(), q_len.tolist(), a.tolist(), end_of_dialog_next.tolist()
+            a_conf_list = a_conf.tolist()
+            for b, game in enumerate(games):
+                _q = q_list[b][:q_len_list[b]]
+                game['q_log'].append(_q)
+                game['dialog'] += _q
+                if ended[b]:
+                    # Guess from the dialog before the <eod> question
+                    yield self._finish_game(game, active['logits'][b])
+                else:
+                    game['a_log'].append([a_list[b]])
+                    game['a_conf_log'].append(a_conf_list[b])
+                    game['dialog'] += [a_list[b]]
+                    game['turn'] += 1
+            # Only the games still playing go through the Guesser and the state handler
+            keep = torch.logical_not(end_of_dialog_next).nonzero().view(-1)
+            games = [game for game, e in zip(games, ended) if not e]
+            if len(games) == 0:
+                active = None
+                continue
+            active = _select_games(active, keep)
+            active['last_state'] = state[:, :, keep]
+            q_plus_cls_token, txt_attn_mask, a_idx = q_plus_cls_token[keep], txt_attn_mask[keep], a_idx[keep]
+            active['guesser_state'], active['logits'] = self.guesser.forward_turn(
+                q_plus_cls_token,
+                a_idx,
+                active['cats_guesser'],
+                active['image_features_rcnn_gt_guesser'],
+                active['bboxs_rcnn_gt_guesser'],
+                curr_state=active['guesser_state'],
+                bboxs_mask=active['bboxs_mask'],
+                attention_mask=txt_attn_mask,
+                image_attention_mask=active['bboxs_mask'].long(),
+            )
+            active['pi'], _ = self.qgen.state_handler.forward_turn(
+                q_plus_cls_token,
+                a_idx,
+                None, # cats
+                active['qgen_img_feats'],
+                active['qgen_bboxs'],
+                curr_state=active['pi'],
+                attention_mask=txt_attn_mask,
+                update_vilbert=False,
+            )
+            active['last_wrd'] = a[keep]
+
+            # Games out of turns guess from the whole dialog
+            out_of_turns = [game['turn'] == max_turns for game in games]
+            if any(out_of_turns):
+                for b, game in enumerate(games):
+                    if out_of_turns[b]:
+                        yield self._finish_game(game, active['logits'][b])
+                keep = torch.tensor([not o for o in out_of_turns], device=device).nonzero().view(-1)
+                games = [game for game, o in zip(games, out_of_turns) if not o]
+                active = _select_games(active, keep) if len(games) > 0 else None
+
+    def answer_questions(
+        self,
+        q_plus_cls_token,
+        txt_attn_mask,
+        tgt_cat,
+        tgt_bbox,
+        tgt_img_feat,
+        bboxs_rcnn_oracle,
+        image_features_rcnn_oracle,
+        q=None,
+        q_len=None,
+        asked=None,
+        game_keys=None,
+        ):
+        """
+        Oracle answer ids and confidences of a batch of questions. With an `answer_cache`
+        and `game_keys`, only the questions of `asked` games missing from the cache go
+        through the Oracle; the other games get answer 0.
+            q, q_len: generated questions, for the cache keys
+        """
+        if self.answer_cache is None or game_keys is None:
+            a = self.oracle(
+                q_plus_cls_token,
+                tgt_cat,
+                tgt_bbox,
+                tgt_img_feat,
+                bboxs_rcnn_oracle,
+                image_features_rcnn_oracle,
+                attention_mask=txt_attn_mask
+                )
+            a_confidence = nn.functional.softmax(a, dim=-1)
+            a_idx = a.argmax(dim=-1)
+            return a_idx, a_confidence.gather(1, a_idx.unsqueeze(1)).squeeze(1)
+
+        device = q_plus_cls_token.device
+        batch_size = q_plus_cls_token.size(0)
+        rows = asked.nonzero().view(-1).tolist()
+        q_list, q_len_list = q.tolist(), q_len.tolist()
+        keys = [self.answer_cache.key(game_keys[b], q_list[b][:q_len_list[b]]) for b in rows]
+        a_idx, a_conf = [0] * batch_size, [0.] * batch_size
+        missing, missing_keys = [], []
+        for b, k, answer in zip(rows, keys, self.answer_cache.lookup(keys)):
+            if answer is None:
+                missing.append(b)
+                missing_keys.append(k)
+            else:
+                a_idx[b], a_conf[b] = answer
+        a_idx = torch.tensor(a_idx).long().to(device)
+        a_conf = torch.tensor(a_conf).float().to(device)
+        if len(missing) > 0:
+            m = torch.tensor(missing).long().to(device)
+            a_idx_m, a_conf_m = self.answer_questions(
+                q_plus_cls_token[m], txt_attn_mask[m], tgt_cat[m], tgt_bbox[m], tgt_img_feat[m],
+                bboxs_rcnn_oracle[m], image_features_rcnn_oracle[m])
+            a_conf_m = a_conf_m.float()
+            a_idx[m] = a_idx_m
+            a_conf[m] = a_conf_m
+            self.answer_cache.update(missing_keys, a_idx_m.tolist(), a_conf_m.tolist())
+        return a_idx, a_conf
+
+    def _init_games(self, inputs, sos_token, guesser_num_bboxs=None):
+        """ Per-game tensors of `play_continuous` before the first turn of a batch. """
+        games = dict(zip(PLAY_INPUTS, inputs))
+        device = games['qgen_img_feats'].device
+        n, num_bboxs = games['qgen_img_feats'].size(0), games['qgen_img_feats'].size(1)
+        games['last_wrd'] = torch.zeros(n).fill_(sos_token).long().to(device)
+        games['last_state'] = torch.zeros(2, 1, n, self.qgen.lstm_hidden_size).to(device)
+        games['pi'] = self.qgen.state_handler.init_state(n, num_bboxs, device)
+        # The guesser state is uniform over the regions of the game's own batch, as in `play`
+        games['guesser_state'] = self.guesser.init_state(
+            n, games['image_features_rcnn_gt_guesser'].size(1), device, guesser_num_bboxs)
+        games['logits'] = torch.ones_like(games['guesser_state'])
+        return games
+
+    def _finish_game(self, game, logits):
+        # First one is global image token
+        guess = logits[1:game['width']]
+        return game['meta'], guess, game['dialog'], game['q_log'], game['a_log'], game['a_conf_log']
+
+
+# Per-game tensor arguments of `SelfPlayModel.play`, in order
+PLAY_INPUTS = (
+    'qgen_img_feats', 'qgen_bboxs', 'image_features_rcnn_oracle', 'bboxs_rcnn_oracle',
+    'image_features_rcnn_gt_guesser', 'bboxs_rcnn_gt_guesser', 'tgt_cat', 'tgt_bbox',
+    'tgt_img_feat', 'cats_guesser', 'bboxs_mask',
+)
+# Per-game tensors whose dim 1 runs over the guesser regions, which differ between batches
+GUESSER_REGION_KEYS = (
+    'image_features_rcnn_gt_guesser', 'bboxs_rcnn_gt_guesser', 'cats_guesser', 'bboxs_mask',
+    'guesser_state', 'logits',
+)
+
+
+def _new_game(meta, width, key=None):
+    return {
+        'meta': meta, 'width': width, 'key': key, 'turn': 0, 'dialog': [],
+        'q_log': [], 'a_log': [], 'a_conf_log': [],
+    }
+
+
+def _select_games(games, rows):
+    # The LSTM state is (2, 1, batch_size, hidden)
+    return {k: v[:, :, rows] if k == 'last_state' else v[rows] for k, v in games.items()}
+
+
+def _cat_games(games, new_games):
+    if games is None:
+        return new_games
+    if new_games['last_wrd'].size(0) == 0:
+        return games
+    # Extra guesser regions are masked out and start with a zero state,
+    # which leaves the guesser outputs of the real regions unchanged
+    width = max(games['bboxs_mask'].size(1), new_games['bboxs_mask'].size(1))
+    out = dict()
+    for k, v in games.items():
+        if k in GUESSER_REGION_KEYS:
+            v, new_v = pad_to_bucket(v, 1, [width]), pad_to_bucket(new_games[k], 1, [width])
+        else:
+            new_v = new_games[k]
+        out[k] = torch.cat([v, new_v], dim=2 if k == 'last_state' else 0)
+    return out
+
+
+def new_dialog_log(batch_size, max_turns, max_q_len, pad_token, device):
+    """
+    Preallocated questions and answers of a batch of dialogs, filled turn by turn with
+    `log_turn`. A turn's question is logged if its length is > 0 and its answer if
+    `a_mask` is set.
+    """
+    return {
+        'q_tokens': torch.zeros(batch_size, max_turns, max_q_len).fill_(pad_token).long().to(device),
+        'q_len': torch.zeros(batch_size, max_turns).long().to(device),
+        'a_tokens': torch.zeros(batch_size, max_turns).fill_(pad_token).long().to(device),
+        'a_conf': torch.zeros(batch_size, max_turns).to(device),
+        'a_mask': torch.zeros(batch_size, max_turns).bool().to(device),
+    }
+
+
+def log_turn(dialog_log, turn, q, q_len, a, a_conf, a_mask):
+    dialog_log['q_tokens'][:, turn, :q.size(1)] = q
+    dialog_log['q_len'][:, turn] = q_len
+    dialog_log['a_tokens'][:, turn] = a
+    dialog_log['a_conf'][:, turn] = a_conf.float()
+    dialog_log['a_mask'][:, turn] = a_mask
+
+
+def dialog_log_to_lists(dialog_log):
+    """
+    Per-game python lists of a `new_dialog_log`, with one host copy per tensor.
+    return: dialog (question and answer tokens of all turns), q_log (token list per
+            question), a_log (token list per answer), a_conf_log (float per answer)
+    """
+    q_tokens, q_len, a_tokens, a_conf, a_mask = (
+        dialog_log[k].cpu().tolist() for k in ('q_tokens', 'q_len', 'a_tokens', 'a_conf', 'a_mask'))
+    dialog, q_log, a_log, a_conf_log = [], [], [], []
+    for b in range(len(q_len)):
+        dialog.append([])
+        q_log.append([])
+        a_log.append([])
+        a_conf_log.append([])
+        for t in range(len(q_len[b])):
+            if q_len[b][t] > 0:
+                q_log[b].append(q_tokens[b][t][:q_len[b][t]])
+                dialog[b] += q_log[b][-1]
+            if a_mask[b][t]:
+                a_log[b].append([a_tokens[b][t]])
+                a_conf_log[b].append(a_conf[b][t])
+                dialog[b] += a_log[b][-1]
+    return dialog, q_log, a_log, a_conf_log
 
 
 def oracle_output_to_answer_token(oracle_output, answer2id, answer2token):
@@ -5,6 +5,7 @@ import torch.nn as nn
 from src.model.qgen_vilbert import QGenModel
 from src.model.oracle import OracleModel
 from src.model.guesser import GuesserModel
+from src.model.utils import quantize_dynamic_int8
 from torch.nn.utils.rnn import pad_sequence
 
 class SelfPlayModel(nn.Module):
@@ -21,10 +22,12 @@ class SelfPlayModel(nn.Module):
         self.oracle = OracleModel(**oracle_kwargs)
         self.guesser = GuesserModel(**guesser_kwargs)
 
-    def load_player(self, player, path, map_location="cpu"):
+    def load_player(self, player, path, map_location="cpu", quantize=False, shortlist=None):
         """
         Usage: 
             self_play_obj.load_play("guesser", ckpt_path)
+            self_play_obj.load_play("guesser", ckpt_path, quantize=True) # int8, CPU only
+            self_play_obj.load_play("qgen", ckpt_path, shortlist=token_ids) # restricted vocabulary
         """
         assert player in ['qgen', 'oracle', 'guesser'],\
             "`player` should be one of ('qgen', 'oracle', 'guesser')."  
@@ -39,6 +42,12 @@ class SelfPlayModel(nn.Module):
                 name = name[7:] 
             new_state_dict[name] = v
         getattr(self, player).load_state_dict(new_state_dict)
+        if shortlist is not None:
+            assert player == 'qgen', "Only QGen generates from a shortlist."
+            self.qgen.set_shortlist(shortlist)
+        if quantize:
+            setattr(self, player, quantize_dynamic_int8(getattr(self, player)))
+            return "Load %s from %s (dynamic int8)" % (player, path)
         return "Load %s from %s" % (player, path)
 
 
@@ -64,10 +73,10 @@ class SelfPlayModel(nn.Module):
             # print(turn, ':', pi[0].argmax())
             q, q_len, state, end_of_dialog_next = self.qgen.generate_sentence(
                 last_wrd, qgen_img_feats, qgen_bboxs, eoq_token, eod_token, end_of_dialog, 
-                max_q_len=max_q_len, pi=pi, last_state=last_state, greedy=greedy
+                max_q_len=max_q_len, pi=pi, last_state=last_state, greedy=greedy, pad_token=pad_token
             )
 
-            pad_q = pad_sequence(q, batch_first=True, padding_value=pad_token)
+            pad_q = q[:, :q_len.max().item()]
             # HACK: length == 0 can not forward in RNN
             fake_q_len = q_len.clone()
             fake_q_len[q_len == 0] = 1
@@ -0,0 +1,238 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import hashlib
+import torch
+from collections import Counter
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+def osda_glimpse_logits(obj_repr, linear):
+    """
+    Closed form of the OsDA glimpse logits.
+        diff[b, i, j] = o_i * (o_i - o_j)
+        logits[b, i]  = linear(diff[b, i].view(num_bboxs * obj_feat_dim))
+    Splitting `linear` into per-region blocks W_j gives
+        logits[b, i] = o_i^2 . sum_j W_j - o_i . sum_j (W_j * o_j) + bias
+    so the (batch_size, num_bboxs, num_bboxs, obj_feat_dim) tensor is never built.
+        obj_repr: (batch_size, num_bboxs, obj_feat_dim)
+        linear:   nn.Linear(num_bboxs * obj_feat_dim, num_glimpses)
+        return:   (batch_size, num_bboxs, num_glimpses)
+    """
+    num_bboxs = obj_repr.size(1)
+    obj_feat_dim = obj_repr.size(-1)
+    # (num_glimpses, num_bboxs, obj_feat_dim)
+    weight = linear.weight.view(-1, num_bboxs, obj_feat_dim)
+    # (batch_size, num_bboxs, num_glimpses)
+    self_term = torch.matmul(obj_repr * obj_repr, weight.sum(dim=1).t())
+    # (batch_size, num_glimpses, obj_feat_dim)
+    context = torch.einsum('gjd,bjd->bgd', weight, obj_repr)
+    cross_term = torch.bmm(obj_repr, context.transpose(1, 2))
+    logits = self_term - cross_term
+    if linear.bias is not None:
+        logits = logits + linear.bias
+    return logits
+
+
+def osda_hard_diff(obj_repr, pi_hard):
+    """
+    Closed form of sum_j sum_i pi_i * o_i * (o_i - o_j), i.e. the OsDA
+    difference tensor pooled by the (straight-through) one-hot `pi_hard`.
+        obj_repr: (batch_size, num_bboxs, obj_feat_dim)
+        pi_hard:  (batch_size, num_bboxs)
+        return:   (batch_size, obj_feat_dim)
+    """
+    num_bboxs = obj_repr.size(1)
+    pi_hard = pi_hard.unsqueeze(-1)
+    picked = (pi_hard * obj_repr).sum(dim=1)
+    picked_sq = (pi_hard * obj_repr * obj_repr).sum(dim=1)
+    return num_bboxs * picked_sq - picked * obj_repr.sum(dim=1)
+
+
+def quantize_dynamic_int8(model):
+    """
+    Dynamic int8 quantization of the nn.Linear layers of `model`, in place.
+    Only runs on CPU. Top-level submodules listed in `model.quantize_skip`
+    keep fp32 weights, e.g. layers whose weight tensors are read directly.
+    """
+    skip = getattr(model, 'quantize_skip', ())
+    qconfig_spec = {
+        name: torch.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name.split('.')[0] not in skip
+    }
+    return torch.quantization.quantize_dynamic(
+        model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def tensor_hash(t):
+    ''' SHA-1 of the bytes of a tensor '''
+    return hashlib.sha1(t.detach().cpu().contiguous().flatten().view(torch.uint8).numpy()).hexdigest()
+
+
+def share_identical_parameters(model, copy=False):
+    """
+    Replace parameters of `model` that are bitwise identical to an earlier one
+    (same dtype, shape and content hash) by that parameter, in place, e.g. the
+    frozen QGen state handler loaded from the Guesser checkpoint. For evaluation:
+    shared parameters would get the updates of all the places they are used in.
+    Only parameters with the dtype and shape of another one are read and hashed.
+    Parameters memory-mapped from a file (`load_weights`) are views of one mapping
+    of the whole file, so replacing some of them frees nothing while the others keep
+    the mapping alive. With `copy`, all parameters and buffers are then copied to
+    new memory (shared ones once), which releases the mappings; otherwise memory is
+    only saved once the model is copied, e.g. with `.to(device)`.
+    return: number of replaced parameters, bytes of the replaced parameters
+    """
+    params = [(module, name, param) for module in model.modules()
+              for name, param in module._parameters.items() if param is not None]
+    n_same_shape = Counter((p.dtype, tuple(p.shape), p.device) for _, _, p in params)
+    seen = dict()
+    n_shared, n_bytes = 0, 0
+    for module, name, param in params:
+        key = (param.dtype, tuple(param.shape), param.device)
+        if n_same_shape[key] < 2:
+            continue
+        first = seen.setdefault(key + (tensor_hash(param),), param)
+        if first is param or not torch.equal(first, param):
+            continue
+        module._parameters[name] = first
+        n_shared += 1
+        n_bytes += param.numel() * param.element_size()
+    if copy:
+        # Keyed by the tensors themselves, which stay alive while a module uses them
+        copies = dict()
+        for module in model.modules():
+            for tensors in (module._parameters, module._buffers):
+                for name, t in list(tensors.items()):
+                    if t is None:
+                        continue
+                    if id(t) not in copies:
+                        data = t.detach().clone()
+                        copies[id(t)] = nn.Parameter(data, requires_grad=t.requires_grad) \
+                            if isinstance(t, nn.Parameter) else data
+                    tensors[name] = copies[id(t)]
+    return n_shared, n_bytes
+
+
+def _cross_entropy_chunk(proj, hidden, tgt):
+    logits = proj(hidden).float()
+    loss = nn.functional.cross_entropy(logits, tgt, reduction='sum')
+    hit = (logits.argmax(dim=-1) == tgt).sum()
+    return loss, hit
+
+
+def chunked_cross_entropy(hidden, proj, tgt, ignore_index, chunk_size):
+    """
+    Cross-entropy of `proj(hidden)` against `tgt` without building the logits
+    of every position. Only positions with tgt != ignore_index are projected,
+    `chunk_size` at a time, and when training the logits of each chunk are
+    recomputed in backward instead of being kept alive.
+        hidden: (..., hidden_size)
+        proj:   nn.Linear(hidden_size, num_classes)
+        tgt:    (...)
+        return: (summed loss, number of target tokens, number of correct argmax)
+    """
+    keep = tgt != ignore_index
+    hidden = hidden[keep]
+    tgt = tgt[keep]
+    loss = hidden.new_zeros((), dtype=torch.float)
+    hit = tgt.new_zeros(())
+    for start in range(0, tgt.size(0), chunk_size):
+        args = (proj, hidden[start:start+chunk_size], tgt[start:start+chunk_size])
+        if torch.is_grad_enabled():
+            chunk_loss, chunk_hit = checkpoint(_cross_entropy_chunk, *args, use_reentrant=False)
+        else:
+            chunk_loss, chunk_hit = _cross_entropy_chunk(*args)
+        loss = loss + chunk_loss
+        hit = hit + chunk_hit
+    return loss, tgt.new_tensor(tgt.size(0)), hit
+
+
+def decode_candidates(
+    qgen, last_wrd, vis_repr, last_state, end_of_dialog, eoq_token, eod_token, max_q_len,
+    num_candidates, beam=True, length_penalty=1.0, pad_token=0, sync_every=4):
+    """
+    Decode `num_candidates` questions per dialog with `qgen.generate_word`,
+    either by beam search or by independent sampling. The visual representation
+    and LSTM state are expanded to (batch_size * num_candidates) once, so every
+    step is a single batched `generate_word`.
+        last_wrd:      (batch_size)
+        vis_repr:      (batch_size, vis_repr_dim)
+        last_state:    (2, 1, batch_size, lstm_hidden_size)
+        end_of_dialog: (batch_size), dialogs which ended get empty candidates
+        return: tokens        (batch_size, num_candidates, max_q_len), padded with `pad_token`
+                lengths       (batch_size, num_candidates)
+                scores        (batch_size, num_candidates), log-prob / length ** length_penalty
+                last_state    (2, 1, batch_size * num_candidates, lstm_hidden_size)
+                end_of_dialog (batch_size, num_candidates)
+        Candidates of a dialog are sorted by descending score.
+    """
+    batch_size = last_wrd.size(0)
+    k = num_candidates
+    num_rows = batch_size * k
+    device = last_wrd.device
+    last_wrd = last_wrd.repeat_interleave(k)
+    vis_repr = vis_repr.repeat_interleave(k, dim=0)
+    last_state = last_state.repeat_interleave(k, dim=2)
+    end_of_dialog = end_of_dialog.repeat_interleave(k)
+    finished = end_of_dialog.clone()
+    lengths = torch.zeros(num_rows, dtype=torch.long, device=device)
+    q_tokens = torch.full((num_rows, max_q_len), pad_token, dtype=torch.long, device=device)
+    scores = torch.zeros(num_rows, device=device)
+    # (batch_size * k), first row of each dialog in the flattened layout
+    offsets = torch.arange(batch_size, device=device).repeat_interleave(k) * k
+    if beam:
+        # All beams start identical, only expand the first one of each dialog
+        scores = scores.masked_fill((torch.arange(num_rows, device=device) % k != 0) & ~finished, float('-inf'))
+    else:
+        # Extra sampling steps would shift the random stream
+        sync_every = 1
+
+    for t in range(max_q_len):
+        logit, state = qgen.generate_word(last_wrd, vis_repr, last_state)
+        logp = torch.log_softmax(logit.float(), dim=-1)
+        num_classes = logp.size(-1)
+        if beam:
+            # A finished beam has one continuation (column 0) which keeps it unchanged
+            stay = torch.full_like(logp, float('-inf'))
+            stay[:, 0] = 0
+            logp = torch.where(finished.unsqueeze(-1), stay, logp)
+            # (batch_size, k)
+            top_scores, top_idx = (scores.unsqueeze(-1) + logp).view(batch_size, -1).topk(k, dim=-1)
+            src = torch.div(top_idx, num_classes, rounding_mode='floor').view(-1) + offsets
+            wrd_idx = (top_idx % num_classes).view(-1)
+            scores = top_scores.view(-1)
+            last_wrd, last_state, state = last_wrd[src], last_state[:, :, src], state[:, :, src]
+            finished, end_of_dialog = finished[src], end_of_dialog[src]
+            lengths, q_tokens = lengths[src], q_tokens[src]
+        else:
+            wrd_idx = torch.multinomial(logp.exp(), 1).view(-1)
+            step_logp = logp.gather(1, wrd_idx.unsqueeze(-1)).squeeze(-1)
+            scores = scores + step_logp.masked_fill(finished, 0)
+        q_t = wrd_idx if qgen.shortlist is None else qgen.shortlist[wrd_idx]
+
+        # Only update those not finished
+        updated = torch.logical_not(finished)
+        lengths = lengths + updated.long()
+        last_state = torch.where(
+            updated.view(1, 1, -1, 1), state.type_as(last_state), last_state)
+        last_wrd = torch.where(updated, q_t, last_wrd)
+        q_tokens[:, t] = torch.where(updated, q_t, q_tokens[:, t])
+        new_end_of_dialog = (q_t == eod_token) & updated
+        finished = finished | ((q_t == eoq_token) & updated) | new_end_of_dialog
+        end_of_dialog = end_of_dialog | new_end_of_dialog
+        if (t + 1) % sync_every == 0 and finished.all().item():
+            break
+
+    # Length normalisation and ranking within each dialog
+    scores = scores / lengths.clamp(min=1).float() ** length_penalty
+    scores, order = scores.view(batch_size, k).sort(dim=-1, descending=True)
+    src = (order + offsets.view(batch_size, k)).view(-1)
+    return (
+        q_tokens[src].view(batch_size, k, max_q_len),
+        lengths[src].view(batch_size, k),
+        scores,
+        last_state[:, :, src],
+        end_of_dialog[src].view(batch_size, k),
+    )
@@ -19,6 +19,7 @@ from torch import nn
 from torch.nn import CrossEntropyLoss
 import torch.nn.functional as F
 from torch.nn.utils.weight_norm import weight_norm
+from torch.utils.checkpoint import checkpoint
 
 from .utils import PreTrainedModel
 import pdb
@@ -182,6 +183,9 @@ class BertConfig(object):
         model="bert",
         task_specific_tokens=False,
         visualization=False,
+        t_checkpoint_id=[],
+        v_checkpoint_id=[],
+        c_checkpoint_id=[],
     ):
 
         """Constructs BertConfig.
@@ -207,6 +211,9 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            t_checkpoint_id / v_checkpoint_id / c_checkpoint_id: Ids of the text,
+                image and co-attention layers whose activations are recomputed in
+                backward (gradient checkpointing), or "all".
         """
         assert len(v_biattention_id) == len(t_biattention_id)
         assert max(v_biattention_id) < v_num_hidden_layers
@@ -260,6 +267,9 @@ class BertConfig(object):
             self.num_negative = num_negative
             self.task_specific_tokens = task_specific_tokens
             self.visualization = visualization
+            self.t_checkpoint_id = t_checkpoint_id
+            self.v_checkpoint_id = v_checkpoint_id
+            self.c_checkpoint_id = c_checkpoint_id
         else:
             raise ValueError(
                 "First argument must be either a vocabulary size (int)"
@@ -900,6 +910,12 @@ class BertConnectionLayer(nn.Module):
         return layer_output1, layer_output2, co_attention_probs
 
 
+def _checkpoint_ids(ids, num_layers):
+    if ids == "all":
+        return set(range(num_layers))
+    return set(ids)
+
+
 class BertEncoder(nn.Module):
     def __init__(self, config):
         super(BertEncoder, self).__init__()
@@ -931,6 +947,16 @@ class BertEncoder(nn.Module):
             [copy.deepcopy(connect_layer) for _ in range(len(config.v_biattention_id))]
         )
 
+        # Layers recomputed in backward instead of keeping their activations.
+        self.t_checkpoint_id = _checkpoint_ids(config.t_checkpoint_id, len(self.layer))
+        self.v_checkpoint_id = _checkpoint_ids(config.v_checkpoint_id, len(self.v_layer))
+        self.c_checkpoint_id = _checkpoint_ids(config.c_checkpoint_id, len(self.c_layer))
+
+    def _forward_layer(self, layer, use_checkpoint, *inputs):
+        if use_checkpoint and torch.is_grad_enabled():
+            return checkpoint(layer, *inputs, use_reentrant=False)
+        return layer(*inputs)
+
     def forward(
         self,
         txt_embedding,
@@ -975,8 +1001,11 @@ class BertEncoder(nn.Module):
                         all_attention_mask_t.append(txt_attention_probs)
 
             for idx in range(t_start, t_end):
-                txt_embedding, txt_attention_probs = self.layer[idx](
-                    txt_embedding, txt_attention_mask
+                txt_embedding, txt_attention_probs = self._forward_layer(
+                    self.layer[idx],
+                    idx in self.t_checkpoint_id,
+                    txt_embedding,
+                    txt_attention_mask,
                 )
                 if output_all_attention_masks:
                     all_attention_mask_t.append(txt_attention_probs)
@@ -995,7 +1024,9 @@ class BertEncoder(nn.Module):
                         all_attnetion_mask_v.append(image_attention_probs)
 
             for idx in range(v_start, v_end):
-                image_embedding, image_attention_probs = self.v_layer[idx](
+                image_embedding, image_attention_probs = self._forward_layer(
+                    self.v_layer[idx],
+                    idx in self.v_checkpoint_id,
                     image_embedding,
                     image_attention_mask,
                     txt_embedding,
@@ -1054,9 +1085,9 @@ class BertEncoder(nn.Module):
 
             if self.with_coattention:
                 # do the bi attention.
-                image_embedding, txt_embedding, co_attention_probs = self.c_layer[
-                    count
-                ](
+                image_embedding, txt_embedding, co_attention_probs = self._forward_layer(
+                    self.c_layer[count],
+                    count in self.c_checkpoint_id,
                     image_embedding,
                     image_attention_mask,
                     txt_embedding,
@@ -1077,7 +1108,9 @@ class BertEncoder(nn.Module):
                 all_encoder_layers_v.append(image_embedding)
 
         for idx in range(v_start, len(self.v_layer)):
-            image_embedding, image_attention_probs = self.v_layer[idx](
+            image_embedding, image_attention_probs = self._forward_layer(
+                self.v_layer[idx],
+                idx in self.v_checkpoint_id,
                 image_embedding,
                 image_attention_mask,
                 txt_embedding,
@@ -1088,8 +1121,11 @@ class BertEncoder(nn.Module):
                 all_attnetion_mask_v.append(image_attention_probs)
 
         for idx in range(t_start, len(self.layer)):
-            txt_embedding, txt_attention_probs = self.layer[idx](
-                txt_embedding, txt_attention_mask
+            txt_embedding, txt_attention_probs = self._forward_layer(
+                self.layer[idx],
+                idx in self.t_checkpoint_id,
+                txt_embedding,
+                txt_attention_mask,
             )
 
             if output_all_attention_masks:
@@ -0,0 +1,77 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import os
+import hashlib
+import torch
+from src.tools.checkpoint import atomic_save
+from src.tools.distributed import get_rank, barrier, gather_objects
+
+
+def checkpoint_hash(path, block_size=2 ** 20):
+    ''' SHA-1 of a checkpoint file, identifies the weights answers were computed with '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class OracleAnswerCache(object):
+    '''
+    Oracle answers keyed by (oracle id, game id, target object id, question tokens),
+    so a question asked again in a game, or in a later run with the same Oracle,
+    does not go through the Oracle again.
+        <str> oracle_id - e.g. `checkpoint_hash` of the Oracle checkpoint
+        <str> path      - file the answers are loaded from / saved to (optional)
+    '''
+    def __init__(self, oracle_id, path=None):
+        self.oracle_id = oracle_id
+        self.path = path
+        self.answers = dict()
+        if path is not None and os.path.exists(path):
+            self.answers = torch.load(path)
+        # Answers added since the last `save`
+        self.new_answers = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.answers)
+
+    def key(self, game_key, q_tokens):
+        return (self.oracle_id, game_key, tuple(q_tokens))
+
+    def lookup(self, keys):
+        ''' (answer id, answer confidence) for each key, None for misses '''
+        answers = [self.answers.get(k) for k in keys]
+        n_hits = sum(a is not None for a in answers)
+        self.hits += n_hits
+        self.misses += len(answers) - n_hits
+        return answers
+
+    def update(self, keys, a_idx, a_conf):
+        for k, i, c in zip(keys, a_idx, a_conf):
+            self.answers[k] = (i, c)
+            self.new_answers[k] = (i, c)
+
+    def hit_rate(self):
+        return self.hits / float(max(self.hits + self.misses, 1))
+
+    def stats(self):
+        return 'Oracle answer cache - hits {} | misses {} | hit rate {:.3f} | size {}'.format(
+            self.hits, self.misses, self.hit_rate(), len(self))
+
+    def save(self):
+        '''
+        Add the new answers of all ranks (each plays its own games) to the cache and
+        write it from rank 0. Call on every rank.
+        '''
+        for new_answers in gather_objects(self.new_answers):
+            self.answers.update(new_answers)
+        self.new_answers = dict()
+        if self.path is None:
+            return
+        if get_rank() == 0:
+            # An interrupted save keeps the old cache
+            atomic_save(self.answers, self.path)
+        barrier()
@@ -0,0 +1,199 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import os
+import time
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+from collections import OrderedDict
+
+# Floating point types of exported weights
+DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def snapshot(state):
+    ''' Copy of the tensors of a (nested) state dict on CPU, safe from later in-place updates '''
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def atomic_save(state, path):
+    ''' torch.save to a temporary file renamed over `path`, so `path` is never half written '''
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_copy(src, path):
+    ''' Hard link (copy if links are not supported) of `src` renamed over `path` '''
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def get_rng_state():
+    ''' States of the python, numpy and torch (CPU and CUDA) random generators '''
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        # Plain python types, which torch.load also reads with `weights_only`
+        'numpy': (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    ''' Inverse of `get_rng_state`, for checkpoints loaded with any `map_location` '''
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    # Generator states must be CPU ByteTensors
+    torch.set_rng_state(state['torch'].cpu())
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def strip_module_prefix(state_dict):
+    ''' Keys without the `module.` prefix of models saved inside a DistributedDataParallel wrapper '''
+    if not all(k.startswith('module.') for k in state_dict):
+        return state_dict
+    return OrderedDict((k[len('module.'):], v) for k, v in state_dict.items())
+
+
+def export_weights(ckpt_path, out_path, dtype='fp32'):
+    '''
+    Write the model weights of a training checkpoint, without the optimizer state
+    and `module.` prefixes, with floating point tensors in `dtype` ('fp32', 'bf16', 'fp16')
+    return: number of tensors written
+    '''
+    state_dict = strip_module_prefix(torch.load(ckpt_path, map_location='cpu')['model'])
+    cast = dict()
+    weights = OrderedDict()
+    for k, v in state_dict.items():
+        if v.is_floating_point():
+            # Tensors sharing storage (tied weights) stay shared
+            if v.data_ptr() not in cast:
+                cast[v.data_ptr()] = v.to(DTYPES[dtype]).contiguous()
+            v = cast[v.data_ptr()]
+        weights[k] = v
+    atomic_save({'model': weights, 'dtype': dtype}, out_path)
+    return len(weights)
+
+
+def load_weights(path):
+    '''
+    Model weights of a training checkpoint or an `export_weights` file, memory-mapped
+    so that only the tensors that are used (not the optimizer state) are read
+    '''
+    try:
+        state = torch.load(path, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # Files in the legacy (non-zip) format cannot be memory-mapped
+        state = torch.load(path, map_location='cpu')
+    return strip_module_prefix(state['model'])
+
+
+class CheckpointWriter(object):
+    '''
+    Write checkpoints on a background thread: `save` only snapshots the state on CPU
+    and training goes on while it is written. Writes are queued and run one at a
+    time, in order.
+        <int> keep_last   - number of rolling checkpoints kept (None: all), files
+                            saved in `keep` (e.g. best.pth) are never removed
+        <fn> log          - called with a message when a write is done
+        <int> max_pending - number of snapshots held in memory, `save` waits for
+                            the oldest write beyond it
+    A failed write is raised again by the next `save` or `wait`.
+    '''
+    def __init__(self, keep_last=None, log=print, max_pending=2):
+        self.keep_last = keep_last
+        self.log = log
+        self.max_pending = max_pending
+        self.rolling = []
+        # Guards `rolling`, which the writes prune
+        self.lock = threading.Lock()
+        self.threads = []
+        self.error = None
+
+    def save(self, state, paths, keep=()):
+        '''
+        Snapshot `state` and queue its write
+            <str/list> paths - file(s) to write, the others are links to / copies of the first
+            <list> keep      - paths never removed by `keep_last`
+        return: time (s) spent on the calling thread
+        '''
+        start = time.time()
+        self.threads = [t for t in self.threads if t.is_alive()]
+        while len(self.threads) >= self.max_pending:
+            self.threads.pop(0).join()
+        self.raise_error()
+        state = snapshot(state)
+        paths = [paths] if isinstance(paths, str) else list(paths)
+        with self.lock:
+            for path in paths:
+                if path not in keep and path not in self.rolling:
+                    self.rolling.append(path)
+        # Not a daemon, so the interpreter waits for the last write before exiting
+        prev = self.threads[-1] if self.threads else None
+        thread = threading.Thread(target=self._write, args=(state, paths, prev))
+        thread.start()
+        self.threads.append(thread)
+        return time.time() - start
+
+    def _write(self, state, paths, prev):
+        if prev is not None:
+            prev.join()
+        start = time.time()
+        for i, path in enumerate(paths):
+            try:
+                if i == 0:
+                    atomic_save(state, path)
+                else:
+                    atomic_copy(paths[0], path)
+            except Exception as e:
+                # e.g. a full disk, the paths keep their previous content
+                with self.lock:
+                    for failed_path in paths[i:]:
+                        if os.path.exists(failed_path + '.tmp'):
+                            os.remove(failed_path + '.tmp')
+                        if failed_path in self.rolling and not os.path.exists(failed_path):
+                            self.rolling.remove(failed_path)
+                self.error = e
+                return
+        self.log('Wrote checkpoint {} in {:.1f}s'.format(', '.join(paths), time.time() - start))
+        if self.keep_last is not None:
+            with self.lock:
+                while len(self.rolling) > self.keep_last:
+                    old_path = self.rolling.pop(0)
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+
+    def raise_error(self):
+        ''' Raise the exception of a failed write, if any '''
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Checkpoint write failed') from error
+
+    def wait(self):
+        ''' Wait for the queued writes, raise the exception of a failed one '''
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.raise_error()
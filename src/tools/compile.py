@@ -0,0 +1,108 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import torch
+import torch.nn.functional as F
+from src.model.vilbert.vilbert import BertModel
+
+# Padded sizes of the text / region dimensions fed to compiled ViLBERT trunks.
+# Every distinct size is one more compiled graph.
+TXT_BUCKETS = [8, 12, 16, 24, 32, 48, 64]
+BBOX_BUCKETS = [8, 16, 24, 32, 48, 64, 101]
+# Distinct batch sizes a trunk is expected to see per bucket (full batches, the
+# last batches of the train / dev sets, shrinking self-play batches)
+NUM_BATCH_SIZES = 4
+
+
+def bucket_size(size, buckets):
+    ''' Smallest bucket >= size, or size itself if it exceeds every bucket. '''
+    for b in buckets:
+        if b >= size:
+            return b
+    return size
+
+
+def pad_to_bucket(x, dim, buckets, value=0):
+    '''
+    Right-pad `x` along `dim` with `value` up to its bucket size
+        <torch> x     - tensor to pad
+        <int> dim     - dimension to pad
+        <list> buckets - allowed sizes of `dim`
+    '''
+    dim = dim % x.dim()
+    n_pad = bucket_size(x.size(dim), buckets) - x.size(dim)
+    if n_pad == 0:
+        return x
+    # F.pad takes (left, right) pairs starting from the last dimension
+    pad = [0, 0] * (x.dim() - dim - 1) + [0, n_pad]
+    if x.dtype == torch.bool:
+        return F.pad(x.long(), pad, value=int(value)).bool()
+    return F.pad(x, pad, value=value)
+
+
+def cache_size_limit(num_batch_sizes=NUM_BATCH_SIZES):
+    ''' Graphs per trunk: text buckets x region buckets x train/eval x batch sizes '''
+    return len(TXT_BUCKETS) * len(BBOX_BUCKETS) * 2 * num_batch_sizes
+
+
+def compile_vilbert(model, limit=None):
+    '''
+    Compile the forward of every ViLBERT trunk in `model` in place. The
+    modules themselves are kept so state dicts and checkpoints are unchanged.
+    Dynamo's cache size limits (8 graphs per function by default) are raised to
+    `limit`, past it a trunk silently falls back to eager mode.
+        <int> limit - graphs per trunk, None: cache_size_limit()
+    Returns the number of compiled trunks.
+    '''
+    import torch._dynamo
+    limit = cache_size_limit() if limit is None else limit
+    dynamo_config = torch._dynamo.config
+    dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, limit)
+    if hasattr(dynamo_config, 'accumulated_cache_size_limit'):
+        dynamo_config.accumulated_cache_size_limit = max(
+            dynamo_config.accumulated_cache_size_limit, limit)
+    n_compiled = 0
+    for module in model.modules():
+        if isinstance(module, BertModel):
+            module.forward = torch.compile(module.forward, dynamic=False)
+            n_compiled += 1
+    return n_compiled
+
+
+def warmup_vilbert(model, batch_size, num_bboxs, device, txt_buckets=TXT_BUCKETS, image_mask=False):
+    '''
+    Trigger compilation of every ViLBERT trunk in `model` for all text buckets
+    with `num_bboxs` regions, in the current train/eval and grad mode.
+        <bool> image_mask - whether the callers pass an `image_attention_mask`
+    '''
+    for module in model.modules():
+        if not isinstance(module, BertModel):
+            continue
+        config = module.config
+        for txt_len in txt_buckets:
+            module(
+                torch.zeros(batch_size, txt_len, dtype=torch.long, device=device),
+                torch.zeros(batch_size, num_bboxs, config.v_feature_size, device=device),
+                torch.zeros(batch_size, num_bboxs, 5, device=device),
+                attention_mask=torch.ones(batch_size, txt_len, dtype=torch.long, device=device),
+                image_attention_mask=torch.ones(batch_size, num_bboxs, dtype=torch.long, device=device)
+                    if image_mask else None,
+            )
+
+
+def num_compiled_graphs():
+    ''' Number of graphs compiled so far in this process. '''
+    try:
+        from torch._dynamo.utils import counters
+    except ImportError:
+        return 0
+    return counters['stats']['unique_graphs']
+
+
+def num_cache_limit_hits():
+    ''' Number of times a function ran in eager mode because dynamo's cache size limit was hit. '''
+    try:
+        from torch._dynamo.utils import counters
+    except ImportError:
+        return 0
+    return sum(n for msg, n in counters['unimplemented'].items()
+               if 'cache_size_limit' in msg or 'cache_limit' in msg or 'recompile_limit' in msg)
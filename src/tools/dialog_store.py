@@ -0,0 +1,116 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import torch
+
+
+class DialogWriter(object):
+    '''
+    Collect self-play dialogs game by game and save them in one file, see `DialogStore`
+    '''
+    def __init__(self):
+        self.game_id, self.label = [], []
+        self.q_len, self.q_tokens, self.num_qs = [], [], []
+        self.a_idx, self.a_conf, self.num_as = [], [], []
+
+    def __len__(self):
+        return len(self.game_id)
+
+    def add(self, game_id, label, q_log, a_idx_log, a_conf_log):
+        '''
+            <int> game_id, label  - game and index of its target object
+            <list> q_log          - token list per question
+            <list> a_idx_log      - Oracle answer id per answered question
+            <list> a_conf_log     - Oracle confidence per answer
+        '''
+        self.game_id.append(game_id)
+        self.label.append(label)
+        self.num_qs.append(len(q_log))
+        for q in q_log:
+            self.q_len.append(len(q))
+            self.q_tokens.extend(q)
+        self.num_as.append(len(a_idx_log))
+        self.a_idx.extend(a_idx_log)
+        self.a_conf.extend(a_conf_log)
+
+    def save(self, path):
+        torch.save({
+            'game_id': torch.LongTensor(self.game_id),
+            'label': torch.LongTensor(self.label),
+            'num_qs': torch.LongTensor(self.num_qs),
+            'q_len': torch.LongTensor(self.q_len),
+            'q_tokens': torch.IntTensor(self.q_tokens),
+            'num_as': torch.LongTensor(self.num_as),
+            'a_idx': torch.LongTensor(self.a_idx).to(torch.int8),
+            'a_conf': torch.FloatTensor(self.a_conf).half(),
+        }, path)
+
+
+class DialogStore(object):
+    '''
+    Saved self-play dialogs: question tokens of all games in one flat tensor,
+    located through per-question lengths and per-game question / answer counts.
+        <str> path - file written by `DialogWriter.save`
+    '''
+    def __init__(self, path):
+        data = torch.load(path)
+        self.label = data['label'].tolist()
+        self.num_as = data['num_as'].tolist()
+        self.q_len = data['q_len'].tolist()
+        self.q_tokens = data['q_tokens']
+        self.a_idx = data['a_idx'].long()
+        self.a_conf = data['a_conf'].float()
+        num_qs = data['num_qs']
+        # Offsets of each game's first question / answer, and of each question's first token
+        self.q_start = (torch.cumsum(num_qs, 0) - num_qs).tolist()
+        self.a_start = (torch.cumsum(data['num_as'], 0) - data['num_as']).tolist()
+        q_len = data['q_len']
+        self.tok_start = (torch.cumsum(q_len, 0) - q_len).tolist()
+        self.index = {g: i for i, g in enumerate(data['game_id'].tolist())}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, game_id):
+        return game_id in self.index
+
+    def answered_turns(self, game_id):
+        ''' (question tokens, answer id) of the answered turns of a game '''
+        i = self.index[game_id]
+        turns = []
+        for t in range(self.num_as[i]):
+            q = self.q_start[i] + t
+            tokens = self.q_tokens[self.tok_start[q]:self.tok_start[q] + self.q_len[q]]
+            turns.append((tokens, self.a_idx[self.a_start[i] + t]))
+        return turns
+
+    def batch(self, game_ids, sos_token, pad_token, device):
+        '''
+        Answered turns of some games as Guesser inputs
+        return: qs (batch_size, max_turns, max_len+1) questions after a `sos_token`,
+                attention_mask (same shape), answers (batch_size, max_turns),
+                end_turn (batch_size,) last answered turn, -1 if none
+        '''
+        dialogs = [self.answered_turns(g) for g in game_ids]
+        max_turns = max([len(d) for d in dialogs] + [1])
+        max_len = max([len(q) for d in dialogs for q, _ in d] + [1])
+        qs = torch.zeros(len(dialogs), max_turns, max_len+1).fill_(pad_token).long()
+        qs[:, :, 0] = sos_token
+        attention_mask = torch.zeros_like(qs)
+        answers = torch.zeros(len(dialogs), max_turns).long()
+        end_turn = torch.LongTensor([len(d) - 1 for d in dialogs])
+        for b, d in enumerate(dialogs):
+            for t, (q, a) in enumerate(d):
+                qs[b, t, 1:len(q)+1] = q
+                # +1 : [CLS] token
+                attention_mask[b, t, :len(q)+1] = 1
+                answers[b, t] = a
+        return qs.to(device), attention_mask.to(device), answers.to(device), end_turn.to(device)
+
+
+def merge_dialog_files(paths, out_path):
+    '''
+    Concatenate dialog files saved by `DialogWriter.save`: games are located
+    through counts and lengths only, so the tensors simply follow each other.
+    '''
+    data = [torch.load(p) for p in paths]
+    torch.save({k: torch.cat([d[k] for d in data]) for k in data[0]}, out_path)
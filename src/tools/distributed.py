@@ -0,0 +1,124 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: CC-BY-NC-4.0
+import os
+import torch
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def shard_indices(num_items, rank=None, world_size=None):
+    '''
+    Indices of the items of this rank: every `world_size`-th item from `rank`,
+    so shards differ by at most one item and no item is repeated
+    '''
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    return list(range(rank, num_items, world_size))
+
+
+def all_reduce_sum(values, device):
+    ''' Sum a list of numbers over all ranks '''
+    if not is_distributed():
+        return list(values)
+    # nccl only reduces cuda tensors, gloo any
+    t = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.tolist()
+
+
+def shard_path(path, rank=None):
+    ''' Per-rank file of `path` while distributed, `path` itself otherwise '''
+    if not is_distributed():
+        return path
+    rank = get_rank() if rank is None else rank
+    return '%s.rank%d' % (path, rank)
+
+
+def merge_shard_files(path, sort_key=None, header=True):
+    '''
+    Merge the per-rank text files of `path` written with `shard_path` into `path`,
+    sorting the lines with `sort_key` so the result does not depend on the number
+    of ranks, and remove them. Call on one rank after a `barrier`.
+        <bool> header - the shards start with the same header line
+    '''
+    head, lines = None, []
+    for rank in range(get_world_size()):
+        name = shard_path(path, rank)
+        with open(name, 'r') as f:
+            shard_lines = f.readlines()
+        if header:
+            head, shard_lines = shard_lines[0], shard_lines[1:]
+        lines.extend(shard_lines)
+        os.remove(name)
+    if sort_key is not None:
+        lines.sort(key=sort_key)
+    with open(path, 'w') as f:
+        if head is not None:
+            f.write(head)
+        f.writelines(lines)
+
+
+def gather_objects(obj):
+    ''' List of the (picklable) `obj` of every rank, in rank order '''
+    if not is_distributed():
+        return [obj]
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def gather_shards(items):
+    '''
+    Per-item results of all ranks, each computed over its `shard_indices` shard,
+    gathered back in the original item order
+    '''
+    if not is_distributed():
+        return list(items)
+    shards = [None] * get_world_size()
+    dist.all_gather_object(shards, list(items))
+    # Item i is the (i // world_size)-th item of rank i % world_size
+    gathered = []
+    for i in range(len(shards[0])):
+        gathered.extend(s[i] for s in shards if i < len(s))
+    return gathered
+
+
+class ResumableSampler(DistributedSampler):
+    '''
+    Training sampler of this rank (the whole shuffled dataset when not distributed)
+    that can start an epoch after its first items, e.g. the batches done before a
+    checkpoint. The order only depends on `seed` and the epoch, so it is the same
+    after a restart.
+    '''
+    def __init__(self, dataset, seed=0):
+        super().__init__(
+            dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=True, seed=seed)
+        self.start = 0
+
+    def set_start(self, start):
+        ''' Skip the first `start` items of the epoch '''
+        self.start = start
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
@@ -17,10 +17,12 @@ class Optimizer(object):
         optimizer, 
         lr, 
         lr_scheduler,
+        grad_accum_steps=1,
         **kwargs):
         
         # Setup torch optimizer
         self.opt_type = optimizer
+        self.grad_accum_steps = grad_accum_steps
         self.sch_type = lr_scheduler
         opt = getattr(torch.optim, optimizer)
         if lr_scheduler == 'warmup':
@@ -52,6 +54,11 @@ class Optimizer(object):
 
 
     def pre_step(self, step):
+        if step % self.grad_accum_steps != 0:
+            # Keep accumulating the gradients of the previous batches
+            return
+        # The learning rate follows optimizer steps, not batches
+        step = step // self.grad_accum_steps
         if self.lr_scheduler is not None:
             # cur_lr = self.lr_scheduler(step)
             for i, param_group in enumerate(self.opt.param_groups):
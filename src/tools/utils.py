@@ -3,6 +3,7 @@
 
 
 import io
+import os
 import torch
 import jsonlines
 import numpy as np
@@ -181,6 +182,30 @@ def load_all_gt_games(annotation_path, verbose=False, debug=False):
     return games
 
 
+def load_vocab_shortlist(path, dataroot, tokenizer, dataset_name='guesswhat', verbose=False):
+    '''
+    Sorted word pieces of the successful training games' questions plus <eoq> and
+    <eod>, i.e. every token QGen is trained to generate. Cached as .npy at `path`.
+    '''
+    if os.path.exists(path):
+        return np.load(path).tolist()
+    token_ids = {tokenizer.eoq_id, tokenizer.eod_id}
+    annotation_path = os.path.join(dataroot, '%s.train.jsonl' % dataset_name)
+    if verbose:
+        print("[INFO] Building vocabulary shortlist from %s..." % annotation_path)
+    with jsonlines.open(annotation_path) as reader:
+        iterator = tqdm(reader) if verbose else reader
+        for annotation in iterator:
+            if annotation['status'] != 'success':
+                continue
+            for qa in annotation['qas']:
+                token_ids.update(tokenizer.encode(qa['question']))
+    token_ids = sorted(token_ids)
+    with open(path, 'wb') as f:
+        np.save(f, np.array(token_ids, dtype=np.int64))
+    return token_ids
+
+
 class Game(object):
     def __init__(self, game_id, object_id, image_info, objects, qas, status):
         self.id = game_id